@@ -0,0 +1,81 @@
+"""
+Benchmarks assembling 4k x 4k masks and images from 84 x 84 patches.
+
+Compares evaluation._patches_to_image and prediction.patch_values_to_mask with
+the nested loops they replaced.
+
+Usage:
+  python benchmarks/benchmark_masks.py
+"""
+
+from __future__ import print_function
+
+import timeit
+
+import numpy
+
+import microscopeimagequality.evaluation
+import microscopeimagequality.prediction
+
+_PATCH_WIDTH = 84
+_NUM_PATCHES_PER_SIDE = 4096 // _PATCH_WIDTH
+_NUM_REPEATS = 5
+
+
+def _patches_to_image_loop(patches, image_shape):
+    """The former nested-loop implementation of _patches_to_image."""
+    patch_width = patches.shape[1]
+    num_rows = image_shape[0] // patch_width
+    num_cols = image_shape[1] // patch_width
+    image = numpy.zeros([num_rows * patch_width, num_cols * patch_width, patches.shape[3]], dtype=patches.dtype)
+    index = 0
+    for i in range(0, num_rows * patch_width, patch_width):
+        for j in range(0, num_cols * patch_width, patch_width):
+            image[i:i + patch_width, j:j + patch_width, :] = patches[index, :, :, :]
+            index += 1
+    return image
+
+
+def _patch_values_to_mask_loop(values, patch_width):
+    """The former nested-loop implementation of patch_values_to_mask."""
+    mask = numpy.zeros(
+        (values.shape[0] * patch_width, values.shape[1] * patch_width),
+        dtype=numpy.uint16)
+    for i in range(values.shape[0]):
+        for j in range(values.shape[1]):
+            mask[i * patch_width:(i + 1) * patch_width, j * patch_width:(j + 1) * patch_width] = values[i, j]
+    return mask
+
+
+def _time(function):
+    """Returns the best time in milliseconds of a function call."""
+    return 1000 * min(timeit.repeat(function, number=1, repeat=_NUM_REPEATS))
+
+
+def main():
+    image_width = _NUM_PATCHES_PER_SIDE * _PATCH_WIDTH
+    image_shape = (image_width, image_width)
+
+    values = numpy.random.randint(
+        0, 65535, (_NUM_PATCHES_PER_SIDE, _NUM_PATCHES_PER_SIDE)).astype(numpy.uint16)
+    numpy.testing.assert_array_equal(
+        _patch_values_to_mask_loop(values, _PATCH_WIDTH),
+        microscopeimagequality.prediction.patch_values_to_mask(values, _PATCH_WIDTH))
+    print('patch_values_to_mask, %dx%d mask: loop %.1f ms, vectorized %.1f ms' % (
+        image_width, image_width,
+        _time(lambda: _patch_values_to_mask_loop(values, _PATCH_WIDTH)),
+        _time(lambda: microscopeimagequality.prediction.patch_values_to_mask(values, _PATCH_WIDTH))))
+
+    patches = numpy.random.rand(
+        _NUM_PATCHES_PER_SIDE ** 2, _PATCH_WIDTH, _PATCH_WIDTH, 3).astype(numpy.float32)
+    numpy.testing.assert_array_equal(
+        _patches_to_image_loop(patches, image_shape),
+        microscopeimagequality.evaluation._patches_to_image(patches, image_shape))
+    print('_patches_to_image, %dx%d RGB image: loop %.1f ms, vectorized %.1f ms' % (
+        image_width, image_width,
+        _time(lambda: _patches_to_image_loop(patches, image_shape)),
+        _time(lambda: microscopeimagequality.evaluation._patches_to_image(patches, image_shape))))
+
+
+if __name__ == '__main__':
+    main()
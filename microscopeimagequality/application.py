@@ -13,6 +13,7 @@ matplotlib.use('Agg')
 import microscopeimagequality.constants as constants
 import microscopeimagequality.data_provider
 import microscopeimagequality.dataset_creation
+import microscopeimagequality.degrade
 import microscopeimagequality.evaluation
 import microscopeimagequality.prediction
 import microscopeimagequality.miq
@@ -128,7 +129,11 @@ def evaluate(images, checkpoint, output, patch_width):
 @command.command()
 @click.argument("images", nargs=-1, type=click.Path(exists=True))
 @click.option("--output", nargs=1, type=click.Path())
-def fit(images, output):
+@click.option("--defocus-z-depth", type=float, multiple=True)
+@click.option("--encoding", default=microscopeimagequality.data_provider.ENCODING_FLOAT_LIST)
+@click.option("--shards", default=None, type=int)
+@click.option("--workers", default=None, type=int)
+def fit(images, output, defocus_z_depth, encoding, shards, workers):
     if not os.path.exists(output):
         os.makedirs(output)
 
@@ -146,9 +151,20 @@ def fit(images, output):
         num_classes,
         image_width=image_size.width,
         image_height=image_size.height,
-        image_background_value=0.0
+        image_background_value=0.0,
+        num_workers=workers,
+        encoding=encoding,
+        num_output_shards=shards
     )
 
+    # With --defocus-z-depth, the images are in focus, and are degraded to one
+    # class per z-depth during training, ignoring their labels.
+    if defocus_z_depth:
+        defocus_psfs = microscopeimagequality.degrade.get_airy_psf_stack(defocus_z_depth)
+        num_classes = len(defocus_z_depth)
+    else:
+        defocus_psfs = None
+
     tfexamples_tfrecord_file_pattern = os.path.join(output, output_tfrecord_file_pattern)
 
     graph = tensorflow.Graph()
@@ -174,7 +190,8 @@ def fit(images, output):
                 num_classes=num_classes,
                 image_width=image_size.width,
                 image_height=image_size.height,
-                patch_width=84
+                patch_width=84,
+                defocus_psfs=defocus_psfs
             )
 
             # Visualize the input
@@ -221,15 +238,46 @@ def download(output_path):
     else:
         microscopeimagequality.miq.download_model()
 
+
+# $ quality degrade-stack tests/data/cell_image.tiff --output tests/degraded --z-depth 0 --z-depth 2e-6 --z-depth 4e-6
+@command.command(name="degrade-stack")
+@click.argument("images", nargs=-1, type=click.Path(exists=True))
+@click.option("--exposure", type=float, multiple=True, default=[1.0])
+@click.option("--output", type=click.Path(), required=True)
+@click.option("--photoelectron-factor", default=65535.0)
+@click.option("--psf-cache", type=click.Path(), default=None)
+@click.option("--seed", default=0)
+@click.option("--sensor-offset", default=100.0)
+@click.option("--workers", default=None, type=int)
+@click.option("--z-depth", type=float, multiple=True)
+def degrade_stack(images, exposure, output, photoelectron_factor, psf_cache, seed, sensor_offset, workers, z_depth):
+    class_globs = microscopeimagequality.degrade.degrade_stack(
+        list(images),
+        output,
+        z_depths_meters=z_depth,
+        exposure_factors=exposure,
+        random_seed=seed,
+        photoelectron_factor=photoelectron_factor,
+        sensor_offset_in_photoelectrons=sensor_offset,
+        psf_cache_directory=psf_cache,
+        num_workers=workers
+    )
+
+    click.echo(' '.join(class_globs))
+
 @command.command()
 @click.argument("images", nargs=-1, type=click.Path(exists=True))
 @click.option("--checkpoint", type=click.Path(), default=None)
 @click.option("--height", type=int)
+@click.option("--in-memory", is_flag=True)
 @click.option("--output", type=click.Path())
+@click.option("--patch-stride", type=int, default=None)
 @click.option("--patch-width", default=84)
+@click.option("--results-store", is_flag=True)
 @click.option("--visualize", is_flag=True)
 @click.option("--width", type=int)
-def predict(images, checkpoint, output, width, height, patch_width, visualize):
+@click.option("--workers", default=1)
+def predict(images, checkpoint, output, width, height, patch_width, visualize, in_memory, patch_stride, workers, results_store):
     if output is None:
         logging.fatal('Eval directory required.')
 
@@ -259,11 +307,68 @@ def predict(images, checkpoint, output, width, height, patch_width, visualize):
 
         image_height = image_size.height
 
+    if patch_stride is not None and patch_width % patch_stride:
+        raise click.UsageError('--patch-stride must divide --patch-width.')
+
     # All patches evaluated in a batch correspond to one single input image.
-    batch_size = int(image_width * image_height / (patch_width ** 2))
+    batch_size = len(microscopeimagequality.prediction._get_patch_locations((image_height, image_width), patch_width, patch_stride))
 
     logging.info('Using batch_size=%d for image_width=%d, image_height=%d, model_patch_width=%d', batch_size, image_width, image_height, patch_width)
 
+    if workers > 1:
+        if visualize:
+            raise click.UsageError('--visualize cannot be used with --workers.')
+
+        if in_memory:
+            logging.info('Ignoring --in-memory, workers always read the images in memory.')
+
+        # Each worker evaluates one shard of the images, with its own session.
+        microscopeimagequality.prediction.run_sharded_model_inference(
+            aggregation_method=microscopeimagequality.evaluation.METHOD_AVERAGE,
+            image_height=image_height,
+            image_width=image_width,
+            list_of_image_globs=images,
+            model_ckpt_file=checkpoint,
+            num_classes=11,
+            num_workers=workers,
+            output_directory=os.path.join(output, 'miq_result_images'),
+            patch_stride=patch_stride,
+            patch_width=patch_width,
+            results_store=results_store
+        )
+
+        return
+
+    if in_memory:
+        dataset = microscopeimagequality.dataset_creation.read_dataset(
+            list_of_image_globs=images,
+            num_classes=11,
+            image_width=image_width,
+            image_height=image_height,
+            max_images=1e6,
+            use_unlabeled_data=use_unlabeled_data
+        )
+
+        logging.info('Dataset has %g samples.', dataset.num_examples)
+
+        microscopeimagequality.prediction.run_model_inference_from_images(
+            aggregation_method=microscopeimagequality.evaluation.METHOD_AVERAGE,
+            dataset=dataset,
+            image_height=image_height,
+            image_width=image_width,
+            model_ckpt_file=checkpoint,
+            num_classes=11,
+            num_shards=1,
+            output_directory=os.path.join(output, 'miq_result_images'),
+            patch_stride=patch_stride,
+            patch_width=patch_width,
+            results_store=results_store,
+            shard_num=1,
+            show_plots=visualize
+        )
+
+        return
+
     tfexamples_tfrecord = microscopeimagequality.prediction.build_tfrecord_from_pngs(images, use_unlabeled_data, 11, output, 0.0, 1.0, 1, 1, image_width, image_height)
 
     num_samples = microscopeimagequality.data_provider.get_num_records(tfexamples_tfrecord % microscopeimagequality.prediction._SPLIT_NAME)
@@ -279,6 +384,7 @@ def predict(images, checkpoint, output, width, height, patch_width, visualize):
             image_width=image_width,
             num_classes=11,
             num_threads=1,
+            patch_stride=patch_stride,
             patch_width=patch_width,
             randomize=False,
             split_name=microscopeimagequality.prediction._SPLIT_NAME,
@@ -304,8 +410,10 @@ def predict(images, checkpoint, output, width, height, patch_width, visualize):
             num_samples=num_samples,
             num_shards=1,
             output_directory=os.path.join(output, 'miq_result_images'),
+            patch_stride=patch_stride,
             patch_width=patch_width,
             probabilities=model_metrics.probabilities,
+            results_store=results_store,
             shard_num=1,
             show_plots=visualize
         )
@@ -320,13 +428,19 @@ def predict(images, checkpoint, output, width, height, patch_width, visualize):
 
 @command.command()
 @click.argument("experiments", type=click.Path(exists=True))
-def summarize(experiments):
+@click.option("--fast", is_flag=True)
+@click.option("--workers", default=None, type=int)
+def summarize(experiments, fast, workers):
     if experiments is None:
         logging.fatal('Experiment directory required.')
 
-    probabilities, labels, certainties, orig_names, predictions = microscopeimagequality.evaluation.load_inference_results(experiments)
+    results = microscopeimagequality.evaluation.load_inference_columns(experiments, microscopeimagequality.evaluation.RESULT_COLUMNS + [microscopeimagequality.evaluation.RESULT_VALID_SIZES])
+
+    probabilities, labels, certainties, orig_names, predictions = [results[column] for column in microscopeimagequality.evaluation.RESULT_COLUMNS]
+
+    valid_sizes = results[microscopeimagequality.evaluation.RESULT_VALID_SIZES]
 
-    if not predictions:
+    if len(predictions) == 0:
         logging.fatal('No inference output found at %s.', experiments)
 
     microscopeimagequality.summarize.check_image_count_matches(experiments, len(predictions))
@@ -342,9 +456,9 @@ def summarize(experiments):
     if not os.path.isdir(output_path_all_plots):
         os.makedirs(output_path_all_plots)
 
-    microscopeimagequality.summarize.save_histograms_scatter_plots_and_csv(probabilities, labels, certainties, orig_names, predictions, output_path, output_path_all_plots)
+    microscopeimagequality.summarize.save_histograms_scatter_plots_and_csv(probabilities, labels, certainties, orig_names, predictions, output_path, output_path_all_plots, valid_sizes, num_workers=workers, fast=fast)
 
-    microscopeimagequality.summarize.save_summary_montages(probabilities, certainties, orig_names, predictions, experiments, output_path, output_path_all_plots)
+    microscopeimagequality.summarize.save_summary_montages(probabilities, certainties, orig_names, predictions, experiments, output_path, output_path_all_plots, valid_sizes, num_workers=workers, fast=fast)
 
     logging.info('Done summarizing results at %s', output_path)
 
@@ -355,7 +469,8 @@ def summarize(experiments):
 @click.option("--width", type=int)
 @click.option("--height", type=int)
 @click.option("--patch-width", default=84)
-def validate(images, width, height, patch_width):
+@click.option("--workers", default=16)
+def validate(images, width, height, patch_width, workers):
     image_paths = []
 
     for image in images:
@@ -369,6 +484,6 @@ def validate(images, width, height, patch_width):
     microscopeimagequality.validation.check_duplicate_image_name(image_paths)
 
     if width is None or height is None:
-        height, width = microscopeimagequality.dataset_creation.image_size_from_glob(images, patch_width)
+        height, width = microscopeimagequality.dataset_creation.image_size_from_glob(images[0], patch_width)
 
-    microscopeimagequality.validation.check_image_dimensions(image_paths, height, width)
+    microscopeimagequality.validation.check_image_dimensions(image_paths, height, width, num_workers=workers)
@@ -3,6 +3,7 @@
 VALID_MASK_FORMAT = 'valid_mask_%s'
 CERTAINTY_MASK_FORMAT = 'certainty_mask_%s'
 PREDICTIONS_MASK_FORMAT = 'predictions_mask_%s'
+DENSE_PREDICTIONS_MASK_FORMAT = 'dense_predictions_mask_%s'
 ORIG_IMAGE_FORMAT = 'orig_name=%s'
 PATCH_SIDE_LENGTH = 84
 
@@ -3,9 +3,12 @@
 The TFRecords contain TF Example protos with full-size images and labels. Either
 a random cropped patch of the image, or all of the tiles within an image are
 extracted and converted to batched tensors, ready for training or inference.
+The input pipeline is a tf.data.Dataset, so no queue runners are needed.
 """
 
+import json
 import logging
+import multiprocessing
 import os
 
 import numpy
@@ -17,6 +20,19 @@ IMAGE_HEIGHT = 520
 FEATURE_IMAGE = 'image'
 FEATURE_IMAGE_CLASS = 'image/class'
 FEATURE_IMAGE_PATH = 'image/path'
+FEATURE_IMAGE_ENCODED = 'image/encoded'
+FEATURE_IMAGE_FORMAT = 'image/format'
+
+# Image encodings in the TF Examples. With ENCODING_FLOAT_LIST, the image is
+# stored under FEATURE_IMAGE, otherwise the bytes are stored under
+# FEATURE_IMAGE_ENCODED and the encoding under FEATURE_IMAGE_FORMAT.
+ENCODING_FLOAT_LIST = 'float_list'
+# Little-endian float32 pixels, lossless.
+ENCODING_RAW_FLOAT32 = 'raw_float32'
+# Little-endian uint16 pixels, quantized to multiples of 1/65535.
+ENCODING_RAW_UINT16 = 'raw_uint16'
+# 16-bit greyscale .png, quantized to multiples of 1/65535.
+ENCODING_PNG = 'png'
 
 _ITEMS_TO_DESCRIPTIONS = {
     FEATURE_IMAGE: 'A [width x width x 1] grayscale image.',
@@ -32,6 +48,10 @@ _BRIGHTNESS_MAX_FACTOR = 5.0
 _BRIGHTNESS_MIN_OFFSET = 1.0 / 65535
 _BRIGHTNESS_MAX_OFFSET = 1000.0 / 65535
 
+# Image sensor parameters for synthesizing defocus, as in degrade.ImageDegrader.
+_DEFOCUS_PHOTOELECTRON_FACTOR = 65535.0
+_DEFOCUS_SENSOR_OFFSET_IN_PHOTOELECTRONS = 100.0
+
 
 def get_filename_num_records(tf_record_path):
     """Get path to text file containing number of records.
@@ -45,15 +65,87 @@ def get_filename_num_records(tf_record_path):
     return os.path.splitext(tf_record_path)[0] + '.num_records'
 
 
+def get_filename_manifest(tf_record_path):
+    """Get path to the manifest of a TFRecord written in shards.
+
+  Args:
+    tf_record_path: String, path to TFRecord file, without the shard suffix.
+
+  Returns:
+    String, path to .json file listing the shards and their number of records.
+  """
+    return os.path.splitext(tf_record_path)[0] + '.manifest.json'
+
+
+def get_shard_filename(tf_record_path, shard_num, num_shards):
+    """Get path to one shard of a TFRecord.
+
+  Args:
+    tf_record_path: String, path to TFRecord file, without the shard suffix.
+    shard_num: Integer, the shard number.
+    num_shards: Integer, total number of shards.
+
+  Returns:
+    String, path to the shard, e.g. 'file-00001-of-00004.tfrecord'.
+  """
+    root, extension = os.path.splitext(tf_record_path)
+    return '%s-%05d-of-%05d%s' % (root, shard_num, num_shards, extension)
+
+
+def read_manifest(tf_record_path):
+    """Read the shards of a TFRecord from its manifest.
+
+  Args:
+    tf_record_path: String, path to TFRecord file, without the shard suffix.
+
+  Returns:
+    List of (shard path, number of records) tuples, or None if the TFRecord
+    was not written in shards.
+  """
+    manifest_path = get_filename_manifest(tf_record_path)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    directory = os.path.dirname(tf_record_path)
+    return [(os.path.join(directory, shard['path']), shard['num_records'])
+            for shard in manifest['shards']]
+
+
+def get_data_sources(tf_record_path):
+    """Get the paths to the files of a TFRecord, which may be in shards.
+
+  Args:
+    tf_record_path: String, path to TFRecord file, without the shard suffix.
+
+  Returns:
+    List of strings, paths to the TFRecord file or its shards.
+  """
+    shards = read_manifest(tf_record_path)
+    if shards is None:
+        return [tf_record_path]
+    return [shard_path for shard_path, _ in shards]
+
+
 def get_num_records(tf_record_path):
     """Get the number of records in a TFRecord by reading it from the text file.
 
+  If the TFRecord was written in shards, the number of records is read from
+  its manifest instead.
+
   Args:
     tf_record_path: String, path to TFRecord file.
 
   Returns:
     Integer, number of records in TFRecord file, as read form the text file.
   """
+    shards = read_manifest(tf_record_path)
+    if shards is not None:
+        num_records = sum(shard_num_records for _, shard_num_records in shards)
+        logging.info('%d records in %d shards of %s.', num_records, len(shards),
+                     tf_record_path)
+        return num_records
+
     num_records_path = get_filename_num_records(tf_record_path)
     with open(num_records_path, 'r') as f:
         num_records = int(f.read())
@@ -88,20 +180,12 @@ def get_split(split_name, tfrecord_file_pattern, num_classes, image_width, image
         raise ValueError('Invalid image_height and/or image_width: %d, %d.' %
                          image_height, image_width)
     image_shape = (image_height, image_width, 1)
-    keys_to_features = {
-        FEATURE_IMAGE:
-            tensorflow.FixedLenFeature(
-                image_shape, tensorflow.float32, default_value=tensorflow.zeros(image_shape)),
-        FEATURE_IMAGE_CLASS:
-            tensorflow.FixedLenFeature(
-                [num_classes], tensorflow.float32, default_value=tensorflow.zeros([num_classes])),
-        FEATURE_IMAGE_PATH:
-            tensorflow.FixedLenFeature(
-                [1], tensorflow.string, default_value=''),
-    }
+    keys_to_features = _get_keys_to_features(image_shape, num_classes)
 
     items_to_handlers = {
-        FEATURE_IMAGE: tensorflow.contrib.slim.tfexample_decoder.Tensor(FEATURE_IMAGE),
+        FEATURE_IMAGE: tensorflow.contrib.slim.tfexample_decoder.ItemHandlerCallback(
+            [FEATURE_IMAGE, FEATURE_IMAGE_ENCODED, FEATURE_IMAGE_FORMAT],
+            lambda keys_to_tensors: _decode_image(keys_to_tensors, image_shape)),
         FEATURE_IMAGE_CLASS: tensorflow.contrib.slim.tfexample_decoder.Tensor(FEATURE_IMAGE_CLASS),
         FEATURE_IMAGE_PATH: tensorflow.contrib.slim.tfexample_decoder.Tensor(FEATURE_IMAGE_PATH),
     }
@@ -113,7 +197,7 @@ def get_split(split_name, tfrecord_file_pattern, num_classes, image_width, image
 
     num_samples = get_num_records(file_pattern)
     return tensorflow.contrib.slim.dataset.Dataset(
-        data_sources=file_pattern,
+        data_sources=get_data_sources(file_pattern),
         reader=tensorflow.TFRecordReader,
         decoder=decoder,
         num_samples=num_samples,
@@ -121,7 +205,67 @@ def get_split(split_name, tfrecord_file_pattern, num_classes, image_width, image
         items_to_descriptions=_ITEMS_TO_DESCRIPTIONS)
 
 
-def get_batches(image, label, image_path, num_threads=800, batch_size=32):
+def _get_keys_to_features(image_shape, num_classes):
+    """Gets the features of the TF Examples, for any image encoding.
+
+  Args:
+    image_shape: Tuple of integers, the image shape (height, width, 1).
+    num_classes: Integer representing number of classes.
+
+  Returns:
+    Dictionary mapping feature keys to FixedLenFeature.
+  """
+    return {
+        FEATURE_IMAGE:
+            tensorflow.FixedLenFeature(
+                image_shape, tensorflow.float32, default_value=tensorflow.zeros(image_shape)),
+        FEATURE_IMAGE_ENCODED:
+            tensorflow.FixedLenFeature(
+                [], tensorflow.string, default_value=''),
+        FEATURE_IMAGE_FORMAT:
+            tensorflow.FixedLenFeature(
+                [], tensorflow.string, default_value=ENCODING_FLOAT_LIST),
+        FEATURE_IMAGE_CLASS:
+            tensorflow.FixedLenFeature(
+                [num_classes], tensorflow.float32, default_value=tensorflow.zeros([num_classes])),
+        FEATURE_IMAGE_PATH:
+            tensorflow.FixedLenFeature(
+                [1], tensorflow.string, default_value=''),
+    }
+
+
+def _decode_image(keys_to_tensors, image_shape):
+    """Decodes the image of a parsed TF Example, for any image encoding.
+
+  Args:
+    keys_to_tensors: Dictionary mapping feature keys to parsed tensors.
+    image_shape: Tuple of integers, the image shape (height, width, 1).
+
+  Returns:
+    Float32 image tensor, of shape image_shape, with values in [0, 1].
+  """
+    encoded = keys_to_tensors[FEATURE_IMAGE_ENCODED]
+
+    def decode_raw(dtype, scale):
+        return lambda: tensorflow.reshape(
+            tensorflow.cast(tensorflow.decode_raw(encoded, dtype, little_endian=True),
+                            tensorflow.float32) * scale, image_shape)
+
+    def decode_png():
+        return tensorflow.reshape(
+            tensorflow.cast(tensorflow.image.decode_png(encoded, channels=1, dtype=tensorflow.uint16),
+                            tensorflow.float32) / 65535.0, image_shape)
+
+    image_format = keys_to_tensors[FEATURE_IMAGE_FORMAT]
+    return tensorflow.case(
+        [(tensorflow.equal(image_format, ENCODING_RAW_FLOAT32), decode_raw(tensorflow.float32, 1.0)),
+         (tensorflow.equal(image_format, ENCODING_RAW_UINT16), decode_raw(tensorflow.uint16, 1.0 / 65535)),
+         (tensorflow.equal(image_format, ENCODING_PNG), decode_png)],
+        default=lambda: keys_to_tensors[FEATURE_IMAGE],
+        exclusive=True)
+
+
+def get_batches(image, label, image_path, num_threads=None, batch_size=32):
     """Converts image and label into batches.
 
   Args:
@@ -129,6 +273,7 @@ def get_batches(image, label, image_path, num_threads=800, batch_size=32):
     label: Input label tensor, size [num_images x num_classes].
     image_path: Input image path tensor, size [num_images x 1].
     num_threads: Integer, number of threads for preprocessing and loading data.
+      If None, the number of CPUs.
     batch_size: Integer, batch size for the output.
 
   Returns:
@@ -137,6 +282,8 @@ def get_batches(image, label, image_path, num_threads=800, batch_size=32):
     [batch_size x 1]) tensors.
   """
     assert len(image.get_shape().as_list()) == 4
+    if num_threads is None:
+        num_threads = multiprocessing.cpu_count()
     batch_images, batch_one_hot_labels, batch_image_paths = tensorflow.train.batch(
         [image, label, image_path],
         batch_size=batch_size,
@@ -187,7 +334,79 @@ def apply_random_brightness_adjust(patch, min_factor, max_factor):
     return tensorflow.multiply(patch, brightness)
 
 
-def get_image_tiles_tensor(image, label, image_path, patch_width):
+def apply_blur_kernels(images, kernels):
+    """Blurs each image with its own kernel, after normalizing the kernels.
+
+  A symmetric boundary is used to handle the image borders, as in
+  degrade.ImageDegrader.apply_blur_kernel.
+
+  Args:
+    images: Input image tensor, size [num_images x height x width x 1].
+    kernels: Kernel tensor, size [num_images x kernel_height x kernel_width],
+      smaller than the images.
+
+  Returns:
+    Blurred image tensor, of the same size as images.
+  """
+    kernel_height, kernel_width = kernels.get_shape().as_list()[1:3]
+    kernels = kernels / tensorflow.reduce_sum(kernels, axis=[1, 2], keepdims=True)
+
+    padded_images = tensorflow.pad(
+        images, [[0, 0], [kernel_height // 2, (kernel_height - 1) // 2],
+                 [kernel_width // 2, (kernel_width - 1) // 2], [0, 0]], mode='SYMMETRIC')
+
+    # A depthwise convolution applies its own filter to each channel, so the
+    # images are moved to the channels. Filters are flipped for a convolution.
+    channels = tensorflow.transpose(padded_images, [3, 1, 2, 0])
+    filters = tensorflow.expand_dims(
+        tensorflow.transpose(tensorflow.reverse(kernels, [1, 2]), [1, 2, 0]), 3)
+    blurred_channels = tensorflow.nn.depthwise_conv2d(
+        channels, filters, [1, 1, 1, 1], 'VALID')
+    return tensorflow.transpose(blurred_channels, [3, 1, 2, 0])
+
+
+def apply_exposure(images, exposure_factors, photoelectron_factor, sensor_offset_in_photoelectrons):
+    """Adjusts the image exposure, as in degrade.ImageDegrader.set_exposure.
+
+  Args:
+    images: Input image tensor, with values in [0, 1].
+    exposure_factors: Tensor of non-negative factors to adjust exposure by,
+      broadcastable to the images.
+    photoelectron_factor: Float, factor to convert to photoelectrons.
+    sensor_offset_in_photoelectrons: Float, image sensor offset (black level),
+      in terms of photoelectrons.
+
+  Returns:
+    Image tensor of the same size as images, with values in [0, 1].
+  """
+    images_without_offset = tensorflow.maximum(
+        0.0, images * photoelectron_factor - sensor_offset_in_photoelectrons)
+    adjusted = ((images_without_offset * exposure_factors + sensor_offset_in_photoelectrons) /
+                photoelectron_factor)
+    return tensorflow.minimum(1.0, adjusted)
+
+
+def apply_poisson_noise(images, photoelectron_factor, sensor_offset_in_photoelectrons):
+    """Applies per-pixel Poisson noise, as in degrade.ImageDegrader.random_noise.
+
+  Args:
+    images: Input image tensor, with values in [0, 1].
+    photoelectron_factor: Float, factor to convert to photoelectrons.
+    sensor_offset_in_photoelectrons: Float, image sensor offset (black level),
+      in terms of photoelectrons.
+
+  Returns:
+    Image tensor of the same size as images, with values in [0, 1].
+  """
+    images_photoelectrons = tensorflow.maximum(
+        0.0, images * photoelectron_factor - sensor_offset_in_photoelectrons)
+    noisy_images_photoelectrons = tensorflow.random_poisson(images_photoelectrons, [])
+    noisy_images = ((noisy_images_photoelectrons + sensor_offset_in_photoelectrons) /
+                    photoelectron_factor)
+    return tensorflow.minimum(1.0, noisy_images)
+
+
+def get_image_tiles_tensor(image, label, image_path, patch_width, stride=None):
     """Gets patches that tile the input image, starting at upper left.
 
   Args:
@@ -195,14 +414,18 @@ def get_image_tiles_tensor(image, label, image_path, patch_width):
     label: Input label tensor, size [num_classes].
     image_path: Input image path tensor, size [1].
     patch_width: Integer representing width of image patch.
+    stride: Integer, the spacing between patches. If None, patch_width, and
+      the patches don't overlap.
 
   Returns:
     Tensors tiles, size [num_tiles x patch_width x patch_width x 1], labels,
     size [num_tiles x num_classes], and image_paths, size [num_tiles x 1].
   """
+    if stride is None:
+        stride = patch_width
     tiles_before_reshape = tensorflow.extract_image_patches(
         tensorflow.expand_dims(image, dim=0), [1, patch_width, patch_width, 1],
-        [1, patch_width, patch_width, 1], [1, 1, 1, 1], 'VALID')
+        [1, stride, stride, 1], [1, 1, 1, 1], 'VALID')
     tiles = tensorflow.reshape(tiles_before_reshape, [-1, patch_width, patch_width, 1])
 
     labels = tensorflow.tile(tensorflow.expand_dims(label, dim=0), [tensorflow.shape(tiles)[0], 1])
@@ -220,9 +443,18 @@ def provide_data(tfrecord_file_pattern,
                  image_height,
                  patch_width=28,
                  randomize=True,
-                 num_threads=64):
+                 num_threads=None,
+                 deterministic=None,
+                 defocus_psfs=None,
+                 defocus_exposure_factors=None,
+                 patch_stride=None):
     """Provides batches of data.
 
+  If defocus_psfs is set, the images are assumed to be in focus, and their
+  labels are ignored. Instead, each training patch is degraded on the fly to a
+  random class of defocus, by blurring with the point spread function of the
+  class, adjusting exposure and applying Poisson noise, as in degrade.py.
+
   Args:
     tfrecord_file_pattern: String, with formatting for split name. E.g.
       'file_%s.tfrecord'.
@@ -236,43 +468,100 @@ def provide_data(tfrecord_file_pattern,
     randomize: Boolean indicating whether to use image patches that are randomly
       cropped, with a random offset and brightness adjustment applied. Use only
       for training.
-    num_threads: Number of threads for data reading queue. Use only 1 thread for
-      deterministic ordering of inputs.
-
+    num_threads: Number of parallel TFRecord readers and preprocessing calls. If
+      None, the readers are limited to the number of CPUs and the preprocessing
+      parallelism is autotuned. The readers interleave the records of a
+      TFRecord written in shards.
+    deterministic: Boolean, whether the ordering of inputs is deterministic.
+      If None, the ordering is deterministic only for num_threads = 1.
+    defocus_psfs: If not None, numpy float array of size [num_classes x
+      psf_width x psf_width], the point spread function of each class, e.g.
+      from degrade.get_airy_psf_stack(). Requires randomize.
+    defocus_exposure_factors: If not None, list of the exposure factor of each
+      class. If None, exposure is not adjusted.
+    patch_stride: Integer, if not 'randomize', the spacing in pixels between
+      the tiles of each image. If None, patch_width, and the tiles don't
+      overlap.
 
   Returns:
     batch_images: A `Tensor` of size [batch_size, patch_width, patch_width, 1]
     batch_one_hot_labels: A `Tensor` of size [batch_size, num_classes], where
       each row has a single element set to one and the rest set to zeros.
+    batch_image_paths: A `Tensor` of size [batch_size, 1].
     num_samples: The number of images (not tiles) in the dataset.
 
   Raises:
-    ValueError: If the batch size is invalid.
+    ValueError: If the batch size is invalid, or defocus_psfs is set without
+      randomize or does not have num_classes psfs.
   """
     if batch_size <= 0:
         raise ValueError('Invalid batch size: %d' % batch_size)
+    if defocus_psfs is not None:
+        if not randomize:
+            raise ValueError('Defocus can only be synthesized for random patches.')
+        if len(defocus_psfs) != num_classes:
+            raise ValueError('%d defocus psfs specified, but must be %d.' %
+                             (len(defocus_psfs), num_classes))
     dataset_info = get_split(
         split_name,
         tfrecord_file_pattern,
         num_classes,
         image_width=image_width,
         image_height=image_height)
-    provider = tensorflow.contrib.slim.dataset_data_provider.DatasetDataProvider(
-        dataset_info,
-        common_queue_capacity=2 * batch_size,
-        common_queue_min=batch_size,
-        shuffle=False,
-        num_readers=num_threads)
-
-    # image, label, image_path have shape [width x width x 1], [num_classes], [1].
-    [image, label, image_path] = provider.get(
-        [FEATURE_IMAGE, FEATURE_IMAGE_CLASS, FEATURE_IMAGE_PATH])
-
-    logging.info('Data provider image shape: %s', str(image.get_shape().as_list()))
-    if randomize:
-        # For training, get a single randomly cropped image patch.
-        patch_original, label, image_path = get_image_patch_tensor(
-            image, label, image_path, patch_width=patch_width)
+
+    if deterministic is None:
+        deterministic = num_threads == 1
+    num_parallel_calls = (tensorflow.data.experimental.AUTOTUNE
+                          if num_threads is None else num_threads)
+    num_readers = min(len(dataset_info.data_sources),
+                      multiprocessing.cpu_count() if num_threads is None else num_threads)
+
+    image_shape = (image_height, image_width, 1)
+
+    def parse_example(serialized_example):
+        """Parses a TF Example into image, label and image_path tensors."""
+        # image, label, image_path have shape [width x width x 1], [num_classes], [1].
+        features = tensorflow.parse_single_example(
+            serialized_example, _get_keys_to_features(image_shape, num_classes))
+        image = _decode_image(features, image_shape)
+        return image, features[FEATURE_IMAGE_CLASS], features[FEATURE_IMAGE_PATH]
+
+    def get_random_defocused_patch(serialized_example):
+        """For training, gets a randomly cropped patch, degraded to a random class."""
+        keys_to_features = _get_keys_to_features(image_shape, num_classes)
+        del keys_to_features[FEATURE_IMAGE_CLASS]
+        features = tensorflow.parse_single_example(serialized_example, keys_to_features)
+        image = _decode_image(features, image_shape)
+
+        class_index = tensorflow.random_uniform([], 0, num_classes, dtype=tensorflow.int32)
+        label = tensorflow.one_hot(class_index, num_classes)
+
+        # Crop a margin for the blur, so the patch is blurred as in the full image.
+        psf_height, psf_width = defocus_psfs.shape[1:3]
+        patch = tensorflow.expand_dims(tensorflow.random_crop(
+            image, [patch_width + psf_height - 1, patch_width + psf_width - 1, 1]), 0)
+        patch = apply_blur_kernels(
+            patch, tensorflow.expand_dims(tensorflow.gather(defocus_psfs_tensor, class_index), 0))
+        patch = patch[:, psf_height // 2:psf_height // 2 + patch_width,
+                      psf_width // 2:psf_width // 2 + patch_width, :]
+
+        if defocus_exposure_factors is not None:
+            patch = apply_exposure(
+                patch, tensorflow.gather(defocus_exposure_factors_tensor, class_index),
+                _DEFOCUS_PHOTOELECTRON_FACTOR, _DEFOCUS_SENSOR_OFFSET_IN_PHOTOELECTRONS)
+
+        patch = apply_poisson_noise(
+            patch, _DEFOCUS_PHOTOELECTRON_FACTOR, _DEFOCUS_SENSOR_OFFSET_IN_PHOTOELECTRONS)
+        return patch, label, features[FEATURE_IMAGE_PATH]
+
+    def get_random_patch(serialized_example):
+        """For training, gets a single randomly cropped image patch."""
+        if defocus_psfs is None:
+            image, label, image_path = parse_example(serialized_example)
+            patch_original, _, _ = get_image_patch_tensor(
+                image, label, image_path, patch_width=patch_width)
+        else:
+            patch_original, label, image_path = get_random_defocused_patch(serialized_example)
 
         # Apply a random offset and brightness adjustment.
         patch_scaled = apply_random_brightness_adjust(
@@ -285,26 +574,45 @@ def provide_data(tfrecord_file_pattern,
             min_offset=_BRIGHTNESS_MIN_OFFSET,
             max_offset=_BRIGHTNESS_MAX_OFFSET)
 
-        batch_images, batch_one_hot_labels, batch_image_paths = get_batches(
-            patch,
-            label,
-            image_path,
-            batch_size=batch_size,
-            num_threads=num_threads)
+        return tensorflow.squeeze(patch, [0]), label, image_path
+
+    def get_tiles(serialized_example):
+        """For testing, gets tiles that tile the image, without overlap unless strided."""
+        image, label, image_path = parse_example(serialized_example)
+        return get_image_tiles_tensor(
+            image, label, image_path, patch_width=patch_width, stride=patch_stride)
+
+    if defocus_psfs is not None:
+        defocus_psfs_tensor = tensorflow.constant(defocus_psfs, dtype=tensorflow.float32)
+    if defocus_exposure_factors is not None:
+        defocus_exposure_factors_tensor = tensorflow.constant(
+            defocus_exposure_factors, dtype=tensorflow.float32)
+
+    dataset = tensorflow.data.Dataset.from_tensor_slices(dataset_info.data_sources)
+    dataset = dataset.apply(
+        tensorflow.data.experimental.parallel_interleave(
+            tensorflow.data.TFRecordDataset,
+            cycle_length=num_readers,
+            sloppy=not deterministic))
+    dataset = dataset.repeat()
+
+    if randomize:
+        dataset = dataset.map(get_random_patch, num_parallel_calls=num_parallel_calls)
+        dataset = dataset.batch(batch_size, drop_remainder=True)
     else:
-        # For testing extract tiles that perfectly tile (without overlap) the image.
-        tiles, labels, image_paths = get_image_tiles_tensor(
-            image, label, image_path, patch_width=patch_width)
+        # Each element is all the tiles of one image.
+        dataset = dataset.map(get_tiles, num_parallel_calls=num_parallel_calls)
 
-        num_tiles = tiles.get_shape().as_list()[0]
+        num_tiles = dataset.output_shapes[0].as_list()[0]
         assert num_tiles == batch_size, 'num_tiles: %d, batch_size: %d' % (
             num_tiles, batch_size)
 
-        batch_images, batch_one_hot_labels, batch_image_paths = get_batches(
-            tiles,
-            labels,
-            image_paths,
-            batch_size=num_tiles,
-            num_threads=num_threads)
-    num_samples = provider.num_samples()
+    dataset = dataset.prefetch(tensorflow.data.experimental.AUTOTUNE)
+
+    batch_images, batch_one_hot_labels, batch_image_paths = (
+        dataset.make_one_shot_iterator().get_next())
+
+    logging.info('Data provider batch shape: %s', str(batch_images.get_shape().as_list()))
+
+    num_samples = dataset_info.num_samples
     return batch_images, batch_one_hot_labels, batch_image_paths, num_samples
@@ -3,9 +3,15 @@
 
 import collections
 import glob
+import io
+import json
 import logging
+import multiprocessing
+import multiprocessing.pool
 import os
+import time
 
+import PIL.Image
 import numpy
 import skimage.io
 import tensorflow
@@ -22,6 +28,16 @@ _FOREGROUND_MEAN = 200.0 / 65535
 
 _SUPPORTED_EXTENSIONS = ['.tif', '.tiff', '.png']
 
+# Types of worker pools for reading and preprocessing images.
+POOL_THREAD = 'thread'
+POOL_PROCESS = 'process'
+
+# The dataset, normalization and encoding used by the worker pool of
+# convert_to_examples.
+_worker_dataset = None
+_worker_normalize = None
+_worker_encoding = None
+
 
 class Dataset(object):
     """Holds the image data before training examples are created.
@@ -131,7 +147,11 @@ def dataset_to_examples_in_tfrecord(list_of_image_globs,
                                     shard_num=None,
                                     num_shards=None,
                                     normalize=True,
-                                    use_unlabeled_data=False):
+                                    use_unlabeled_data=False,
+                                    num_workers=None,
+                                    pool_type=POOL_THREAD,
+                                    encoding=microscopeimagequality.data_provider.ENCODING_FLOAT_LIST,
+                                    num_output_shards=None):
     """Reads dataset and saves as TFExamples in a TFRecord.
 
   Args:
@@ -152,10 +172,60 @@ def dataset_to_examples_in_tfrecord(list_of_image_globs,
     num_shards: Integer, if sharding, total number of borg tasks.
     normalize: Boolean, whether to brightness normalize the image.
     use_unlabeled_data: Boolean, whether there does not exist true labels.
+    num_workers: Integer, if not None, the number of workers reading and
+      preprocessing images concurrently.
+    pool_type: String, POOL_THREAD or POOL_PROCESS, the type of worker pool.
+    encoding: String, the data_provider image encoding (e.g. ENCODING_PNG).
+    num_output_shards: Integer, if not None, the number of TFRecord files to
+      write, listed in a manifest.
 
   Returns:
     Number of converted example images.
 
+  Raises:
+    ValueError: If the input image directories are invalid.
+  """
+    dataset = read_dataset(list_of_image_globs, num_classes, image_width,
+                           image_height, max_images, image_background_value,
+                           image_brightness_scale, shard_num, num_shards,
+                           use_unlabeled_data)
+
+    # Convert to Examples and write the result to an TFRecord.
+    num_examples = convert_to_examples(dataset, output_directory,
+                                       output_tfrecord_filename, randomize,
+                                       normalize, num_workers, pool_type,
+                                       encoding, num_output_shards)
+    return num_examples
+
+
+def read_dataset(list_of_image_globs,
+                 num_classes,
+                 image_width,
+                 image_height,
+                 max_images=100000,
+                 image_background_value=0.0,
+                 image_brightness_scale=1.0,
+                 shard_num=None,
+                 num_shards=None,
+                 use_unlabeled_data=False):
+    """Reads the image paths (and labels) of a dataset, optionally sharded.
+
+  Args:
+    list_of_image_globs: List of strings, each a glob. If use_unlabeled_data is
+      False, the number of globs must equal num_classes.
+    num_classes: Integer, number of classes of defocus.
+    image_width: Integer, width of image size to be cropped.
+    image_height: Integer, height of image size to be cropped.
+    max_images: Integer, max number of images to read per class.
+    image_background_value: Float, background value of images in dataset.
+    image_brightness_scale: Float, multiplicative exposure factor.
+    shard_num: Integer, if sharding, borg task number.
+    num_shards: Integer, if sharding, total number of borg tasks.
+    use_unlabeled_data: Boolean, whether there does not exist true labels.
+
+  Returns:
+    Dataset object.
+
   Raises:
     ValueError: If the input image directories are invalid.
   """
@@ -180,34 +250,47 @@ def dataset_to_examples_in_tfrecord(list_of_image_globs,
     if shard_num is not None and num_shards is not None and num_shards > 1:
         dataset.subsample_for_shard(shard_num, num_shards)
 
-    # Convert to Examples and write the result to an TFRecord.
-    num_examples = convert_to_examples(dataset, output_directory,
-                                       output_tfrecord_filename, randomize,
-                                       normalize)
-    return num_examples
+    return dataset
 
 
 def convert_to_examples(dataset,
                         output_directory,
                         output_tfrecord_filename,
                         randomize=True,
-                        normalize=True):
+                        normalize=True,
+                        num_workers=None,
+                        pool_type=POOL_THREAD,
+                        encoding=microscopeimagequality.data_provider.ENCODING_FLOAT_LIST,
+                        num_output_shards=None):
     """Save images and labels into TF Example protos in TFRecord.
 
-  The number of examples is also saved as a .num_examples file.
+  The number of examples is also saved as a .num_examples file. If
+  num_output_shards is set, the examples are instead split into contiguous
+  shards named by data_provider.get_shard_filename(), and the number of
+  examples in each shard is saved in a .manifest.json file.
+
+  If num_workers is set, the images are read, preprocessed and serialized by a
+  pool of workers, while the examples are written in the dataset order by this
+  process.
 
   Args:
     dataset: Dataset object to convert to examples.
     output_directory: String, path to output directory.
     output_tfrecord_filename: String, name for output TFRecord.
     randomize: Boolean, whether to randomly permute the data ordering.
-      normalize: Boolean, whether to brightness normalize the image.
+    normalize: Boolean, whether to brightness normalize the image.
+    num_workers: Integer, if not None, the number of workers reading and
+      preprocessing images concurrently.
+    pool_type: String, POOL_THREAD or POOL_PROCESS, the type of worker pool.
+    encoding: String, the data_provider image encoding (e.g. ENCODING_PNG).
+    num_output_shards: Integer, if not None, the number of TFRecord files to
+      write, listed in a manifest.
 
   Returns:
     Number of converted example images.
 
   Raises:
-    ValueError: If dataset contains no examples.
+    ValueError: If dataset contains no examples, or pool_type is invalid.
   """
     if dataset.num_examples == 0:
         raise ValueError('No examples found')
@@ -219,26 +302,125 @@ def convert_to_examples(dataset,
         os.makedirs(output_directory)
     output_path = os.path.join(output_directory, output_tfrecord_filename)
 
-    # Write the actual TFRecord.
-    with tensorflow.python_io.TFRecordWriter(output_path) as writer:
-        for index in range(dataset.num_examples):
-            image, label, image_path = dataset.get_sample(index, normalize)
-            example = generate_tf_example(image, label, image_path)
-            writer.write(example.SerializeToString())
-            if index % 100 == 0:
-                logging.info('Saved to TFRecord %g of %g', index, dataset.num_examples)
-        logging.info('Wrote %s examples to a TFRecord, with image shape %gx%g.',
-                     dataset.num_examples, image.shape[0], image.shape[1])
-
-    # Write the number of examples as a separate file.
-    with open(
-            microscopeimagequality.data_provider.get_filename_num_records(
-                os.path.join(output_directory, output_tfrecord_filename)), 'w') as f:
-        f.write(str(dataset.num_examples))
+    if num_workers is None:
+        pool = None
+        serialized_examples = (_serialize_example(dataset, index, normalize, encoding)
+                               for index in range(dataset.num_examples))
+    elif pool_type in (POOL_THREAD, POOL_PROCESS):
+        pool_class = (multiprocessing.pool.ThreadPool if pool_type == POOL_THREAD
+                      else multiprocessing.Pool)
+        pool = pool_class(num_workers, initializer=_init_example_worker,
+                          initargs=(dataset, normalize, encoding))
+        # imap returns the examples in order, as soon as each is available.
+        serialized_examples = pool.imap(_get_serialized_example,
+                                        range(dataset.num_examples),
+                                        chunksize=4)
+    else:
+        raise ValueError('Invalid pool type: %s' % pool_type)
+
+    # The reader prefers a manifest to a .num_records file, so neither may be
+    # left from a previous conversion with the other layout.
+    _remove_previous_tfrecord(output_path)
+
+    if num_output_shards is None:
+        shard_paths = [output_path]
+        shard_sizes = [dataset.num_examples]
+    else:
+        shard_paths = [
+            microscopeimagequality.data_provider.get_shard_filename(output_path, shard_num, num_output_shards)
+            for shard_num in range(num_output_shards)]
+        shard_sizes = [len(indices) for indices in
+                       numpy.array_split(numpy.arange(dataset.num_examples), num_output_shards)]
+
+    # Write the actual TFRecord, one shard after the other.
+    start_time = time.time()
+    serialized_examples = iter(serialized_examples)
+    index = 0
+    try:
+        for shard_path, shard_size in zip(shard_paths, shard_sizes):
+            with tensorflow.python_io.TFRecordWriter(shard_path) as writer:
+                for _ in range(shard_size):
+                    serialized_example, image_shape = next(serialized_examples)
+                    writer.write(serialized_example)
+                    if index % 100 == 0:
+                        logging.info('Saved to TFRecord %g of %g', index, dataset.num_examples)
+                    index += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    elapsed_time = time.time() - start_time
+
+    logging.info('Wrote %s examples to a TFRecord, with image shape %gx%g.',
+                 dataset.num_examples, image_shape[0], image_shape[1])
+    logging.info('Converted %g images per second.',
+                 dataset.num_examples / max(elapsed_time, 1e-6))
+
+    if num_output_shards is None:
+        # Write the number of examples as a separate file.
+        with open(
+                microscopeimagequality.data_provider.get_filename_num_records(
+                    os.path.join(output_directory, output_tfrecord_filename)), 'w') as f:
+            f.write(str(dataset.num_examples))
+    else:
+        manifest = {
+            'num_records': dataset.num_examples,
+            'shards': [{'path': os.path.basename(shard_path), 'num_records': shard_size}
+                       for shard_path, shard_size in zip(shard_paths, shard_sizes)]
+        }
+        with open(microscopeimagequality.data_provider.get_filename_manifest(output_path), 'w') as f:
+            json.dump(manifest, f, indent=2)
 
     return dataset.num_examples
 
 
+def _remove_previous_tfrecord(output_path):
+    """Remove the metadata and shards of a TFRecord written previously.
+
+  Args:
+    output_path: String, path to TFRecord file, without the shard suffix.
+  """
+    shards = microscopeimagequality.data_provider.read_manifest(output_path)
+    metadata_paths = [
+        microscopeimagequality.data_provider.get_filename_num_records(output_path),
+        microscopeimagequality.data_provider.get_filename_manifest(output_path)]
+    shard_paths = [shard_path for shard_path, _ in shards or []]
+    for path in metadata_paths + shard_paths:
+        if os.path.isfile(path):
+            logging.info('Removing previous %s', path)
+            os.remove(path)
+
+
+def _init_example_worker(dataset, normalize, encoding):
+    """Sets the dataset to convert, in each worker of convert_to_examples."""
+    global _worker_dataset, _worker_normalize, _worker_encoding
+    _worker_dataset = dataset
+    _worker_normalize = normalize
+    _worker_encoding = encoding
+
+
+def _get_serialized_example(index):
+    """Serializes one example of the worker dataset, see _serialize_example()."""
+    return _serialize_example(_worker_dataset, index, _worker_normalize, _worker_encoding)
+
+
+def _serialize_example(dataset, index, normalize, encoding):
+    """Reads, preprocesses and serializes one example of a dataset.
+
+  Args:
+    dataset: Dataset object containing image paths and labels.
+    index: Integer, index within the dataset for the sample.
+    normalize: Boolean, whether to brightness normalize the image.
+    encoding: String, the data_provider image encoding (e.g. ENCODING_PNG).
+
+  Returns:
+    Tuple of the serialized TF Example, and the image shape.
+  """
+    image, label, image_path = dataset.get_sample(index, normalize)
+    example = generate_tf_example(image, label, image_path, encoding)
+    return example.SerializeToString(), image.shape
+
+
 def get_preprocessed_image(path,
                            image_background_value,
                            image_brightness_scale,
@@ -306,7 +488,8 @@ def normalize_image(image):
     return image
 
 
-def generate_tf_example(image, label, image_path):
+def generate_tf_example(image, label, image_path,
+                        encoding=microscopeimagequality.data_provider.ENCODING_FLOAT_LIST):
     """Generates a single TF example from an image and label.
 
   Args:
@@ -315,15 +498,25 @@ def generate_tf_example(image, label, image_path):
     label: Float32 numpy array of length [num_classes], a one-hot encoding of
       the class.
     image_path: String, the original path to the image.
+    encoding: String, the data_provider image encoding (e.g. ENCODING_PNG).
   Returns:
     TensorFlow Example.
+
+  Raises:
+    ValueError: If the encoding is invalid.
   """
     example = tensorflow.train.Example()
     features = example.features
 
-    image_expanded = numpy.expand_dims(image, axis=2)
-    features.feature[microscopeimagequality.data_provider.FEATURE_IMAGE].float_list.value.extend(
-        (image_expanded.flatten().tolist()))
+    if encoding == microscopeimagequality.data_provider.ENCODING_FLOAT_LIST:
+        image_expanded = numpy.expand_dims(image, axis=2)
+        features.feature[microscopeimagequality.data_provider.FEATURE_IMAGE].float_list.value.extend(
+            (image_expanded.flatten().tolist()))
+    else:
+        features.feature[microscopeimagequality.data_provider.FEATURE_IMAGE_ENCODED].bytes_list.value.append(
+            encode_image(image, encoding))
+        features.feature[microscopeimagequality.data_provider.FEATURE_IMAGE_FORMAT].bytes_list.value.append(
+            str.encode(encoding))
 
     features.feature[microscopeimagequality.data_provider.FEATURE_IMAGE_CLASS].float_list.value.extend(
         (label.flatten().tolist()))
@@ -335,6 +528,33 @@ def generate_tf_example(image, label, image_path):
     return example
 
 
+def encode_image(image, encoding):
+    """Encodes an image as bytes, for a TF Example.
+
+  Args:
+    image: Float32 numpy array of shape [height x width], with values in [0, 1].
+    encoding: String, the data_provider image encoding, other than
+      ENCODING_FLOAT_LIST.
+
+  Returns:
+    The encoded image bytes.
+
+  Raises:
+    ValueError: If the encoding is invalid.
+  """
+    if encoding == microscopeimagequality.data_provider.ENCODING_RAW_FLOAT32:
+        return image.astype('<f4').tobytes()
+
+    image_uint16 = numpy.round(image * 65535.0).astype('<u2')
+    if encoding == microscopeimagequality.data_provider.ENCODING_RAW_UINT16:
+        return image_uint16.tobytes()
+    elif encoding == microscopeimagequality.data_provider.ENCODING_PNG:
+        output = io.BytesIO()
+        PIL.Image.fromarray(image_uint16).save(output, format='PNG')
+        return output.getvalue()
+    raise ValueError('Invalid image encoding: %s' % encoding)
+
+
 def read_16_bit_greyscale(path):
     """Reads a 16-bit png or tif into a numpy array.
 
@@ -357,6 +577,31 @@ def read_16_bit_greyscale(path):
     return greyscale_map_normalized
 
 
+def read_image_shape(path):
+    """Reads the height and width of a png or tif, without decoding the pixels.
+
+  Only the image header is read, unless PIL can't open the image, in which case
+  the image is decoded with read_16_bit_greyscale().
+
+  Args:
+    path: String indicating path to .png or .tif file to read.
+  Returns:
+    A tuple of height, width, both integers.
+  """
+    try:
+        image = PIL.Image.open(path)
+    except IOError:
+        return read_16_bit_greyscale(path).shape[:2]
+
+    # Opening an image only reads its header. The file is closed on load(), which
+    # is never called, so close it here.
+    try:
+        width, height = image.size
+    finally:
+        image.close()
+    return height, width
+
+
 def get_image_paths(input_directory, max_images):
     """Gets PNG and TIF image paths within a given directory.
 
@@ -407,9 +652,9 @@ def image_size_from_glob(glob, patch_width):
     image_paths = get_images_from_glob(glob, max_images=1)
     if not image_paths:
         raise ValueError('No input images found in the first glob: %s.' % glob)
-    image = read_16_bit_greyscale(image_paths[0])
-    image_width = int(patch_width * numpy.floor(image.shape[1] / patch_width))
-    image_height = int(patch_width * numpy.floor(image.shape[0] / patch_width))
+    height, width = read_image_shape(image_paths[0])
+    image_width = int(patch_width * numpy.floor(width / patch_width))
+    image_height = int(patch_width * numpy.floor(height / patch_width))
 
     image_size = collections.namedtuple('image_size', ['height', 'width'])
     return image_size(image_height, image_width)
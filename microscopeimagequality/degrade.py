@@ -15,17 +15,113 @@ Example usage:
                    sensor_offset_in_photoelectrons=100)
 """
 
+import collections
+import hashlib
+import multiprocessing
 import os
+import tempfile
 
 import numpy
-import past.builtins
+import scipy.fftpack
 import scipy.integrate
 import scipy.signal
 import scipy.special
+import six
 import skimage.io
 
 import microscopeimagequality.dataset_creation
 
+# Gauss-Legendre quadrature order for the Airy integral: a minimum, plus one
+# node per radian of oscillation of the integrand.
+_AIRY_QUADRATURE_MIN_ORDER = 32
+_AIRY_QUADRATURE_NODES_PER_RADIAN = 1.0
+
+# Max number of radii to integrate at once, to bound memory use.
+_AIRY_RADII_PER_BATCH = 1024
+
+# Max number of psfs kept in memory by get_cached_airy_psf(), least recently used first.
+_PSF_CACHE_MAX_SIZE = 64
+_psf_cache = collections.OrderedDict()
+
+# The settings of _degrade_image_paths(), used by each worker of its pool.
+_DegradeSettings = collections.namedtuple('_DegradeSettings', ['output_paths', 'blur_kernels', 'exposure_factors', 'random_seed', 'photoelectron_factor', 'sensor_offset_in_photoelectrons', 'skip_apply_poisson_noise'])
+_worker_settings = None
+
+# Directory name of each class of images degraded by degrade_stack(), given the class index.
+DEGRADED_CLASS_DIRECTORY_FORMAT = '%d'
+
+# Kernels with at least this many pixels are applied by FFT, smaller ones by direct convolution.
+_FFT_BLUR_MIN_KERNEL_SIZE = 5 * 5
+
+
+class BlurKernel(object):
+    """
+    A normalized blur kernel, which can be applied to many images.
+
+    Small kernels are applied by direct convolution. Large kernels are applied by FFT, reusing the kernel transform
+    across images of the same shape.
+
+    Attributes:
+        psf: A 2D numpy float array, the kernel normalized to sum to 1.
+        use_fft: Boolean, whether the kernel is applied by FFT.
+        _is_non_negative: Boolean, whether all kernel weights are non-negative.
+        _kernel_ffts: Dictionary of kernel real FFTs, keyed by FFT shape.
+    """
+    def __init__(self, psf, use_fft=None):
+        """
+        Initialize with the kernel.
+
+        Args:
+            psf: A 2D numpy float array, the kernel to blur images with.
+            use_fft: Boolean, whether to apply the kernel by FFT. If None, chosen by kernel size.
+        """
+        self.psf = psf / numpy.sum(psf)
+
+        if use_fft is None:
+            use_fft = self.psf.size >= _FFT_BLUR_MIN_KERNEL_SIZE
+
+        self.use_fft = use_fft
+        self._is_non_negative = numpy.min(self.psf) >= 0
+        self._kernel_ffts = {}
+
+    def apply(self, image):
+        """
+        Blurs an image with the kernel.
+
+        A symmetric boundary is used to handle the image borders.
+
+        Args:
+            image: A 2D numpy float array in [0.0, 1.0], the image to blur.
+
+        Returns:
+            A 2D numpy float array of same shape as 'image', in [0.0, 1.0].
+        """
+        kernel_height, kernel_width = self.psf.shape
+
+        # Symmetric padding wider than the image reflects more than once, which differs from convolve2d.
+        if not self.use_fft or kernel_height > image.shape[0] or kernel_width > image.shape[1]:
+            return scipy.signal.convolve2d(image, self.psf, 'same', boundary='symm')
+
+        # Pad as convolve2d(..., 'same', boundary='symm') does, then keep the 'valid' part of the convolution. The
+        # circular convolution only wraps around into rows and columns before the valid part.
+        padding = ((kernel_height // 2, (kernel_height - 1) // 2), (kernel_width // 2, (kernel_width - 1) // 2))
+        padded_image = numpy.pad(image, padding, 'symmetric')
+
+        fft_shape = (scipy.fftpack.next_fast_len(padded_image.shape[0]), scipy.fftpack.next_fast_len(padded_image.shape[1]))
+
+        if fft_shape not in self._kernel_ffts:
+            self._kernel_ffts[fft_shape] = numpy.fft.rfft2(self.psf, fft_shape)
+
+        blurred_image = numpy.fft.irfft2(numpy.fft.rfft2(padded_image, fft_shape) * self._kernel_ffts[fft_shape], fft_shape)
+        blurred_image = blurred_image[kernel_height - 1:padded_image.shape[0], kernel_width - 1:padded_image.shape[1]]
+
+        if not self._is_non_negative:
+            return blurred_image
+
+        # With non-negative weights, each output pixel is a weighted mean of input pixels, so this only removes FFT
+        # round-off.
+        return numpy.clip(blurred_image, numpy.min(image), numpy.max(image))
+
 
 class ImageDegrader(object):
     """
@@ -80,14 +176,15 @@ class ImageDegrader(object):
 
         Args:
             image: A 2D numpy float array in [0.0, 1.0], the image to blur.
-            psf: A 2D numpy float array, the kernel to blur the image with.
+            psf: A 2D numpy float array, the kernel to blur the image with, or a BlurKernel to reuse across images.
 
         Returns:
             A 2D numpy float array of same shape as 'image', in [0.0, 1.0].
         """
-        psf_normalized = psf / numpy.sum(psf)
+        if not isinstance(psf, BlurKernel):
+            psf = BlurKernel(psf)
 
-        return scipy.signal.convolve2d(image, psf_normalized, 'same', boundary='symm')
+        return psf.apply(image)
 
     def set_exposure(self, image, exposure_factor):
         """
@@ -136,13 +233,14 @@ def get_airy_psf(psf_width_pixels, psf_width_meters, z, wavelength, numerical_ap
             'psf_width_pixels must be an odd number, but is %d.' % psf_width_pixels)
 
     meters_per_pixel = psf_width_meters / psf_width_pixels
-    psf = numpy.zeros((psf_width_pixels, psf_width_pixels), dtype=numpy.float64)
-    for i in past.builtins.xrange(psf_width_pixels):
-        for j in past.builtins.xrange(psf_width_pixels):
-            x = (i - (psf_width_pixels - 1.0) / 2.0) * meters_per_pixel
-            y = (j - (psf_width_pixels - 1.0) / 2.0) * meters_per_pixel
-            psf[i, j] = _evaluate_airy_function_at_point(
-                x, y, z, wavelength, numerical_aperture, refractive_index)
+    coordinates = (numpy.arange(psf_width_pixels) - (psf_width_pixels - 1.0) / 2.0) * meters_per_pixel
+    squared_radii = numpy.expand_dims(coordinates, 1) ** 2 + numpy.expand_dims(coordinates, 0) ** 2
+
+    # The psf is radially symmetric, so evaluate it once per distinct radius.
+    unique_squared_radii, pixel_indices = numpy.unique(squared_radii, return_inverse=True)
+    psf_values = _evaluate_airy_function_at_radii(
+        numpy.sqrt(unique_squared_radii), z, wavelength, numerical_aperture, refractive_index)
+    psf = psf_values[pixel_indices].reshape(squared_radii.shape)
 
     # Normalize PSF to max value.
     if normalize:
@@ -150,6 +248,148 @@ def get_airy_psf(psf_width_pixels, psf_width_meters, z, wavelength, numerical_ap
     return psf
 
 
+def get_cached_airy_psf(psf_width_pixels, psf_width_meters, z, wavelength, numerical_aperture, refractive_index, cache_directory=None):
+    """
+    Get the normalized Airy point spread function (psf) kernel, computing it only if it is not cached.
+
+    Psfs are cached in memory, evicting the least recently used, and optionally as .npy files in a cache directory,
+    which can be shared across processes and runs. Both are keyed by a hash of the optical parameters.
+
+    Args:
+        psf_width_pixels: Integer, the width of the psf, in pixels. Must be odd.
+        psf_width_meters: Float, the width of the psf, in meters.
+        z: Float, z-coordinate relative to the focal plane, in meters.
+        wavelength: Float, wavelength of light in meters.
+        numerical_aperture: Float, numerical aperture of the imaging lens.
+        refractive_index: Float, refractive index of the imaging medium.
+        cache_directory: String, path to the directory of cached .npy psfs. If None, psfs are cached in memory only.
+
+    Returns:
+        The psf kernel, a read-only numpy float 2D array, normalized to max value.
+    """
+    parameters = (int(psf_width_pixels), float(psf_width_meters), float(z), float(wavelength),
+                  float(numerical_aperture), float(refractive_index))
+    key = hashlib.sha1(repr(parameters).encode('utf-8')).hexdigest()
+
+    if key in _psf_cache:
+        # Mark as most recently used.
+        psf = _psf_cache.pop(key)
+        _psf_cache[key] = psf
+        return psf
+
+    cache_path = None if cache_directory is None else os.path.join(cache_directory, 'airy_psf_%s.npy' % key)
+
+    if cache_path is not None and os.path.isfile(cache_path):
+        psf = numpy.load(cache_path)
+    else:
+        psf = get_airy_psf(*parameters)
+
+        if cache_path is not None:
+            _save_array_atomically(psf, cache_path)
+
+    psf.flags.writeable = False
+
+    _psf_cache[key] = psf
+    while len(_psf_cache) > _PSF_CACHE_MAX_SIZE:
+        _psf_cache.popitem(last=False)
+
+    return psf
+
+
+def get_airy_psf_stack(z_depths_meters, wavelength=500e-9, numerical_aperture=0.5, refractive_index=1.0, psf_width_pixels=51, pixel_size_meters=0.65e-6, psf_cache_directory=None):
+    """
+    Get the Airy psf of each z-depth, e.g. for synthesizing defocus with data_provider.provide_data().
+
+    Args:
+        z_depths_meters: List of z-coordinates, in meters, distance relative to focal plane.
+        wavelength: Float, wavelength of light in meters.
+        numerical_aperture: Float, numerical aperture of the imaging lens.
+        refractive_index: Float, refractive index of the imaging medium.
+        psf_width_pixels: Integer, the width of the psf, in pixels. Must be odd.
+        pixel_size_meters: Float, width of each image pixel in meters. This is the magnified camera pixel size.
+        psf_cache_directory: String, path to a directory of cached psfs, shared across runs. If None, psfs are only
+          cached in memory.
+
+    Returns:
+        A numpy float 3D array of size [num_z_depths x psf_width_pixels x psf_width_pixels], each normalized to max value.
+    """
+    psf_width_meters = psf_width_pixels * pixel_size_meters
+
+    return numpy.stack([get_cached_airy_psf(psf_width_pixels, psf_width_meters, z_depth_meters, wavelength, numerical_aperture, refractive_index, psf_cache_directory) for z_depth_meters in z_depths_meters])
+
+
+def _save_array_atomically(array, path):
+    """
+    Saves a numpy array as a .npy file, so that concurrent readers never see a partial file.
+
+    Args:
+        array: Numpy array to save.
+        path: String, path of the .npy file.
+    """
+    directory = os.path.dirname(path)
+
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another process may have created it.
+            if not os.path.isdir(directory):
+                raise
+
+    file_descriptor, temporary_path = tempfile.mkstemp(suffix='.npy', dir=directory)
+    try:
+        with os.fdopen(file_descriptor, 'wb') as f:
+            numpy.save(f, array)
+        os.rename(temporary_path, path)
+    except OSError:
+        os.remove(temporary_path)
+        # Another process may have saved the same array.
+        if not os.path.isfile(path):
+            raise
+
+
+def _evaluate_airy_function_at_radii(radii, z, wavelength, numerical_aperture, refractive_index):
+    """
+    Evaluates the Airy point spread function at several radii, with Gauss-Legendre quadrature.
+
+    The quadrature order grows with the oscillation of the integrand, which gives the same values as
+    _evaluate_airy_function_at_point() to within floating point precision.
+
+    Args:
+        radii: 1D numpy float array, the distances from the optical axis, in meters.
+        z: Float, z coordinate, in meters.
+        wavelength: Float, wavelength of light in meters.
+        numerical_aperture: Float, numerical aperture of the imaging lens.
+        refractive_index: Float, refractive index of the imaging medium.
+
+    Returns:
+        1D numpy float array, the value of the Airy point spread function at each radius.
+    """
+    k = 2 * numpy.pi / wavelength
+    bessel_scale = k * numerical_aperture / refractive_index
+    phase_scale = 1.0 / 2.0 * k * z * numpy.power(numerical_aperture / refractive_index, 2)
+
+    # The integrand oscillates over at most this many radians on [0, 1].
+    max_radians = bessel_scale * numpy.max(radii) + abs(phase_scale)
+    order = _AIRY_QUADRATURE_MIN_ORDER + int(numpy.ceil(_AIRY_QUADRATURE_NODES_PER_RADIAN * max_radians))
+
+    # Map the nodes and weights from [-1, 1] to [0, 1].
+    nodes, weights = numpy.polynomial.legendre.leggauss(order)
+    rho = (nodes + 1.0) / 2.0
+    weights = weights / 2.0
+
+    phase = numpy.exp(-1j * phase_scale * numpy.power(rho, 2)) * rho
+
+    psf_values = numpy.zeros(len(radii), dtype=numpy.float64)
+    for start in range(0, len(radii), _AIRY_RADII_PER_BATCH):
+        batch_radii = radii[start:start + _AIRY_RADII_PER_BATCH]
+        integrand = scipy.special.j0(bessel_scale * numpy.outer(batch_radii, rho)) * phase
+        integral_result = integrand.dot(weights)
+        psf_values[start:start + _AIRY_RADII_PER_BATCH] = numpy.real(integral_result * numpy.conj(integral_result))
+
+    return psf_values
+
+
 def _evaluate_airy_function_at_point(x, y, z, wavelength, numerical_aperture, refractive_index):
     """
     Evaluates the Airy point spread function at a point.
@@ -204,7 +444,7 @@ def _integrate_numerical(function_to_integrate, start, end):
     return real_result + 1j * imag_result
 
 
-def degrade_images(images, output_path, z_depth_meters, exposure_factor, random_seed, photoelectron_factor, sensor_offset_in_photoelectrons, wavelength=500e-9, numerical_aperture=0.5, refractive_index=1.0, psf_width_pixels=51, pixel_size_meters=0.65e-6, skip_apply_poisson_noise=False):
+def degrade_images(images, output_path, z_depth_meters, exposure_factor, random_seed, photoelectron_factor, sensor_offset_in_photoelectrons, wavelength=500e-9, numerical_aperture=0.5, refractive_index=1.0, psf_width_pixels=51, pixel_size_meters=0.65e-6, skip_apply_poisson_noise=False, psf_cache_directory=None, num_workers=None):
     """
     Create a PSF and degrade all specified images.
 
@@ -222,36 +462,223 @@ def degrade_images(images, output_path, z_depth_meters, exposure_factor, random_
         psf_width_pixels: Integer, the width of the psf, in pixels. Must be odd.
         pixel_size_meters: Float, width of each image pixel in meters. This is the magnified camera pixel size.
         skip_apply_poisson_noise: Boolean, skip application of Poisson noise.
+        psf_cache_directory: String, path to a directory of cached psfs, shared across runs. If None, psfs are only
+          cached in memory.
+        num_workers: Integer, number of worker processes. If None, images are degraded serially with a single random
+          generator, so noise depends on image order. Otherwise, each image is seeded from random_seed and its
+          filename, so results are identical for any number of workers.
 
     Raises:
         ValueError: If no images are found by the specified glob.
     """
-    psf_width_meters = psf_width_pixels * pixel_size_meters
+    image_paths = _get_image_paths(images)
+
+    _degrade_image_paths(image_paths, [output_path], [z_depth_meters], [exposure_factor], random_seed, photoelectron_factor, sensor_offset_in_photoelectrons, wavelength, numerical_aperture, refractive_index, psf_width_pixels, pixel_size_meters, skip_apply_poisson_noise, psf_cache_directory, num_workers)
+
+
+def degrade_stack(images, output_path, z_depths_meters, exposure_factors, random_seed, photoelectron_factor, sensor_offset_in_photoelectrons, wavelength=500e-9, numerical_aperture=0.5, refractive_index=1.0, psf_width_pixels=51, pixel_size_meters=0.65e-6, skip_apply_poisson_noise=False, psf_cache_directory=None, num_workers=None):
+    """
+    Degrade all specified images to each of a list of z-depths and exposures, reading each image once.
+
+    The degraded images for the i-th z-depth are saved in the output_path/i/ directory, so the list of class globs
+    for read_labeled_dataset() is returned. Each class is identical to the output of degrade_images() with the same
+    arguments.
+
+    Args:
+        images: String or list of strings, globs for input images, either .png, .tif or .tiff.
+        output_path: String, path to save the class directories of degraded images.
+        z_depths_meters: List of z-coordinates, in meters, distance relative to focal plane, one per class.
+        exposure_factors: List of non-negative floats, the factors to adjust exposure by, one per class. A single
+          factor is used for all classes.
+        random_seed: Integer, the random seed.
+        photoelectron_factor: Float, factor to convert to photoelectrons.
+        sensor_offset_in_photoelectrons: Float, image sensor offset (black level), in terms of photoelectrons.
+        wavelength: Float, wavelength of light in meters.
+        numerical_aperture: Float, numerical aperture of the imaging lens.
+        refractive_index: Float, refractive index of the imaging medium.
+        psf_width_pixels: Integer, the width of the psf, in pixels. Must be odd.
+        pixel_size_meters: Float, width of each image pixel in meters. This is the magnified camera pixel size.
+        skip_apply_poisson_noise: Boolean, skip application of Poisson noise.
+        psf_cache_directory: String, path to a directory of cached psfs, shared across runs. If None, psfs are only
+          cached in memory.
+        num_workers: Integer, number of worker processes. If None, images are degraded serially with a single random
+          generator, so noise depends on image order. Otherwise, each image is seeded from random_seed and its
+          filename, so results are identical for any number of workers.
+
+    Returns:
+        List of strings, the glob of degraded images for each class.
+
+    Raises:
+        ValueError: If no images are found by the specified globs, or the z-depths and exposure factors don't match.
+    """
+    z_depths_meters = list(z_depths_meters)
+    exposure_factors = list(exposure_factors)
+
+    if len(exposure_factors) == 1:
+        exposure_factors *= len(z_depths_meters)
+
+    if not z_depths_meters or len(exposure_factors) != len(z_depths_meters):
+        raise ValueError('Expected one exposure factor per z-depth, got %d z-depths and %d exposure factors.' % (len(z_depths_meters), len(exposure_factors)))
 
-    psf = get_airy_psf(psf_width_pixels, psf_width_meters, z_depth_meters, wavelength, numerical_aperture, refractive_index)
+    image_paths = _get_image_paths(images)
 
-    degrader = ImageDegrader(random_seed, photoelectron_factor, sensor_offset_in_photoelectrons)
+    class_output_paths = [os.path.join(output_path, DEGRADED_CLASS_DIRECTORY_FORMAT % i) for i in range(len(z_depths_meters))]
 
-    image_paths = microscopeimagequality.dataset_creation.get_images_from_glob(images, max_images=1e7)
+    _degrade_image_paths(image_paths, class_output_paths, z_depths_meters, exposure_factors, random_seed, photoelectron_factor, sensor_offset_in_photoelectrons, wavelength, numerical_aperture, refractive_index, psf_width_pixels, pixel_size_meters, skip_apply_poisson_noise, psf_cache_directory, num_workers)
+
+    return [os.path.join(class_output_path, '*.png') for class_output_path in class_output_paths]
+
+
+def _get_image_paths(images):
+    """
+    Get the paths of the input images.
+
+    Args:
+        images: String or list of strings, globs for input images.
+
+    Returns:
+        List of image paths.
+
+    Raises:
+        ValueError: If no images are found by the specified globs.
+    """
+    if isinstance(images, six.string_types):
+        images = [images]
+
+    image_paths = []
+
+    for image_glob in images:
+        image_paths += microscopeimagequality.dataset_creation.get_images_from_glob(image_glob, max_images=1e7)
 
     if not image_paths:
-        raise ValueError('No images found with glob %s.' % images)
+        raise ValueError('No images found with glob %s.' % ', '.join(images))
+
+    return image_paths
+
+
+def _degrade_image_paths(image_paths, output_paths, z_depths_meters, exposure_factors, random_seed, photoelectron_factor, sensor_offset_in_photoelectrons, wavelength, numerical_aperture, refractive_index, psf_width_pixels, pixel_size_meters, skip_apply_poisson_noise, psf_cache_directory, num_workers):
+    """
+    Degrade images to each of a list of z-depths and exposures, reading each image once.
+
+    Each output path gets its own image degrader, so its noise is independent of the other output paths.
+
+    Args:
+        image_paths: List of strings, paths of the input images.
+        output_paths: List of strings, paths to save degraded images, one per z-depth.
+        z_depths_meters: List of z-coordinates, in meters, one per output path.
+        exposure_factors: List of non-negative floats, the factors to adjust exposure by, one per output path.
+        See degrade_images() for the remaining arguments.
+    """
+    psf_width_meters = psf_width_pixels * pixel_size_meters
+
+    blur_kernels = [BlurKernel(get_cached_airy_psf(psf_width_pixels, psf_width_meters, z_depth_meters, wavelength, numerical_aperture, refractive_index, psf_cache_directory)) for z_depth_meters in z_depths_meters]
+
+    settings = _DegradeSettings(output_paths, blur_kernels, exposure_factors, random_seed, photoelectron_factor, sensor_offset_in_photoelectrons, skip_apply_poisson_noise)
 
-    for path in image_paths:
-        image = microscopeimagequality.dataset_creation.read_16_bit_greyscale(path)
-        blurred_image = degrader.apply_blur_kernel(image, psf)
+    for output_path in output_paths:
+        if not os.path.isdir(output_path):
+            os.makedirs(output_path)
+
+    if num_workers is None:
+        degraders = [ImageDegrader(_get_output_seed(random_seed, output_index), photoelectron_factor, sensor_offset_in_photoelectrons) for output_index in range(len(output_paths))]
+
+        for path in image_paths:
+            _degrade_image(path, settings, degraders)
+    elif num_workers == 1:
+        _init_degrade_worker(settings)
+
+        for path in image_paths:
+            _degrade_image_with_own_seed(path)
+    else:
+        pool = multiprocessing.Pool(num_workers, initializer=_init_degrade_worker, initargs=(settings,))
+
+        try:
+            for _ in pool.imap_unordered(_degrade_image_with_own_seed, image_paths):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+
+
+def _init_degrade_worker(settings):
+    """Sets the settings of _degrade_image_paths(), in each worker of its pool."""
+    global _worker_settings
+    _worker_settings = settings
+
+
+def _degrade_image_with_own_seed(path):
+    """
+    Degrade an image with degraders seeded from the random seed, the image filename and the output path index.
+
+    Args:
+        path: String, path of the input image.
+    """
+    seed = _get_image_seed(_worker_settings.random_seed, path)
+
+    degraders = [ImageDegrader(_get_output_seed(seed, output_index), _worker_settings.photoelectron_factor, _worker_settings.sensor_offset_in_photoelectrons) for output_index in range(len(_worker_settings.output_paths))]
+
+    _degrade_image(path, _worker_settings, degraders)
+
+
+def _get_image_seed(random_seed, path):
+    """
+    Get the random seed of an image, from the random seed of the run and the image filename.
+
+    The filename, rather than the full path, is used so that results don't depend on where the images are stored.
+
+    Args:
+        random_seed: Integer, the random seed.
+        path: String, path of the input image.
+
+    Returns:
+        Integer in [0, 2**32), the random seed of the image.
+    """
+    key = '%d:%s' % (random_seed, os.path.basename(path))
+
+    return int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:8], 16)
+
+
+def _get_output_seed(random_seed, output_index):
+    """
+    Get the random seed of an output path, from the random seed and the index of the output path.
+
+    The first output path keeps the random seed, so that degrading to a single output path is unchanged.
+
+    Args:
+        random_seed: Integer, the random seed.
+        output_index: Integer, index of the output path.
+
+    Returns:
+        Integer in [0, 2**32), the random seed of the output path.
+    """
+    if output_index == 0:
+        return random_seed
+
+    key = '%d:%d' % (random_seed, output_index)
+
+    return int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:8], 16)
+
+
+def _degrade_image(path, settings, degraders):
+    """
+    Degrade an image to each z-depth and exposure and save the results.
+
+    Args:
+        path: String, path of the input image.
+        settings: _DegradeSettings, the settings of _degrade_image_paths().
+        degraders: List of ImageDegrader, one per output path.
+    """
+    image = microscopeimagequality.dataset_creation.read_16_bit_greyscale(path)
+
+    output_basename = '%s.png' % os.path.splitext(os.path.basename(path))[0]
+
+    for output_path, blur_kernel, degrader, exposure_factor in zip(settings.output_paths, settings.blur_kernels, degraders, settings.exposure_factors):
+        blurred_image = degrader.apply_blur_kernel(image, blur_kernel)
         exposure_adjusted_image = degrader.set_exposure(blurred_image, exposure_factor)
 
-        if skip_apply_poisson_noise:
+        if settings.skip_apply_poisson_noise:
             noisy_image = exposure_adjusted_image
         else:
             noisy_image = degrader.random_noise(exposure_adjusted_image)
 
-        output_filename = os.path.join(output_path, '%s.png' % os.path.splitext(os.path.basename(path))[0])
-
-        output_dir = os.path.dirname(output_filename)
-
-        if not os.path.isdir(output_dir):
-            os.makedirs(output_dir)
-
-        skimage.io.imsave(output_filename, noisy_image)
+        skimage.io.imsave(os.path.join(output_path, output_basename), noisy_image)
@@ -22,14 +22,17 @@ Usage:
 import collections
 import csv
 import logging
+import multiprocessing
 import os
+import shutil
 
 import PIL.Image
 import PIL.ImageDraw
 import matplotlib.pyplot
 import numpy
 import scipy.misc
-import scipy.stats
+import scipy.special
+import six
 import skimage.io
 import tensorflow
 import tensorflow.contrib.slim
@@ -44,6 +47,23 @@ BORDER_SIZE = 8
 
 CLASS_ANNOTATION_COLORMAP = 'hsv'
 
+# Columns of inference results, in the order returned by load_inference_results().
+RESULT_PROBABILITIES = 'probabilities'
+RESULT_LABELS = 'labels'
+RESULT_CERTAINTIES = 'certainties'
+RESULT_ORIG_NAMES = 'orig_names'
+RESULT_PREDICTIONS = 'predictions'
+RESULT_COLUMNS = [RESULT_PROBABILITIES, RESULT_LABELS, RESULT_CERTAINTIES, RESULT_ORIG_NAMES, RESULT_PREDICTIONS]
+
+# Optional column of the (height, width) of the upper-left region of each image
+# on which inference was run, -1 if unknown (e.g. for older results).
+RESULT_VALID_SIZES = 'valid_sizes'
+_VALID_SIZE_HEADERS = ['valid height', 'valid width']
+
+# Extension of the binary store of a results .csv file, a directory of one .npy
+# file per column.
+RESULTS_STORE_EXTENSION = '.columns'
+
 METHOD_AVERAGE = 'average'
 METHOD_PRODUCT = 'product'
 
@@ -219,6 +239,20 @@ def _get_class_rgb(num_classes, predicted_class):
     return matplotlib.pyplot.cm.get_cmap(CLASS_ANNOTATION_COLORMAP)(colormap_index)[0:3]
 
 
+def _get_class_rgb_table(num_classes):
+    """Map from each class to RGB value for a specific colormap.
+
+  Args:
+    num_classes: Integer, the total number of classes.
+
+  Returns:
+    Numpy float array of shape (num_classes, 3), where row i is the RGB color
+    of class i, as returned by _get_class_rgb().
+  """
+    colormap_indices = (numpy.arange(num_classes) * 255.0 / num_classes).astype(int)
+    return matplotlib.pyplot.cm.get_cmap(CLASS_ANNOTATION_COLORMAP)(colormap_indices)[:, 0:3]
+
+
 def get_certainty(probabilities):
     """Get a measure of certainty in [0.0, 1.0] given the class probabilities.
 
@@ -230,20 +264,7 @@ def get_certainty(probabilities):
     A float in the range [0.0, 1.0] representing the certainty of the
     distribution.
   """
-    sum_prob = numpy.sum(probabilities)
-    num_classes = probabilities.shape[0]
-    if sum_prob > 0:
-        normalized_probabilities = probabilities / sum_prob
-
-        certainty_proxy = 1.0 - scipy.stats.entropy(
-            normalized_probabilities) / numpy.log(num_classes)
-
-    else:
-        certainty_proxy = 0.0
-    assert certainty_proxy - 1 < 1e-6, 'certainty: ' ' %g' % certainty_proxy
-    assert certainty_proxy > -1e-6, 'certainty:' ' %g' % certainty_proxy
-    certainty_proxy = numpy.clip(certainty_proxy, 0.0, 1.0)
-    return certainty_proxy
+    return certainties_from_probabilities(numpy.expand_dims(probabilities, 0))[0]
 
 
 def get_rgb_image(max_value,
@@ -273,29 +294,23 @@ def get_rgb_image(max_value,
   """
     assert patches.shape[3] == 1
     num_classes = probabilities.shape[1]
+    border_size = 2
 
-    patches_rgb = numpy.zeros(
-        (patches.shape[0], patches.shape[1], patches.shape[2], 3))
-
-    for i in range(patches.shape[0]):
-        patch = patches[i, :, :, :]
-
-        prediction = numpy.argmax(probabilities[i, :])
-
-        certainty_proxy = get_certainty(probabilities[i, :])
+    predictions = numpy.argmax(probabilities, 1)
+    certainties = certainties_from_probabilities(probabilities)
 
-        # The brightness of the annotation should map from no certainty (random
-        # probability) to 100% certainty, to the range [0 - 1.0].
-        class_rgb = _get_class_rgb(num_classes, prediction)
+    # The brightness of the annotation should map from no certainty (random
+    # probability) to 100% certainty, to the range [0 - 1.0].
+    class_rgb_with_certainty = (numpy.expand_dims(max_value * certainties, 1) *
+                                _get_class_rgb_table(num_classes)[predictions])
 
-        class_rgb_with_certainty = [
-            numpy.float(max_value * certainty_proxy * c) for c in class_rgb
-            ]
-        patches_rgb[i, :, :, :] = numpy.concatenate(
-            (_set_border_pixels(patch, class_rgb_with_certainty[0]),
-             _set_border_pixels(patch, class_rgb_with_certainty[1]),
-             _set_border_pixels(patch, class_rgb_with_certainty[2])),
-            axis=2)
+    # Fill each patch with its annotation color, then copy the patch interior
+    # back, leaving a colored border.
+    patches_rgb = numpy.zeros(
+        (patches.shape[0], patches.shape[1], patches.shape[2], 3))
+    patches_rgb[:] = class_rgb_with_certainty.astype(patches.dtype)[:, numpy.newaxis, numpy.newaxis, :]
+    patches_rgb[:, border_size:-border_size, border_size:-border_size, :] = (
+        patches[:, border_size:-border_size, border_size:-border_size, :])
 
     image_rgb = _patches_to_image(patches_rgb, image_shape)
     predicted_color = _get_class_rgb(
@@ -323,15 +338,33 @@ def certainties_from_probabilities(probabilities):
 
   Args:
     probabilities: Numpy array of marginal probabilities, shape
-     (batch_size, num_classes).
+     (batch_size, num_classes), or more generally (..., num_classes), e.g.
+     (num_images, num_patches, num_classes).
 
   Returns:
-    Numpy array of certainties, of shape (batch_size).
+    Numpy float64 array of certainties, of shape (batch_size), or
+    probabilities.shape[:-1].
   """
-    certainties = numpy.zeros(probabilities.shape[0])
-    for i in range(probabilities.shape[0]):
-        certainties[i] = get_certainty(probabilities[i, :])
-    return certainties
+    probabilities = numpy.asarray(probabilities)
+    num_classes = probabilities.shape[-1]
+
+    sum_prob = numpy.sum(probabilities, -1, keepdims=True)
+    is_valid = sum_prob > 0
+    normalized_probabilities = probabilities / numpy.where(is_valid, sum_prob, 1)
+
+    # Normalize once more and sum the entropy terms, as scipy.stats.entropy()
+    # does, which gives results identical to calling it on each row.
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        normalized_probabilities = 1.0 * normalized_probabilities / numpy.sum(
+            normalized_probabilities, -1, keepdims=True)
+    entropy = numpy.sum(scipy.special.entr(normalized_probabilities), -1)
+
+    certainties = 1.0 - entropy.astype(numpy.float64) / numpy.log(num_classes)
+    certainties = numpy.where(is_valid[..., 0], certainties, 0.0)
+
+    assert numpy.all(certainties - 1 < 1e-6), 'certainty: %g' % numpy.max(certainties)
+    assert numpy.all(certainties > -1e-6), 'certainty: %g' % numpy.min(certainties)
+    return numpy.clip(certainties, 0.0, 1.0)
 
 
 def aggregate_prediction_from_probabilities(probabilities,
@@ -411,20 +444,25 @@ def _patches_to_image(patches, image_shape):
     """Reshapes a numpy array of patches to a single image.
 
   Args:
-    patches: Numpy array of shape (num_patches, patch_width, patch_width, 1).
+    patches: Numpy array of shape (num_patches, patch_width, patch_width,
+      num_channels), or of shape (num_images, num_patches, patch_width,
+      patch_width, num_channels) for a stack of images, with the patches of
+      each image in row-major order.
     image_shape: Tuple of integers, the height and width of assembled image.
 
   Returns:
-    The whole assembled image, shape (image_shape[0], image_shape[1], 1).
+    The whole assembled image, shape (image_shape[0], image_shape[1],
+    num_channels), or the stack of images, shape (num_images, image_shape[0],
+    image_shape[1], num_channels).
 
   Raises:
      ValueError: If the input array dimensions are incorrect.
   """
-    if len(patches.shape) != 4:
-        raise ValueError('Input array has shape %s but must be 4D.' %
+    if len(patches.shape) not in (4, 5):
+        raise ValueError('Input array has shape %s but must be 4D or 5D.' %
                          str(patches.shape))
-    num_patches = patches.shape[0]
-    patch_width = patches.shape[1]
+    images_patches = patches if len(patches.shape) == 5 else numpy.expand_dims(patches, 0)
+    num_images, num_patches, patch_width, _, num_channels = images_patches.shape
     num_rows = image_shape[0] // patch_width
     num_cols = image_shape[1] // patch_width
 
@@ -432,15 +470,14 @@ def _patches_to_image(patches, image_shape):
         raise ValueError('image_shape %s not valid for %d %dx%d patches.' %
                          (str(image_shape), num_patches, patch_width, patch_width))
 
-    image = numpy.zeros([num_rows * patch_width, num_cols * patch_width, patches.shape[3]], dtype=patches.dtype)
-
-    index = 0
-    for i in range(0, num_rows * patch_width, patch_width):
-        for j in range(0, num_cols * patch_width, patch_width):
-            image[i:i + patch_width, j:j + patch_width, :] = patches[index, :, :, :]
-            index += 1
+    # Interleave the patch rows with the pixel rows, and the patch columns with
+    # the pixel columns.
+    images = images_patches.reshape(
+        (num_images, num_rows, num_cols, patch_width, patch_width, num_channels)).transpose(
+        (0, 1, 3, 2, 4, 5)).reshape(
+        (num_images, num_rows * patch_width, num_cols * patch_width, num_channels))
 
-    return image
+    return images if len(patches.shape) == 5 else images[0]
 
 
 def _set_border_pixels(patch, value, border_size=2):
@@ -613,7 +650,7 @@ def get_model_and_metrics(images,
 
 def save_inference_results(aggregate_probabilities, aggregate_labels,
                            certainties, orig_names, aggregate_predictions,
-                           output_file):
+                           output_file, valid_sizes=None):
     """Save inference results to a .csv file.
 
   This function must remain synced with load_inference_results().
@@ -629,7 +666,14 @@ def save_inference_results(aggregate_probabilities, aggregate_labels,
     aggregate_predictions: List of integers, the predicted classes, length
       num_samples.
     output_file: String, path to csv file to write results to.
+    valid_sizes: Integer array of shape [num_samples x 2], the (height, width)
+      of the valid region of each image. If None, it is not saved.
   """
+    valid_size_headers = []
+    valid_size_columns = []
+    if valid_sizes is not None:
+        valid_size_headers = _VALID_SIZE_HEADERS
+        valid_size_columns = numpy.transpose(numpy.asarray(valid_sizes, dtype=numpy.int64).reshape([-1, 2])).tolist()
 
     with open(output_file, 'w') as csvfile:
         writer = csv.writer(csvfile)
@@ -642,76 +686,350 @@ def save_inference_results(aggregate_probabilities, aggregate_labels,
                             'aggregate certainty', 'weighted certainty', 'label'
                         ] + [
                             'probabilities_%g' % i for i in range(aggregate_probabilities.shape[1])
-                            ])
+                            ] + valid_size_headers)
 
         writer.writerows(
             zip(orig_names, aggregate_predictions, certainties['mean'], certainties[
                 'max'], certainties['aggregate'], certainties['weighted'],
-                aggregate_labels, *numpy.transpose(aggregate_probabilities).tolist()))
+                aggregate_labels, *(numpy.transpose(aggregate_probabilities).tolist() + valid_size_columns)))
 
     logging.info('Wrote %g results to %s', len(orig_names), output_file)
 
 
-def load_inference_results(directory_csvs):
+def get_results_store_path(results_path):
+    """Get path to the binary store of a results .csv file.
+
+  Args:
+    results_path: String, path to the results .csv file.
+
+  Returns:
+    String, path to the directory of .npy files with the same results.
+  """
+    return os.path.splitext(results_path)[0] + RESULTS_STORE_EXTENSION
+
+
+def save_inference_store(aggregate_probabilities, aggregate_labels,
+                         certainties, orig_names, aggregate_predictions,
+                         output_directory, valid_sizes=None):
+    """Save inference results as a directory of .npy files, one per column.
+
+  Unlike the .csv file, the columns can be memory-mapped when loaded. This
+  function must remain synced with _load_inference_store().
+
+  The columns are written to a temporary directory, which then replaces any
+  previous store. The modification time of the store is thus that of its
+  columns, as compared with the .csv file by _get_results_store_if_current().
+
+  Args:
+    aggregate_probabilities: Numpy float array of shape [num_samples x
+      num_classes].
+    aggregate_labels: List of integers, the actual classes, length
+      num_samples.
+    certainties: Dict of lists of floats, the certainties, each length
+      num_samples.
+    orig_names: List of strings, the original names, length num_samples.
+    aggregate_predictions: List of integers, the predicted classes, length
+      num_samples.
+    output_directory: String, path to the directory to write results to.
+    valid_sizes: Integer array of shape [num_samples x 2], the (height, width)
+      of the valid region of each image. If None, it is not saved.
+  """
+    arrays = {
+        RESULT_PROBABILITIES: numpy.asarray(aggregate_probabilities, dtype=numpy.float32),
+        RESULT_LABELS: numpy.asarray(aggregate_labels, dtype=numpy.int64),
+        # Names are converted as by the csv module, e.g. for bytes image paths.
+        RESULT_ORIG_NAMES: numpy.asarray([name if isinstance(name, six.string_types) else str(name)
+                                          for name in orig_names], dtype=str),
+        RESULT_PREDICTIONS: numpy.asarray(aggregate_predictions, dtype=numpy.int64),
+    }
+    for certainty in CERTAINTY_NAMES:
+        arrays['%s_%s' % (RESULT_CERTAINTIES, certainty)] = numpy.asarray(
+            certainties[certainty], dtype=numpy.float64)
+    if valid_sizes is not None:
+        arrays[RESULT_VALID_SIZES] = numpy.asarray(valid_sizes, dtype=numpy.int64).reshape([-1, 2])
+
+    temporary_directory = '%s.%d.tmp' % (output_directory, os.getpid())
+    if os.path.isdir(temporary_directory):
+        shutil.rmtree(temporary_directory)
+    os.makedirs(temporary_directory)
+
+    for name, array in arrays.items():
+        numpy.save(os.path.join(temporary_directory, name + '.npy'), array)
+
+    if os.path.isdir(output_directory):
+        shutil.rmtree(output_directory)
+    os.rename(temporary_directory, output_directory)
+
+    logging.info('Wrote %g results to %s', len(orig_names), output_directory)
+
+
+def convert_inference_results_to_stores(directory_csvs):
+    """Save the binary store of each results .csv file in a directory.
+
+  Stores that are at least as recent as their .csv file are kept.
+
+  Args:
+    directory_csvs: String, directory of csv files to convert.
+  """
+    for filename in sorted(os.listdir(directory_csvs)):
+        if os.path.splitext(filename)[1] != '.csv':
+            continue
+        path = os.path.join(directory_csvs, filename)
+        if _get_results_store_if_current(path) is None:
+            loaded_columns, _ = _load_inference_csv((path, RESULT_COLUMNS + [RESULT_VALID_SIZES]))
+            save_inference_store(*([loaded_columns[column] for column in RESULT_COLUMNS] +
+                                   [get_results_store_path(path)]),
+                                 valid_sizes=loaded_columns[RESULT_VALID_SIZES])
+
+
+def load_inference_results(directory_csvs, num_workers=None, mmap_mode='r'):
     """Load inference results from a directory with .csv file(s).
 
+  The binary store of a .csv file, from save_inference_store(), is loaded
+  instead of the .csv file if it is at least as recent. Stores without a .csv
+  file are loaded too.
+
   This function must remain synced with save_inference_results().
 
   Args:
     directory_csvs: String, directory of csv files to be loaded.
+    num_workers: Integer, if not None, the number of processes parsing the .csv
+      files concurrently.
+    mmap_mode: If not None, the numpy.load() memory-map mode of the binary
+      stores. The arrays of a single store are then returned without copying.
 
   Returns:
-    Tuple of results, the inputs to save_inference_results().
+    Tuple of results, the inputs to save_inference_results(), as numpy arrays:
+    probabilities (float32, [num_samples x num_classes]), labels (integers),
+    certainties (dict of float arrays), orig_names (strings) and predictions
+    (integers).
+  """
+    columns = load_inference_columns(directory_csvs, num_workers=num_workers,
+                                     mmap_mode=mmap_mode)
+    return tuple(columns[column] for column in RESULT_COLUMNS)
+
+
+def load_inference_columns(directory_csvs, columns=None, num_workers=None, mmap_mode='r'):
+    """Load selected columns of inference results from a directory with .csv file(s).
+
+  Each .csv file is read in a single pass, and all its numeric columns are
+  parsed at once, unless its binary store is loaded instead, as in
+  load_inference_results(). The files are concatenated in sorted order.
+
+  Args:
+    directory_csvs: String, directory of csv files to be loaded.
+    columns: List of strings in RESULT_COLUMNS, or RESULT_VALID_SIZES, the
+      columns to load. If None, all columns in RESULT_COLUMNS.
+    num_workers: Integer, if not None, the number of processes parsing the .csv
+      files concurrently.
+    mmap_mode: If not None, the numpy.load() memory-map mode of the binary
+      stores.
+
+  Returns:
+    Dict mapping each selected column to its numpy array, as returned by
+    load_inference_results(). The certainties are a dict of numpy arrays, and
+    the valid sizes an integer array of shape [num_samples x 2].
+
+  Raises:
+    ValueError: If a column is not in RESULT_COLUMNS or RESULT_VALID_SIZES.
   """
-    # Get paths to .csv files in directory.
-    paths_all = os.listdir(directory_csvs)
-    paths = [
-        os.path.join(directory_csvs, p) for p in paths_all
-        if os.path.splitext(p)[1] == '.csv'
-        ]
-
-    # Determine number of records across all .csv files.
-    num_entries_total = 0
-    for path in paths:
-        with open(path, 'r') as csvfile:
-            num_entries = sum(1 for _ in csvfile) - 1
-            logging.info('%g entries found at %s.', num_entries, path)
-            num_entries_total += num_entries
+    if columns is None:
+        columns = RESULT_COLUMNS
+    for column in columns:
+        if column not in RESULT_COLUMNS + [RESULT_VALID_SIZES]:
+            raise ValueError('Invalid column: %s' % column)
+
+    # Get paths to .csv files in directory, including those only saved as a
+    # binary store.
+    paths = sorted(set(
+        os.path.join(directory_csvs, os.path.splitext(p)[0] + '.csv')
+        for p in os.listdir(directory_csvs)
+        if os.path.splitext(p)[1] in ('.csv', RESULTS_STORE_EXTENSION)))
+    store_paths = [_get_results_store_if_current(path) for path in paths]
+    csv_paths = [path for path, store_path in zip(paths, store_paths) if store_path is None]
+
+    if num_workers is None:
+        csv_results = [_load_inference_csv((path, columns)) for path in csv_paths]
+    else:
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            csv_results = pool.map(_load_inference_csv, [(path, columns) for path in csv_paths])
+        finally:
+            pool.close()
+            pool.join()
+
+    csv_results = iter(csv_results)
+    results = [next(csv_results) if store_path is None else
+               _load_inference_store(store_path, columns, mmap_mode)
+               for store_path in store_paths]
+
+    # Skip .csv files without rows, whose number of classes may be unknown.
+    results = [result for result in results if result[1] > 0]
+    if not results:
+        results = [(_get_inference_columns([], numpy.zeros([0, len(CERTAINTY_TYPES) + 2]), columns), 0)]
+
+    num_entries_total = sum(num_entries for _, num_entries in results)
     logging.info('%g entries total.', num_entries_total)
 
-    # Read and parse all records.
-    aggregate_probabilities = None
-    aggregate_labels = []
-    certainties = {}
-    for k in CERTAINTY_TYPES.values():
-        certainties[k] = []
-    orig_names = []
-    predictions = []
-    count = 0
-    for path in paths:
-        with open(path, 'r') as csvfile:
-            reader = csv.reader(csvfile)
-            next(reader, None)
-            for row in reader:
-                orig_names.append(row[0])
-                predictions.append(int(row[1]))
-
-                for i, certainty in CERTAINTY_TYPES.items():
-                    certainties[certainty].append(float(row[i + 2]))
-                aggregate_labels.append(int(row[len(CERTAINTY_TYPES) + 2]))
-
-                row_probabilities = row[len(CERTAINTY_TYPES) + 3:]
-                if aggregate_probabilities is None:
-                    # Initialize
-                    aggregate_probabilities = numpy.zeros(
-                        (num_entries_total, len(row_probabilities)), dtype=numpy.float32)
-                aggregate_probabilities[count, :] = numpy.array(row_probabilities)
-
-                count += 1
-    assert count == num_entries_total
-
-    return (aggregate_probabilities, aggregate_labels, certainties, orig_names,
-            predictions)
+    if len(results) == 1:
+        return results[0][0]
+
+    loaded_columns = {}
+    for column in columns:
+        if column == RESULT_CERTAINTIES:
+            loaded_columns[column] = {
+                certainty: numpy.concatenate([result[column][certainty] for result, _ in results])
+                for certainty in CERTAINTY_NAMES}
+        else:
+            loaded_columns[column] = numpy.concatenate([result[column] for result, _ in results])
+    return loaded_columns
+
+
+def _get_results_store_if_current(results_path):
+    """Get path to the binary store of a results .csv file, if it is current.
+
+  Args:
+    results_path: String, path to the results .csv file, which may not exist.
+
+  Returns:
+    String, path to the binary store, or None if it doesn't exist or is older
+    than the .csv file.
+  """
+    store_path = get_results_store_path(results_path)
+    if not os.path.isdir(store_path):
+        return None
+    if (os.path.isfile(results_path) and
+            os.path.getmtime(results_path) > os.path.getmtime(store_path)):
+        return None
+    return store_path
+
+
+def _load_inference_store(store_path, columns, mmap_mode):
+    """Loads the selected columns of a binary store of inference results.
+
+  This function must remain synced with save_inference_store().
+
+  Args:
+    store_path: String, path to the directory of .npy files.
+    columns: List of strings in RESULT_COLUMNS, or RESULT_VALID_SIZES, the
+      columns to load.
+    mmap_mode: If not None, the numpy.load() memory-map mode.
+
+  Returns:
+    Tuple of the dict of loaded columns, and the number of entries.
+  """
+    def load(name):
+        return numpy.load(os.path.join(store_path, name + '.npy'), mmap_mode=mmap_mode)
+
+    num_entries = len(numpy.load(os.path.join(store_path, RESULT_PREDICTIONS + '.npy'), mmap_mode='r'))
+
+    loaded_columns = {}
+    for column in columns:
+        if column == RESULT_CERTAINTIES:
+            loaded_columns[column] = {
+                certainty: load('%s_%s' % (RESULT_CERTAINTIES, certainty))
+                for certainty in CERTAINTY_NAMES}
+        elif (column == RESULT_VALID_SIZES and
+              not os.path.isfile(os.path.join(store_path, column + '.npy'))):
+            loaded_columns[column] = numpy.full([num_entries, 2], -1, dtype=numpy.int64)
+        else:
+            loaded_columns[column] = load(column)
+
+    logging.info('%g entries found at %s.', num_entries, store_path)
+    return loaded_columns, num_entries
+
+
+def _load_inference_csv(path_and_columns):
+    """Loads the selected columns of a .csv file of inference results.
+
+  This function must remain synced with save_inference_results().
+
+  Args:
+    path_and_columns: Tuple of the path to the .csv file, and the list of
+      columns to load.
+
+  Returns:
+    Tuple of the dict of loaded columns, and the number of entries.
+
+  Raises:
+    ValueError: If the .csv file is malformed.
+  """
+    path, columns = path_and_columns
+    with open(path, 'r') as csvfile:
+        text = csvfile.read()
+
+    lines = text.splitlines(True)
+    header = next(csv.reader(lines[:1]), [''])
+    num_numeric_columns = len(header) - 1
+    has_valid_sizes = header[-len(_VALID_SIZE_HEADERS):] == _VALID_SIZE_HEADERS
+
+    if '"' in text:
+        # Quoted names, e.g. with commas, need the csv parser.
+        rows = list(csv.reader(lines[1:]))
+        orig_names = [row[0] for row in rows]
+        numeric_fields = [','.join(row[1:]) for row in rows]
+    else:
+        # Only the first column is not numeric.
+        orig_names = []
+        numeric_fields = []
+        for line in lines[1:]:
+            orig_name, _, numeric_field = line.rstrip('\r\n').partition(',')
+            orig_names.append(orig_name)
+            numeric_fields.append(numeric_field)
+
+    num_entries = len(orig_names)
+    logging.info('%g entries found at %s.', num_entries, path)
+
+    # Parse all numeric columns at once.
+    if num_entries:
+        values = numpy.fromstring(','.join(numeric_fields), sep=',')
+    else:
+        values = numpy.zeros([0])
+    if values.size != num_entries * num_numeric_columns:
+        raise ValueError('Malformed inference results in %s.' % path)
+    values = values.reshape([num_entries, num_numeric_columns])
+
+    valid_sizes = None
+    if has_valid_sizes:
+        valid_sizes = values[:, -len(_VALID_SIZE_HEADERS):].astype(numpy.int64)
+        values = values[:, :-len(_VALID_SIZE_HEADERS)]
+
+    return _get_inference_columns(orig_names, values, columns, valid_sizes), num_entries
+
+
+def _get_inference_columns(orig_names, values, columns, valid_sizes=None):
+    """Gets the selected columns of inference results.
+
+  Args:
+    orig_names: List of strings, the original names.
+    values: Numpy float array of the numeric columns of the .csv file, except
+      the valid sizes, of shape [num_entries x num_numeric_columns].
+    columns: List of strings in RESULT_COLUMNS, or RESULT_VALID_SIZES, the
+      columns to get.
+    valid_sizes: Integer numpy array of shape [num_entries x 2], or None if
+      unknown.
+
+  Returns:
+    Dict mapping each column to its numpy array.
+  """
+    label_column = len(CERTAINTY_TYPES) + 1
+    loaded_columns = {}
+    if RESULT_VALID_SIZES in columns:
+        if valid_sizes is None:
+            valid_sizes = numpy.full([len(orig_names), 2], -1, dtype=numpy.int64)
+        loaded_columns[RESULT_VALID_SIZES] = valid_sizes
+    if RESULT_ORIG_NAMES in columns:
+        loaded_columns[RESULT_ORIG_NAMES] = numpy.array(orig_names, dtype=str)
+    if RESULT_PREDICTIONS in columns:
+        loaded_columns[RESULT_PREDICTIONS] = values[:, 0].astype(numpy.int64)
+    if RESULT_CERTAINTIES in columns:
+        loaded_columns[RESULT_CERTAINTIES] = {
+            certainty: values[:, i + 1].copy() for i, certainty in CERTAINTY_TYPES.items()}
+    if RESULT_LABELS in columns:
+        loaded_columns[RESULT_LABELS] = values[:, label_column].astype(numpy.int64)
+    if RESULT_PROBABILITIES in columns:
+        loaded_columns[RESULT_PROBABILITIES] = values[:, label_column + 1:].astype(numpy.float32)
+    return loaded_columns
 
 
 def save_result_plots(aggregate_probabilities,
@@ -10,7 +10,10 @@ Example usage:
 """
 
 import logging
+import multiprocessing
 import os
+import re
+import shutil
 import sys
 
 import numpy
@@ -18,6 +21,7 @@ import skimage.io
 import tensorflow
 
 import microscopeimagequality.constants
+import microscopeimagequality.data_provider
 import microscopeimagequality.dataset_creation
 import microscopeimagequality.evaluation
 
@@ -27,6 +31,10 @@ _SPLIT_NAME = 'test'
 
 _TFRECORD_FILE_PATTERN = 'data_%s-%05d-of-%05d.tfrecord'
 
+# Results .csv files, and their binary stores, of one shard of inference.
+_RESULTS_SHARD_PATTERN = re.compile(r'^results-\d{5}-of-\d{5}(\.csv|%s)$' % re.escape(
+    microscopeimagequality.evaluation.RESULTS_STORE_EXTENSION))
+
 class ImageQualityClassifier(object):
   """Object for running image quality model inference.
 
@@ -38,7 +46,8 @@ class ImageQualityClassifier(object):
                model_ckpt,
                model_patch_side_length,
                num_classes,
-               graph=None):
+               graph=None,
+               patch_stride=None):
     """Initialize the model from a checkpoint.
 
     Args:
@@ -47,8 +56,14 @@ class ImageQualityClassifier(object):
         image passed to the model.
       num_classes: Integer, the number of classes the model predicts.
       graph: TensorFlow graph. If None, one will be created.
+      patch_stride: Integer, the spacing in pixels between the patches passed
+        to the model. If None, the patches don't overlap. A stride smaller than
+        model_patch_side_length (e.g. half of it) gives denser predictions.
     """
+    if patch_stride is None:
+      patch_stride = model_patch_side_length
     self._model_patch_side_length = model_patch_side_length
+    self._patch_stride = patch_stride
     self._num_classes = num_classes
 
     if graph is None:
@@ -56,11 +71,20 @@ class ImageQualityClassifier(object):
     self.graph = graph
 
     with self.graph.as_default():
+      # A batch of images, all of the same size.
       self._image_placeholder = tensorflow.placeholder(
-          tensorflow.float32, shape=[None, None, 1])
+          tensorflow.float32, shape=[None, None, None, 1])
+
+      self._tiles = _get_batch_tiles_tensor(self._image_placeholder,
+                                            model_patch_side_length,
+                                            patch_stride)
+
+      # The visualization requires non-overlapping tiles.
+      self._grid_tiles = _get_batch_tiles_tensor(self._image_placeholder,
+                                                 model_patch_side_length)
 
-      self._probabilities = self._probabilities_from_image(
-          self._image_placeholder, model_patch_side_length, num_classes)
+      self._probabilities = self._probabilities_from_tiles(
+          self._tiles, num_classes)
 
       self._sess = tensorflow.Session()
       saver = tensorflow.train.Saver()
@@ -71,35 +95,48 @@ class ImageQualityClassifier(object):
   def __del__(self):
     self._sess.close()
 
-  def _probabilities_from_image(self, image_placeholder,
-                                model_patch_side_length, num_classes):
-    """Get probabilities tensor from input image tensor.
+  def _probabilities_from_tiles(self, tiles, num_classes):
+    """Get probabilities tensor from input image tiles tensor.
 
     Args:
-      image_placeholder: Float32 tensor, placeholder for input image.
-      model_patch_side_length: Integer, the side length in pixels of the square
-        image passed to the model.
+      tiles: Float32 tensor of image tiles, size [num_tiles x
+        model_patch_side_length x model_patch_side_length x 1].
       num_classes: Integer, the number of classes the model predicts.
 
     Returns:
-      Probabilities tensor, shape [num_classes] representing the predicted
-      probabilities for each class.
+      Probabilities tensor, shape [num_tiles x num_classes] representing the
+      predicted probabilities for each class.
     """
-    labels_fake = tensorflow.zeros([self._num_classes])
-
-    image_path_fake = tensorflow.constant(['unused'])
-    tiles, labels, _ = _get_image_tiles_tensor(
-        image_placeholder, labels_fake, image_path_fake,
-        model_patch_side_length)
+    labels_fake = tensorflow.zeros([tensorflow.shape(tiles)[0], num_classes])
 
     model_metrics = microscopeimagequality.evaluation.get_model_and_metrics(
         tiles,
         num_classes=num_classes,
-        one_hot_labels=labels,
+        one_hot_labels=labels_fake,
         is_training=False)
 
     return model_metrics.probabilities
 
+  def _get_tile_probabilities(self, tiles, batch_size):
+    """Run inference on image tiles, batch_size tiles per Session.run() call.
+
+    Args:
+      tiles: Numpy float array of image tiles, of shape (num_tiles,
+        model_patch_side_length, model_patch_side_length, 1).
+      batch_size: Integer, the max number of tiles per Session.run() call.
+
+    Returns:
+      Numpy float array of probabilities, of shape (num_tiles, num_classes).
+    """
+    np_probabilities = numpy.zeros((tiles.shape[0], self._num_classes),
+                                   dtype=numpy.float32)
+    for start in range(0, tiles.shape[0], batch_size):
+      # Feed the tiles directly, bypassing the tiling of the input image.
+      np_probabilities[start:start + batch_size] = self._sess.run(
+          self._probabilities,
+          feed_dict={self._tiles: tiles[start:start + batch_size]})
+    return np_probabilities
+
   def predict(self, image):
     """Run inference on an image.
 
@@ -109,14 +146,89 @@ class ImageQualityClassifier(object):
     Returns:
       A evaluation.WholeImagePrediction object.
     """
-    feed_dict = {self._image_placeholder: numpy.expand_dims(image, 2)}
-    [np_probabilities] = self._sess.run(
-        [self._probabilities], feed_dict=feed_dict)
-
-    return microscopeimagequality.evaluation.aggregate_prediction_from_probabilities(
-        np_probabilities, microscopeimagequality.evaluation.METHOD_AVERAGE)
-  
-  def get_patch_predictions(self,  image):
+    return self.predict_batch([image])[0]
+
+  def predict_batch(self, images, batch_size=32):
+    """Run inference on several images of the same size.
+
+    The tiles of up to batch_size images are evaluated in a single
+    Session.run() call.
+
+    Args:
+      images: Numpy float array of shape (num_images, height, width), or a list
+        of two-dimensional numpy float arrays of the same shape.
+      batch_size: Integer, the max number of images per Session.run() call.
+
+    Returns:
+      A list of evaluation.WholeImagePrediction objects, one per image.
+
+    Raises:
+      ValueError: If the images are not two-dimensional and of the same shape.
+    """
+    image_shapes = sorted(set(numpy.shape(image) for image in images))
+    if len(image_shapes) != 1 or len(image_shapes[0]) != 2:
+      raise ValueError('Images must be two-dimensional and of the same shape, '
+                       'but have shapes %s.' % str(image_shapes))
+    images = numpy.asarray(images)
+
+    predictions = []
+    for start in range(0, images.shape[0], batch_size):
+      batch = images[start:start + batch_size]
+      feed_dict = {self._image_placeholder: numpy.expand_dims(batch, 3)}
+      [np_probabilities] = self._sess.run(
+          [self._probabilities], feed_dict=feed_dict)
+
+      # The tiles of each image are contiguous.
+      for image_probabilities in numpy.split(np_probabilities, batch.shape[0]):
+        predictions.append(
+            microscopeimagequality.evaluation.aggregate_prediction_from_probabilities(
+                image_probabilities,
+                microscopeimagequality.evaluation.METHOD_AVERAGE))
+
+    return predictions
+
+  def get_patch_probabilities(self, image, batch_size=256):
+    """Run inference on each patch in an image, in batches of patches.
+
+    Patches are patch_stride apart, starting at the upper left, and include the
+    last full row and column of patches.
+
+    Args:
+      image: Numpy float array, of shape (height, width).
+      batch_size: Integer, the max number of patches per Session.run() call.
+
+    Returns:
+      Tuple of numpy arrays, the patch probabilities of shape (num_patches,
+      num_classes), and the patch locations of shape (num_patches, 4), where
+      each row is (upper_left_row, upper_left_col, height, width).
+    """
+    feed_dict = {
+        self._image_placeholder: numpy.expand_dims(numpy.expand_dims(image, 0), 3)
+    }
+    np_tiles = self._sess.run(self._tiles, feed_dict=feed_dict)
+    np_probabilities = self._get_tile_probabilities(np_tiles, batch_size)
+
+    locations = _get_patch_locations(image.shape, self._model_patch_side_length,
+                                     self._patch_stride)
+
+    return np_probabilities, locations
+
+  def get_probability_map(self, image, batch_size=256):
+    """Run inference on each patch in an image, and blend the patch results.
+
+    Args:
+      image: Numpy float array, of shape (height, width).
+      batch_size: Integer, the max number of patches per Session.run() call.
+
+    Returns:
+      Numpy float array of shape (height, width, num_classes), the average
+      probabilities of the patches covering each pixel. Pixels not covered by
+      any patch have zero probability for all classes.
+    """
+    probabilities, locations = self.get_patch_probabilities(image, batch_size)
+    return patch_probabilities_to_map(probabilities, locations, image.shape)
+
+  def get_patch_predictions(self, image):
     """Run inference on each patch in an image, returning each patch score.
 
     Args:
@@ -127,13 +239,16 @@ class ImageQualityClassifier(object):
       evaluation.WholeImagePrediction) which denote the patch location,
       dimensions and predition result.
     """
-    results = []
-    w = microscopeimagequality.constants.PATCH_SIDE_LENGTH
-    for i in range(0, image.shape[0] - w, w):
-      for j in range(0, image.shape[1] - w, w):
-        results.append((i, j, w, w, self.predict(image[i:i+w, j:j+w])))
-    return results               
-    
+    probabilities, locations = self.get_patch_probabilities(image)
+
+    return [
+        tuple(int(v) for v in locations[i]) +
+        (microscopeimagequality.evaluation.aggregate_prediction_from_probabilities(
+            probabilities[i:i + 1],
+            microscopeimagequality.evaluation.METHOD_AVERAGE),)
+        for i in range(locations.shape[0])
+    ]
+
   def get_annotated_prediction(self, image):
     """Run inference to annotate the input image with patch predictions.
 
@@ -147,16 +262,17 @@ class ImageQualityClassifier(object):
          image_width = floor(image.shape[1] / model_patch_side_length)
     """
 
-    feed_dict = {self._image_placeholder: numpy.expand_dims(image, 2)}
+    feed_dict = {
+        self._image_placeholder: numpy.expand_dims(numpy.expand_dims(image, 0), 3)
+    }
 
-    with self.graph.as_default():
-      patches = _get_image_tiles_tensor(
-          self._image_placeholder,
-          tensorflow.constant([0]),
-          tensorflow.constant([0]),
-          patch_width=self._model_patch_side_length)[0]
+    if self._patch_stride == self._model_patch_side_length:
       [np_probabilities, np_patches] = self._sess.run(
-          [self._probabilities, patches], feed_dict=feed_dict)
+          [self._probabilities, self._tiles], feed_dict=feed_dict)
+    else:
+      np_patches = self._sess.run(self._grid_tiles, feed_dict=feed_dict)
+      np_probabilities = self._get_tile_probabilities(np_patches,
+                                                      np_patches.shape[0])
 
     # We use '-1' to denote no true label exists.
     np_labels = -1 * numpy.ones((np_patches.shape[0]))
@@ -174,35 +290,67 @@ def patch_values_to_mask(values, patch_width):
     """Construct a mask from an array of patch values.
 
   Args:
-    values: A uint16 2D numpy array.
+    values: A uint16 2D numpy array, or a 3D array for a stack of masks.
     patch_width: Width in pixels of each patch.
 
   Returns:
     The  mask, a uint16 numpy array of width patch_width *
-    values.shape[0].
+    values.shape[-1] and height patch_width * values.shape[-2], or the stack
+    of masks.
 
   Raises:
     ValueError: If the input values are invalid.
   """
-    if values.dtype != numpy.uint16 or len(values.shape) != 2:
+    if values.dtype != numpy.uint16 or len(values.shape) not in (2, 3):
         logging.info('dtype: %s shape: %s', values.dtype, values.shape)
-        raise ValueError('Input must be a 2D np.uint16 array.')
+        raise ValueError('Input must be a 2D or 3D np.uint16 array.')
 
-    patches_per_column = values.shape[0]
-    patches_per_row = values.shape[1]
+    patches_per_column = values.shape[-2]
+    patches_per_row = values.shape[-1]
 
-    mask = numpy.zeros(
-        (patches_per_column * patch_width, patches_per_row * patch_width),
+    # Repeat each value over a patch with a single broadcast assignment.
+    mask = numpy.empty(
+        values.shape[:-2] + (patches_per_column, patch_width, patches_per_row, patch_width),
         dtype=numpy.uint16)
+    mask[:] = values[..., :, numpy.newaxis, :, numpy.newaxis]
 
-    for i in range(patches_per_column):
-        for j in range(patches_per_row):
-            ymin = i * patch_width
-            xmin = j * patch_width
-            mask[ymin:ymin + patch_width, xmin:xmin + patch_width] = values[i, j]
+    return mask.reshape(values.shape[:-2] + (patches_per_column * patch_width,
+                                             patches_per_row * patch_width))
 
-    return mask
+def patch_probabilities_to_map(probabilities, locations, image_shape):
+    """Blend (possibly overlapping) patch probabilities into a per-pixel map.
+
+  Args:
+    probabilities: Numpy float array of shape (num_patches, num_classes).
+    locations: Integer numpy array of shape (num_patches, 4), where each row is
+      (upper_left_row, upper_left_col, height, width).
+    image_shape: Tuple of integers, the height and width of the image.
 
+  Returns:
+    Numpy float array of shape (height, width, num_classes), the average
+    probabilities of the patches covering each pixel. Pixels not covered by
+    any patch have zero probability for all classes.
+  """
+    height, width = image_shape[0], image_shape[1]
+    rows, cols = locations[:, 0], locations[:, 1]
+    bottom_rows = numpy.minimum(rows + locations[:, 2], height)
+    right_cols = numpy.minimum(cols + locations[:, 3], width)
+
+    # Add each patch at its corners to a difference array, whose cumulative
+    # sums along both axes are the sums over the patches covering each pixel.
+    probability_diff = numpy.zeros((height + 1, width + 1, probabilities.shape[1]))
+    count_diff = numpy.zeros((height + 1, width + 1), dtype=numpy.int64)
+    for corner_rows, corner_cols, sign in [(rows, cols, 1),
+                                           (rows, right_cols, -1),
+                                           (bottom_rows, cols, -1),
+                                           (bottom_rows, right_cols, 1)]:
+        numpy.add.at(probability_diff, (corner_rows, corner_cols), sign * probabilities)
+        numpy.add.at(count_diff, (corner_rows, corner_cols), sign)
+
+    probability_sum = probability_diff.cumsum(0).cumsum(1)[:height, :width]
+    counts = count_diff.cumsum(0).cumsum(1)[:height, :width, numpy.newaxis]
+
+    return numpy.where(counts > 0, probability_sum / numpy.maximum(counts, 1), 0.0)
 
 def save_masks_and_annotated_visualization(orig_name,
                                            output_directory,
@@ -299,7 +447,7 @@ def save_masks_and_annotated_visualization(orig_name,
         predictions.shape, dtype=numpy.uint16) * numpy.iinfo(numpy.uint16).max
     save_mask_from_patch_values(valid_pixel_regions, microscopeimagequality.constants.VALID_MASK_FORMAT)
 
-def _get_image_tiles_tensor(image, label, image_path, patch_width):
+def _get_image_tiles_tensor(image, label, image_path, patch_width, stride=None):
   """Gets patches that tile the input image, starting at upper left.
 
   Args:
@@ -307,105 +455,483 @@ def _get_image_tiles_tensor(image, label, image_path, patch_width):
     label: Input label tensor, size [num_classes].
     image_path: Input image path tensor, size [1].
     patch_width: Integer representing width of image patch.
+    stride: Integer, the spacing between patches. If None, patch_width.
 
   Returns:
     Tensors tiles, size [num_tiles x patch_width x patch_width x 1], labels,
     size [num_tiles x num_classes], and image_paths, size [num_tiles x 1].
   """
-  tiles_before_reshape = tensorflow.extract_image_patches(
-      tensorflow.expand_dims(image, dim=0), [1, patch_width, patch_width, 1],
-      [1, patch_width, patch_width, 1], [1, 1, 1, 1], 'VALID')
-  tiles = tensorflow.reshape(tiles_before_reshape, [-1, patch_width, patch_width, 1])
+  tiles = _get_batch_tiles_tensor(tensorflow.expand_dims(image, dim=0), patch_width,
+                                  stride)
 
   labels = tensorflow.tile(tensorflow.expand_dims(label, dim=0), [tensorflow.shape(tiles)[0], 1])
   image_paths = tensorflow.tile(
       tensorflow.expand_dims(image_path, dim=0), [tensorflow.shape(tiles)[0], 1])
   return tiles, labels, image_paths
 
+def _get_patch_locations(image_shape, patch_width, stride=None):
+  """Gets the locations of the patches that tile an image, in row-major order.
+
+  Args:
+    image_shape: Tuple of integers, the height and width of the image.
+    patch_width: Integer representing width of image patch.
+    stride: Integer, the spacing between patches. If None, patch_width.
+
+  Returns:
+    Integer numpy array of shape (num_patches, 4), where each row is
+    (upper_left_row, upper_left_col, height, width).
+  """
+  if stride is None:
+    stride = patch_width
+  upper_left_rows, upper_left_cols = numpy.meshgrid(
+      numpy.arange(0, image_shape[0] - patch_width + 1, stride),
+      numpy.arange(0, image_shape[1] - patch_width + 1, stride),
+      indexing='ij')
+  num_patches = upper_left_rows.size
+  return numpy.stack([
+      upper_left_rows.ravel(),
+      upper_left_cols.ravel(),
+      numpy.full(num_patches, patch_width, dtype=upper_left_rows.dtype),
+      numpy.full(num_patches, patch_width, dtype=upper_left_rows.dtype)
+  ], axis=1)
+
+def _get_batch_tiles_tensor(images, patch_width, stride=None):
+  """Gets patches that tile each image in a batch, starting at upper left.
+
+  Args:
+    images: Input images tensor, size [num_images x height x width x 1].
+    patch_width: Integer representing width of image patch.
+    stride: Integer, the spacing between patches. If None, patch_width, and
+      the patches don't overlap.
+
+  Returns:
+    Tensor of tiles, size [num_images * num_tiles x patch_width x patch_width x
+    1], where the tiles of each image are contiguous and in row-major order.
+  """
+  if stride is None:
+    stride = patch_width
+  tiles_before_reshape = tensorflow.extract_image_patches(
+      images, [1, patch_width, patch_width, 1],
+      [1, stride, stride, 1], [1, 1, 1, 1], 'VALID')
+  return tensorflow.reshape(tiles_before_reshape, [-1, patch_width, patch_width, 1])
+
 def run_model_inference( model_ckpt_file, probabilities, labels, images,
                         output_directory, image_paths, num_samples,
                         image_height, image_width, show_plots, shard_num,
-                        num_shards, patch_width, aggregation_method):
-    """Run a previously trained model on images."""
+                        num_shards, patch_width, aggregation_method,
+                        results_store=False, patch_stride=None):
+    """Run a previously trained model on images.
+
+  If patch_stride is not None, the tensors must hold the patches of each image
+  patch_stride apart, see save_inference_outputs().
+  """
+    logging.info('Running inference and writing inference results to \n%s',
+                 os.path.dirname(output_directory))
+
+    _check_model_directory(model_ckpt_file)
+
+    saver = tensorflow.train.Saver()
+    with tensorflow.Session() as sess:
+        logging.info('Restoring checkpoint %s', model_ckpt_file)
+
+        saver.restore(sess, model_ckpt_file)
+
+        def run_samples():
+            for i in range(num_samples):
+                logging.info('Running inference on sample  %d.', i)
+                yield sess.run([probabilities, labels, images, image_paths])
+
+        save_inference_outputs(run_samples(), output_directory, image_height,
+                               image_width, show_plots, shard_num, num_shards,
+                               patch_width, aggregation_method, results_store,
+                               patch_stride)
+
+
+def run_model_inference_from_images(model_ckpt_file, dataset, output_directory,
+                                    image_height, image_width, show_plots,
+                                    shard_num, num_shards, patch_width,
+                                    aggregation_method, num_classes=11,
+                                    results_store=False, patch_stride=None):
+    """Run a previously trained model on images read directly from disk.
+
+  Unlike run_model_inference(), no intermediate TFRecord is needed: each image
+  is decoded and preprocessed in memory and fed to the model, one image (and
+  all of its tiles) per Session.run() call.
+
+  Args:
+    model_ckpt_file: String, path to TensorFlow model checkpoint to load.
+    dataset: dataset_creation.Dataset object with the images to run inference
+      on, already subsampled if sharding.
+    output_directory: String, path to directory for outputs.
+    image_height: Integer, the image height.
+    image_width: Integer, the image width.
+    show_plots: Whether to show plots (use with Colab).
+    shard_num: Integer, the shard number.
+    num_shards: Integer, total number of shards.
+    patch_width: Integer, width of image patches.
+    aggregation_method: String, the method of aggregating the patch
+      probabilities.
+    num_classes: Integer, the number of classes the model predicts.
+    results_store: Boolean, whether to also save the results as a binary
+      store, see save_inference_outputs().
+    patch_stride: Integer, the spacing in pixels between the patches, for
+      full resolution predictions masks, see save_inference_outputs(). If
+      None, patch_width.
+  """
     logging.info('Running inference and writing inference results to \n%s',
                  os.path.dirname(output_directory))
 
+    _check_model_directory(model_ckpt_file)
+
+    graph = tensorflow.Graph()
+    with graph.as_default():
+        image_placeholder = tensorflow.placeholder(
+            tensorflow.float32, shape=[image_height, image_width, 1])
+        label_placeholder = tensorflow.placeholder(
+            tensorflow.float32, shape=[num_classes])
+
+        tiles, one_hot_labels, _ = _get_image_tiles_tensor(
+            image_placeholder, label_placeholder,
+            tensorflow.constant(['unused']), patch_width, patch_stride)
+
+        model_metrics = microscopeimagequality.evaluation.get_model_and_metrics(
+            tiles,
+            num_classes=num_classes,
+            one_hot_labels=one_hot_labels,
+            is_training=False)
+
+        saver = tensorflow.train.Saver()
+        with tensorflow.Session() as sess:
+            logging.info('Restoring checkpoint %s', model_ckpt_file)
+
+            saver.restore(sess, model_ckpt_file)
+
+            def run_samples():
+                for i in range(dataset.num_examples):
+                    logging.info('Running inference on sample  %d.', i)
+                    image, label, image_path = dataset.get_sample(i, normalize=False)
+                    feed_dict = {
+                        image_placeholder: numpy.expand_dims(image, 2),
+                        label_placeholder: label
+                    }
+                    [np_probabilities, np_labels, np_images] = sess.run(
+                        [model_metrics.probabilities, model_metrics.labels, tiles],
+                        feed_dict=feed_dict)
+                    # Match the [num_tiles x 1] string tensor of the TFRecord path.
+                    np_image_paths = [[str.encode(image_path)]]
+                    yield np_probabilities, np_labels, np_images, np_image_paths
+
+            save_inference_outputs(run_samples(), output_directory, image_height,
+                                   image_width, show_plots, shard_num, num_shards,
+                                   patch_width, aggregation_method, results_store,
+                                   patch_stride)
+
+
+def save_inference_outputs(samples, output_directory, image_height, image_width,
+                           show_plots, shard_num, num_shards, patch_width,
+                           aggregation_method, results_store=False,
+                           patch_stride=None):
+    """Save the masks, annotated images, .csv and plots for inference results.
+
+  If patch_stride is not None, a full resolution predictions mask of each image
+  is also saved, from the average probabilities of the (overlapping) patches
+  covering each pixel. All the other outputs use the non-overlapping patches
+  among them.
+
+  Args:
+    samples: Iterable of (np_probabilities, np_labels, np_images,
+      np_image_paths) tuples, one per image, with the patch probabilities of
+      shape (num_patches, num_classes), patch labels of shape (num_patches),
+      patches of shape (num_patches, width, width, 1) and image paths, where
+      np_image_paths[0][0] is the original image path.
+    output_directory: String, path to directory for outputs.
+    image_height: Integer, the image height.
+    image_width: Integer, the image width.
+    show_plots: Whether to show plots (use with Colab).
+    shard_num: Integer, the shard number.
+    num_shards: Integer, total number of shards.
+    patch_width: Integer, width of image patches.
+    aggregation_method: String, the method of aggregating the patch
+      probabilities.
+    results_store: Boolean, whether to also save the results as a binary store
+      of .npy files, next to the .csv file, see
+      evaluation.save_inference_store().
+    patch_stride: Integer, the spacing in pixels between the patches of each
+      sample, which must divide patch_width. If None, patch_width.
+
+  Raises:
+    ValueError: If patch_stride does not divide patch_width.
+  """
     if not os.path.isdir(output_directory):
         os.makedirs(output_directory)
 
+    if patch_stride is not None:
+        if patch_width % patch_stride:
+            raise ValueError('The patch stride %d must divide the patch width %d.' % (patch_stride, patch_width))
+
+        # The non-overlapping patches are those at multiples of patch_width.
+        locations = _get_patch_locations((image_height, image_width), patch_width, patch_stride)
+        is_grid_patch = numpy.all(locations[:, :2] % patch_width == 0, axis=1)
+
     aggregate_labels = []
     patch_labels = []
 
-    model_directory = os.path.dirname(model_ckpt_file)
-    if not os.path.isdir(model_directory):
-        logging.fatal('Model checkpoint directory does not exist.')
+    # The annotated images and masks are valid in the upper-left region covered
+    # by patches, the same for every image.
+    valid_size = [image_height // patch_width * patch_width, image_width // patch_width * patch_width]
 
-    saver = tensorflow.train.Saver()
-    with tensorflow.Session() as sess:
-        logging.info('Restoring checkpoint %s', model_ckpt_file)
+    for i, (np_probabilities, np_labels, np_images, np_image_paths) in enumerate(samples):
+        if patch_stride is not None:
+            _save_dense_prediction_mask(np_image_paths[0][0].decode('utf-8'), output_directory, patch_probabilities_to_map(np_probabilities, locations, (image_height, image_width)))
 
-        saver.restore(sess, model_ckpt_file)
-        coord = tensorflow.train.Coordinator()
-        threads = tensorflow.train.start_queue_runners(sess=sess, coord=coord)
-        logging.info('Started queue_runners.')
+            np_probabilities = np_probabilities[is_grid_patch]
+            np_labels = np_labels[is_grid_patch]
+            np_images = np_images[is_grid_patch]
 
-        for i in range(num_samples):
-            logging.info('Running inference on sample  %d.', i)
+        (prediction, certainties, probabilities_i) = microscopeimagequality.evaluation.aggregate_prediction_from_probabilities(np_probabilities, aggregation_method)
 
-            [np_probabilities, np_labels, np_images, np_image_paths] = sess.run([probabilities, labels, images, image_paths])
+        # Each name must be unique since all workers write to same directory.
+        orig_name = np_image_paths[0][0] if np_image_paths[0][0] else ('not_available_%03d_%07d.png' % (shard_num, i))
 
-            (prediction, certainties, probabilities_i) = microscopeimagequality.evaluation.aggregate_prediction_from_probabilities(np_probabilities, aggregation_method)
+        save_masks_and_annotated_visualization(orig_name, output_directory, prediction, certainties, np_images, np_probabilities, np_labels, patch_width, image_height, image_width, show_plots)
 
-            # Each name must be unique since all workers write to same directory.
-            orig_name = np_image_paths[0][0] if np_image_paths[0][0] else ('not_available_%03d_%07d.png' % shard_num, i)
+        if i == 0:
+            patch_probabilities = np_probabilities
+            aggregate_probabilities = numpy.expand_dims(probabilities_i, 0)
+            orig_names = []
+            all_certainties = {}
+            for k in microscopeimagequality.evaluation.CERTAINTY_TYPES.values():
+                all_certainties[k] = []
+        else:
+            patch_probabilities = numpy.concatenate((patch_probabilities,
+                                                     np_probabilities), 0)
+            aggregate_probabilities = numpy.concatenate(
+                (aggregate_probabilities, numpy.expand_dims(probabilities_i, 0)))
 
-            save_masks_and_annotated_visualization(orig_name, output_directory, prediction, certainties, np_images, np_probabilities, np_labels, patch_width, image_height, image_width, show_plots)
+        orig_names.append(orig_name)
 
-            if i == 0:
-                patch_probabilities = np_probabilities
-                aggregate_probabilities = numpy.expand_dims(probabilities_i, 0)
-                orig_names = []
-                all_certainties = {}
-                for k in microscopeimagequality.evaluation.CERTAINTY_TYPES.values():
-                    all_certainties[k] = []
-            else:
-                patch_probabilities = numpy.concatenate((patch_probabilities,
-                                                         np_probabilities), 0)
-                aggregate_probabilities = numpy.concatenate(
-                    (aggregate_probabilities, numpy.expand_dims(probabilities_i, 0)))
+        for k, v in certainties.items():
+            all_certainties[k].append(v)
 
-            orig_names.append(orig_name)
+        aggregate_labels.append(np_labels[0])
 
-            for k, v in certainties.items():
-                all_certainties[k].append(v)
+        patch_labels += list(np_labels)
 
-            aggregate_labels.append(np_labels[0])
+    aggregate_predictions = list(numpy.argmax(aggregate_probabilities, 1))
 
-            patch_labels += list(np_labels)
+    logging.info('Inference output to %s.', output_directory)
 
-        aggregate_predictions = list(numpy.argmax(aggregate_probabilities, 1))
+    logging.info('Done evaluating model.')
 
-        logging.info('Inference output to %s.', output_directory)
+    output_file = (os.path.join(output_directory, 'results-%05d-of-%05d.csv') % (shard_num, num_shards))
 
-        logging.info('Done evaluating model.')
+    valid_sizes = [valid_size] * len(orig_names)
 
-        output_file = (os.path.join(output_directory, 'results-%05d-of-%05d.csv') % (shard_num, num_shards))
+    microscopeimagequality.evaluation.save_inference_results(aggregate_probabilities, aggregate_labels, all_certainties, orig_names, aggregate_predictions, output_file, valid_sizes)
 
-        microscopeimagequality.evaluation.save_inference_results(aggregate_probabilities, aggregate_labels, all_certainties, orig_names, aggregate_predictions, output_file)
+    if results_store:
+        # Saved after the .csv file, so that the store is current.
+        microscopeimagequality.evaluation.save_inference_store(aggregate_probabilities, aggregate_labels, all_certainties, orig_names, aggregate_predictions, microscopeimagequality.evaluation.get_results_store_path(output_file), valid_sizes)
 
-        # If we're not sharding, save out accuracy statistics.
-        if num_shards == 1:
-            save_confusion = not numpy.any(numpy.asarray(aggregate_labels) < 0)
+    # If we're not sharding, save out accuracy statistics.
+    if num_shards == 1:
+        save_confusion = not numpy.any(numpy.asarray(aggregate_labels) < 0)
 
-            microscopeimagequality.evaluation.save_result_plots(aggregate_probabilities, aggregate_labels, save_confusion, output_directory, patch_probabilities, patch_labels)
+        microscopeimagequality.evaluation.save_result_plots(aggregate_probabilities, aggregate_labels, save_confusion, output_directory, patch_probabilities, patch_labels)
 
-        logging.info('Stopping threads')
 
-        coord.request_stop()
+def run_sharded_model_inference(model_ckpt_file, list_of_image_globs,
+                                output_directory, image_height, image_width,
+                                patch_width, aggregation_method, num_workers,
+                                num_classes=11, results_store=False,
+                                patch_stride=None):
+    """Run model inference on shards of the images in parallel processes.
 
-        coord.join(threads)
+  Each worker process evaluates one shard of the (unlabeled) images with its
+  own model session and writes its own results .csv, and the plots are then
+  saved from the results of all shards.
 
-        logging.info('Threads stopped')
+  Args:
+    model_ckpt_file: String, path to TensorFlow model checkpoint to load.
+    list_of_image_globs: List of strings, each a glob of images to evaluate.
+    output_directory: String, path to directory for outputs.
+    image_height: Integer, the image height.
+    image_width: Integer, the image width.
+    patch_width: Integer, width of image patches.
+    aggregation_method: String, the method of aggregating the patch
+      probabilities.
+    num_workers: Integer, the maximum number of worker processes and shards.
+      There are no more shards than images.
+    num_classes: Integer, the number of classes the model predicts.
+    results_store: Boolean, whether each shard also saves its results as a
+      binary store, see save_inference_outputs().
+    patch_stride: Integer, the spacing in pixels between the patches, for
+      full resolution predictions masks, see save_inference_outputs(). If
+      None, patch_width.
+  """
+    _check_model_directory(model_ckpt_file)
+
+    num_shards = _get_num_inference_shards(list_of_image_globs, num_workers,
+                                           image_height, image_width, num_classes)
+
+    # The merged plots must only count the results of this run.
+    _remove_shard_results(output_directory)
+
+    shard_args = [(model_ckpt_file, list_of_image_globs, output_directory,
+                   image_height, image_width, patch_width, aggregation_method,
+                   num_classes, shard_num, num_shards, results_store,
+                   patch_stride)
+                  for shard_num in range(num_shards)]
+
+    # No TensorFlow session may exist in this process, since workers are forked.
+    pool = multiprocessing.Pool(num_shards)
+    try:
+        pool.map(_run_model_inference_shard, shard_args)
+    finally:
+        pool.close()
+        pool.join()
+
+    save_merged_result_plots(output_directory)
+
+
+def _get_num_inference_shards(list_of_image_globs, num_workers, image_height,
+                              image_width, num_classes):
+    """Get the number of shards to split the images in, none of them empty.
+
+  Args:
+    list_of_image_globs: List of strings, each a glob of images to evaluate.
+    num_workers: Integer, the maximum number of shards.
+    image_height: Integer, the image height.
+    image_width: Integer, the image width.
+    num_classes: Integer, the number of classes the model predicts.
+
+  Returns:
+    Integer, the smaller of num_workers and the number of images.
+
+  Raises:
+    ValueError: If no images are found.
+  """
+    num_images = microscopeimagequality.dataset_creation.read_dataset(
+        list_of_image_globs,
+        num_classes,
+        image_width,
+        image_height,
+        max_images=1e6,
+        use_unlabeled_data=True).num_examples
+    if num_images == 0:
+        raise ValueError('No images found.')
+    if num_workers > num_images:
+        logging.info('Using %d workers, one per image, instead of %d.', num_images, num_workers)
+    return min(num_workers, num_images)
+
+
+def _remove_shard_results(output_directory):
+    """Remove the results .csv files and binary stores of previous shards.
+
+  Args:
+    output_directory: String, path to the directory with the results.
+  """
+    if not os.path.isdir(output_directory):
+        return
+    for filename in sorted(os.listdir(output_directory)):
+        if not _RESULTS_SHARD_PATTERN.match(filename):
+            continue
+        path = os.path.join(output_directory, filename)
+        logging.info('Removing results of a previous run %s', path)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+def _run_model_inference_shard(shard_args):
+    """Run in-memory model inference on one shard, in a worker process."""
+    (model_ckpt_file, list_of_image_globs, output_directory, image_height,
+     image_width, patch_width, aggregation_method, num_classes, shard_num,
+     num_shards, results_store, patch_stride) = shard_args
+
+    dataset = microscopeimagequality.dataset_creation.read_dataset(
+        list_of_image_globs,
+        num_classes,
+        image_width,
+        image_height,
+        max_images=1e6,
+        shard_num=shard_num,
+        num_shards=num_shards,
+        use_unlabeled_data=True)
+
+    logging.info('Shard %d of %d has %g samples.', shard_num, num_shards,
+                 dataset.num_examples)
+
+    run_model_inference_from_images(model_ckpt_file, dataset, output_directory,
+                                    image_height, image_width, False, shard_num,
+                                    num_shards, patch_width, aggregation_method,
+                                    num_classes, results_store, patch_stride)
+
+def save_merged_result_plots(output_directory):
+    """Save the plots from all the results .csv files in a directory.
+
+  Args:
+    output_directory: String, path to the directory with the results .csv files
+      of all shards, and for the plots.
+  """
+    aggregate_probabilities, aggregate_labels, _, _, _ = (
+        microscopeimagequality.evaluation.load_inference_results(output_directory))
+
+    save_confusion = not numpy.any(numpy.asarray(aggregate_labels) < 0)
+
+    microscopeimagequality.evaluation.save_result_plots(aggregate_probabilities, aggregate_labels, save_confusion, output_directory)
+
+
+def _save_dense_prediction_mask(image_path, output_directory, probability_map):
+    """Save the full resolution predictions mask of an image.
+
+  Args:
+    image_path: String, path of the original input image.
+    output_directory: String, path to directory for outputs.
+    probability_map: Numpy float array of shape (height, width, num_classes),
+      from patch_probabilities_to_map().
+  """
+    predictions = numpy.argmax(probability_map, 2).astype(numpy.uint16)
+
+    orig_name_png = os.path.splitext(os.path.basename(image_path))[0] + '.png'
+    skimage.io.imsave(
+        os.path.join(output_directory,
+                     microscopeimagequality.constants.DENSE_PREDICTIONS_MASK_FORMAT % orig_name_png),
+        predictions)
+
+
+def save_dense_prediction_masks(model_ckpt_file, dataset, output_directory,
+                                patch_width, patch_stride, num_classes=11):
+    """Save a full resolution predictions mask for each image in a dataset.
+
+  Each mask pixel is the most probable class after averaging the predictions
+  of all the (overlapping) patches covering it.
+
+  Args:
+    model_ckpt_file: String, path to TensorFlow model checkpoint to load.
+    dataset: dataset_creation.Dataset of the images to evaluate.
+    output_directory: String, path to directory for outputs.
+    patch_width: Integer, width of image patches.
+    patch_stride: Integer, the spacing in pixels between patches.
+    num_classes: Integer, the number of classes the model predicts.
+  """
+    _check_model_directory(model_ckpt_file)
+
+    classifier = ImageQualityClassifier(model_ckpt_file, patch_width,
+                                        num_classes, patch_stride=patch_stride)
+
+    for i in range(dataset.num_examples):
+        image, _, image_path = dataset.get_sample(i, normalize=False)
+
+        _save_dense_prediction_mask(image_path, output_directory,
+                                    classifier.get_probability_map(image))
+
+def _check_model_directory(model_ckpt_file):
+    """Log a fatal error if the model checkpoint directory does not exist."""
+    model_directory = os.path.dirname(model_ckpt_file)
+    if not os.path.isdir(model_directory):
+        logging.fatal('Model checkpoint directory does not exist.')
 
 
 def build_tfrecord_from_pngs(image_globs_list, use_unlabeled_data, num_classes,
@@ -431,7 +957,8 @@ def build_tfrecord_from_pngs(image_globs_list, use_unlabeled_data, num_classes,
         shard_num=shard_num,
         num_shards=num_shards,
         normalize=False,
-        use_unlabeled_data=use_unlabeled_data
+        use_unlabeled_data=use_unlabeled_data,
+        encoding=microscopeimagequality.data_provider.ENCODING_RAW_FLOAT32
     )
 
     logging.info('Created TFRecord with %g examples.', num_samples_converted)
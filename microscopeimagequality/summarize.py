@@ -8,9 +8,13 @@ Example usage:
   microscopeimagequality summarize <path_to_eval_directory>
 """
 
+import collections
+import json
 import logging
+import multiprocessing
 import os
 import sys
+import tempfile
 
 import matplotlib
 import matplotlib.pyplot
@@ -27,7 +31,35 @@ logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 # Thickness of prediction border annotation, as fraction of image height.
 _BORDER_FRACTION = 0.08
 
-_FIG_WIDTH = 60
+# Maximum height and width of the images in summary montages, in pixels.
+_THUMBNAIL_SIZE = 512
+
+# Memory budget of the downsampled images kept for summary montages, in bytes.
+_THUMBNAIL_CACHE_MAX_BYTES = 256 * 1024 ** 2
+
+# Number of images in each row of the per-class summary montages.
+_NUM_MONTAGE_COLUMNS = 10
+
+# White space between images in summary montages, in pixels.
+_MONTAGE_SPACING = 4
+
+# Resolution of the certainty scatter plots, in dots per inch.
+_SCATTER_PLOT_DPI = 600
+
+# Scatter plot resolution and montage thumbnail size of the fast profile, which
+# also skips most plots in the additional plots folder.
+_FAST_SCATTER_PLOT_DPI = 150
+_FAST_THUMBNAIL_SIZE = 256
+
+# The thumbnails and names of save_summary_montages(), used by each worker of
+# its pool.
+_worker_thumbnail_cache = None
+_worker_orig_names = None
+_worker_valid_sizes = None
+
+# Name of the file, in the experiment folder, that persists the index of
+# annotated images.
+ANNOTATED_IMAGE_INDEX_FILENAME = 'annotated_image_index.json'
 
 
 def check_image_count_matches(experiment_path, num_images_expected):
@@ -135,7 +167,7 @@ def _get_alpha(count):
     return alpha
 
 
-def plot_certainties(certainties, predictions, num_classes, save_path):
+def plot_certainties(certainties, predictions, num_classes, save_path, dpi=_SCATTER_PLOT_DPI):
     """Generate scatter plots of certainties.
 
   Args:
@@ -144,6 +176,7 @@ def plot_certainties(certainties, predictions, num_classes, save_path):
     predictions: List of integer predictions in [0, num_classes).
     num_classes: Integer, total number of possible predicted classes.
     save_path: String, path to save the figure.
+    dpi: Integer, the resolution of the figure in dots per inch.
   """
     keys = sorted(certainties.keys())
     num_keys = len(keys)
@@ -161,10 +194,85 @@ def plot_certainties(certainties, predictions, num_classes, save_path):
                      numpy.min(certainties[k1]),
                      numpy.mean(certainties[k1]), numpy.max(certainties[k1]))
     matplotlib.pyplot.subplots_adjust(hspace=0.05, wspace=0.05)
-    matplotlib.pyplot.savefig(save_path, bbox_inches='tight', dpi=600)
+    matplotlib.pyplot.savefig(save_path, bbox_inches='tight', dpi=dpi)
 
 
-def _read_valid_part_of_annotated_image(experiment_path, orig_name):
+def _build_annotated_image_index(experiment_path):
+    """Maps each original image name to its annotated image and valid mask.
+
+  Args:
+    experiment_path: String, path to inference annotated output images.
+
+  Returns:
+    Dictionary mapping original filename without path and extension to a
+      dictionary with the 'annotated' and 'valid_mask' filenames. The mask
+      filename is None if no mask file exists.
+  """
+    all_files = os.listdir(experiment_path)
+    all_files_set = set(all_files)
+    orig_name_prefix = microscopeimagequality.constants.ORIG_IMAGE_FORMAT % ''
+    index = {}
+    for name in all_files:
+        # Masks are named by the original name only, so are excluded here.
+        if orig_name_prefix not in name or not name.endswith('.png'):
+            continue
+        orig_name = name.split(orig_name_prefix, 1)[1][:-len('.png')]
+        mask_filename = microscopeimagequality.constants.VALID_MASK_FORMAT % orig_name + '.png'
+        index[orig_name] = {
+            'annotated': name,
+            'valid_mask': mask_filename if mask_filename in all_files_set else None
+        }
+    return index
+
+
+def _save_annotated_image_index(experiment_path, index):
+    """Saves the annotated image index in the experiment folder, if writable.
+
+  The index is written to a temporary file, then renamed, so that concurrent
+  writers, e.g. the workers of save_summary_montages(), never leave a partial
+  file.
+  """
+    index_path = os.path.join(experiment_path, ANNOTATED_IMAGE_INDEX_FILENAME)
+    temporary_path = None
+    try:
+        file_descriptor, temporary_path = tempfile.mkstemp(suffix='.json', dir=experiment_path)
+        with os.fdopen(file_descriptor, 'w') as f:
+            json.dump(index, f)
+        os.rename(temporary_path, index_path)
+    except (IOError, OSError) as e:
+        logging.warning('Could not save annotated image index %s: %s', index_path, e)
+        if temporary_path is not None and os.path.isfile(temporary_path):
+            os.remove(temporary_path)
+
+
+def get_annotated_image_index(experiment_path):
+    """Gets the index of annotated images, reusing a saved index if present.
+
+  The index is built with a single directory listing and saved in the
+  experiment folder, so that repeated summaries do not list it again. Entries
+  of a saved index are checked as they are used, see
+  _read_valid_part_of_annotated_image.
+
+  Args:
+    experiment_path: String, path to inference annotated output images.
+
+  Returns:
+    Dictionary mapping original filename without path and extension to a
+      dictionary with the 'annotated' and 'valid_mask' filenames.
+  """
+    index_path = os.path.join(experiment_path, ANNOTATED_IMAGE_INDEX_FILENAME)
+    if os.path.isfile(index_path):
+        try:
+            with open(index_path, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            logging.warning('Ignoring invalid annotated image index %s', index_path)
+    index = _build_annotated_image_index(experiment_path)
+    _save_annotated_image_index(experiment_path, index)
+    return index
+
+
+def _read_valid_part_of_annotated_image(experiment_path, orig_name, index=None, valid_size=None):
     """Reads in an image and returns the valid region.
 
   The valid region defines the pixels over which the inference has been done.
@@ -173,6 +281,11 @@ def _read_valid_part_of_annotated_image(experiment_path, orig_name):
     experiment_path: String, path to inference annotated output images.
     orig_name: Original filename without path and extension of image to be
         found.
+    index: Dictionary, the index from get_annotated_image_index. If the image
+        is missing from it or its entry is stale, the index is rebuilt in
+        place. If None, a new index is built for this image only.
+    valid_size: The (height, width) of the valid region, from the inference
+        results. If None or negative, the region is read from the mask file.
 
   Returns:
     An image as a numpy array, with the valid region only if a mask file
@@ -181,28 +294,31 @@ def _read_valid_part_of_annotated_image(experiment_path, orig_name):
   Raises:
       ValueError: If the image is not found.
   """
-    filename_index = None
-    all_files = os.listdir(experiment_path)
-    # Find the annotated image file. There is exactly one.
-    for index, name in enumerate(all_files):
-        # Exclude all masks from search.
-        if (microscopeimagequality.constants.ORIG_IMAGE_FORMAT + '.png') % orig_name in name:
-            filename_index = index
-    if filename_index is None:
+    if index is None:
+        index = _build_annotated_image_index(experiment_path)
+    entry = index.get(orig_name)
+    if entry is None or not os.path.isfile(os.path.join(experiment_path, entry['annotated'])):
+        logging.info('Annotated image index is out of date, rebuilding.')
+        index.clear()
+        index.update(_build_annotated_image_index(experiment_path))
+        _save_annotated_image_index(experiment_path, index)
+        entry = index.get(orig_name)
+    if entry is None:
         raise ValueError('File %s not found' % orig_name)
-    annotated_filename = all_files[filename_index]
 
-    image = skimage.io.imread(os.path.join(experiment_path, annotated_filename))
+    image = skimage.io.imread(os.path.join(experiment_path, entry['annotated']))
+
+    if valid_size is not None and min(valid_size) >= 0:
+        return image[:valid_size[0], :valid_size[1]]
 
-    mask_path = os.path.join(experiment_path, microscopeimagequality.constants.VALID_MASK_FORMAT % orig_name + '.png')
+    if entry['valid_mask'] is None:
+        logging.info('No mask found for %s', orig_name)
+        return image
 
-    # if not os.path.isdir(mask_path):
-    #     logging.info('No mask found at %s', mask_path)
-    # else:
-    mask = skimage.io.imread(mask_path)
+    mask = skimage.io.imread(os.path.join(experiment_path, entry['valid_mask']))
     # Get the upper-left crop that is valid (where mask > 0).
-    max_valid_row = numpy.argwhere(numpy.sum(mask, 1))[-1][0]
-    max_valid_column = numpy.argwhere(numpy.sum(mask, 0))[-1][0]
+    max_valid_row = numpy.argwhere(numpy.sum(mask, 1))[-1][0] + 1
+    max_valid_column = numpy.argwhere(numpy.sum(mask, 0))[-1][0] + 1
     image = image[:max_valid_row, :max_valid_column]
 
     return image
@@ -238,13 +354,59 @@ def _save_color_legend(num_classes, path):
     matplotlib.pyplot.close()
 
 
+def _render_plot(function_and_args):
+    """Calls a plotting function, then closes all its figures.
+
+  Args:
+    function_and_args: Tuple of a module-level function and its arguments.
+
+  Returns:
+    The return value of the function.
+  """
+    function, args = function_and_args
+    try:
+        return function(*args)
+    finally:
+        matplotlib.pyplot.close('all')
+
+
+def _render_plots(plots, num_workers=None, initializer=None, initargs=()):
+    """Renders independent plots, in a process pool if num_workers is not None.
+
+  Args:
+    plots: List of (function, arguments) tuples, as in _render_plot.
+    num_workers: Integer, if not None, the number of processes rendering the
+      plots concurrently.
+    initializer: If not None, function called with initargs before rendering,
+      in each process.
+    initargs: Tuple, the arguments of initializer.
+
+  Returns:
+    List of the return values of the plotting functions, in order.
+  """
+    if num_workers is None:
+        if initializer is not None:
+            initializer(*initargs)
+        return [_render_plot(plot) for plot in plots]
+
+    pool = multiprocessing.Pool(num_workers, initializer=initializer, initargs=initargs)
+    try:
+        return pool.map(_render_plot, plots, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def save_histograms_scatter_plots_and_csv(probabilities,
                                           labels,
                                           certainties,
                                           orig_names,
                                           predictions,
                                           output_path,
-                                          output_path_all_plots=None):
+                                          output_path_all_plots=None,
+                                          valid_sizes=None,
+                                          num_workers=None,
+                                          fast=False):
     """Visualize and save various summary plots and an aggregated .csv file.
 
   Args:
@@ -257,6 +419,13 @@ def save_histograms_scatter_plots_and_csv(probabilities,
       num_samples.
     output_path: String, path to folder to save summary results.
     output_path_all_plots: String, path to folder to save less useful results.
+    valid_sizes: Integer array of shape [num_samples x 2], the (height, width)
+      of the valid region of each image, or None if unknown.
+    num_workers: Integer, if not None, the number of processes rendering the
+      plots concurrently.
+    fast: Boolean, whether to save the scatter plot at a lower resolution, and
+      skip the scatter plot of all certainties and the histograms of all
+      certainties but the aggregate one.
   """
     if output_path_all_plots is None:
         output_path_all_plots = output_path
@@ -264,45 +433,53 @@ def save_histograms_scatter_plots_and_csv(probabilities,
     logging.info('Saving inference results in single .csv file.')
     microscopeimagequality.evaluation.save_inference_results(probabilities, labels, certainties,
                                       orig_names, predictions,
-                                      os.path.join(output_path, 'results_all.csv'))
-
-    logging.info('Generating simple result plot.')
-    save_confusion = not numpy.any(numpy.array(labels) < 0)
-    microscopeimagequality.evaluation.save_result_plots(probabilities, labels, save_confusion,
-                                 output_path_all_plots)
+                                      os.path.join(output_path, 'results_all.csv'),
+                                      valid_sizes)
 
     predictions = numpy.array(predictions)
     num_classes = probabilities.shape[1]
+    dpi = _FAST_SCATTER_PLOT_DPI if fast else _SCATTER_PLOT_DPI
 
-    _save_color_legend(num_classes, os.path.join(output_path, 'color_legend.png'))
-
-    plot_certainties(certainties, predictions, num_classes,
-                     os.path.join(output_path_all_plots,
-                                  'certainty_scatter_plot_all_certainties.png'))
+    # Each plot is independent of the others.
+    save_confusion = not numpy.any(numpy.array(labels) < 0)
+    plots = [
+        (microscopeimagequality.evaluation.save_result_plots,
+         (probabilities, labels, save_confusion, output_path_all_plots)),
+        (_save_color_legend, (num_classes, os.path.join(output_path, 'color_legend.png')))
+    ]
+
+    if not fast:
+        plots.append((plot_certainties,
+                      (certainties, predictions, num_classes,
+                       os.path.join(output_path_all_plots,
+                                    'certainty_scatter_plot_all_certainties.png'), dpi)))
 
     certainties_subset = {k: certainties[k] for k in ['mean', 'aggregate']}
-    plot_certainties(certainties_subset, predictions, num_classes,
-                     os.path.join(output_path, 'certainty_scatter_plot.png'))
+    plots.append((plot_certainties,
+                  (certainties_subset, predictions, num_classes,
+                   os.path.join(output_path, 'certainty_scatter_plot.png'), dpi)))
 
     # Generate and save histograms for predictions and certainties.
 
-    microscopeimagequality.evaluation.save_prediction_histogram(
-        predictions,
-        os.path.join(output_path, 'histogram_predictions.jpg'), num_classes)
-    microscopeimagequality.evaluation.save_prediction_histogram(
-        predictions,
-        os.path.join(output_path, 'histogram_predictions_log.jpg'),
-        num_classes,
-        log=True)
+    plots.append((microscopeimagequality.evaluation.save_prediction_histogram,
+                  (predictions, os.path.join(output_path, 'histogram_predictions.jpg'), num_classes)))
+    plots.append((microscopeimagequality.evaluation.save_prediction_histogram,
+                  (predictions, os.path.join(output_path, 'histogram_predictions_log.jpg'),
+                   num_classes, True)))
 
     for kind in microscopeimagequality.evaluation.CERTAINTY_TYPES.values():
         if kind == 'aggregate':
             path = output_path
+        elif fast:
+            continue
         else:
             path = output_path_all_plots
-        _plot_histogram(certainties[kind], '%s prediction certainty' % kind,
-                        'image count',
-                        os.path.join(path, 'histogram_%s_certainty.jpg' % kind))
+        plots.append((_plot_histogram,
+                      (certainties[kind], '%s prediction certainty' % kind, 'image count',
+                       os.path.join(path, 'histogram_%s_certainty.jpg' % kind))))
+
+    logging.info('Generating %d result plots.', len(plots))
+    _render_plots(plots, num_workers)
 
     logging.info('Done summarizing results')
 
@@ -359,15 +536,303 @@ def _rank_examples(indices, rank_method, certainties, predictions,
     return indices
 
 
+def _downsample_image(image, max_size):
+    """Downsamples an image by an integer factor, averaging blocks of pixels.
+
+  Args:
+    image: Numpy array of shape [height x width] or [height x width x
+      channels].
+    max_size: Integer, the maximum height and width of the result.
+
+  Returns:
+    The downsampled image as a numpy array of the same dtype.
+  """
+    factor = int(numpy.ceil(float(max(image.shape[:2])) / max_size))
+    if factor <= 1:
+        return image
+    height = image.shape[0] // factor
+    width = image.shape[1] // factor
+    blocks = image[:height * factor, :width * factor].reshape(
+        (height, factor, width, factor) + image.shape[2:])
+    return numpy.round(blocks.mean(axis=(1, 3))).astype(image.dtype)
+
+
+class ThumbnailCache(object):
+    """Downsampled annotated images, least recently used first out.
+
+  Each annotated image is decoded and downsampled once, and kept until the
+  total size of the kept images exceeds the memory budget.
+  """
+
+    def __init__(self, experiment_path, index=None, thumbnail_size=_THUMBNAIL_SIZE,
+                 max_bytes=_THUMBNAIL_CACHE_MAX_BYTES):
+        """Create a cache of thumbnails.
+
+    Args:
+      experiment_path: String, path to inference annotated output images.
+      index: Dictionary, the index from get_annotated_image_index. If None, it
+        is loaded or built.
+      thumbnail_size: Integer, the maximum height and width of the thumbnails.
+      max_bytes: Integer, the memory budget of the thumbnails, in bytes. The
+        most recently used thumbnail is kept even if it is larger.
+    """
+        self._experiment_path = experiment_path
+        self._index = get_annotated_image_index(experiment_path) if index is None else index
+        self._thumbnail_size = thumbnail_size
+        self._max_bytes = max_bytes
+        self._thumbnails = collections.OrderedDict()
+        self.num_bytes = 0
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def __len__(self):
+        return len(self._thumbnails)
+
+    def get(self, orig_name, valid_size=None):
+        """Get the thumbnail of the valid part of an annotated RGB image.
+
+    Args:
+      orig_name: Original filename without path and extension of the image.
+      valid_size: The (height, width) of the valid region, as in
+        _read_valid_part_of_annotated_image.
+
+    Returns:
+      A read-only uint8 numpy array of shape [height x width x 3].
+    """
+        if orig_name in self._thumbnails:
+            self.num_hits += 1
+            # Move to the end, the most recently used.
+            thumbnail = self._thumbnails.pop(orig_name)
+            self._thumbnails[orig_name] = thumbnail
+            return thumbnail
+
+        self.num_misses += 1
+        image = _read_valid_part_of_annotated_image(self._experiment_path, orig_name,
+                                                    self._index, valid_size)
+        if image.ndim == 2:
+            image = numpy.dstack([image] * 3)
+        thumbnail = _downsample_image(image[:, :, :3], self._thumbnail_size)
+        thumbnail.flags.writeable = False
+
+        self._thumbnails[orig_name] = thumbnail
+        self.num_bytes += thumbnail.nbytes
+        while self.num_bytes > self._max_bytes and len(self._thumbnails) > 1:
+            _, evicted = self._thumbnails.popitem(last=False)
+            self.num_bytes -= evicted.nbytes
+        return thumbnail
+
+
+def _make_montage_image(images, num_rows, num_columns):
+    """Arrange images in a grid on a white background.
+
+  Args:
+    images: List of (row, column, image) tuples, with uint8 RGB images as numpy
+      arrays. Each image is centered in its grid cell, which fits the largest
+      image.
+    num_rows: Integer, the number of rows in the grid.
+    num_columns: Integer, the number of columns in the grid.
+
+  Returns:
+    The montage as a uint8 numpy array of shape [height x width x 3].
+  """
+    cell_height = max([image.shape[0] for _, _, image in images] or [1])
+    cell_width = max([image.shape[1] for _, _, image in images] or [1])
+    montage = numpy.full(
+        (num_rows * (cell_height + _MONTAGE_SPACING) - _MONTAGE_SPACING,
+         num_columns * (cell_width + _MONTAGE_SPACING) - _MONTAGE_SPACING, 3),
+        255, dtype=numpy.uint8)
+    for row, column, image in images:
+        top = row * (cell_height + _MONTAGE_SPACING) + (cell_height - image.shape[0]) // 2
+        left = column * (cell_width + _MONTAGE_SPACING) + (cell_width - image.shape[1]) // 2
+        montage[top:top + image.shape[0], left:left + image.shape[1]] = image
+    return montage
+
+
+def _get_class_rank_montage_tiles(rank_method, certainties, predictions, num_classes,
+                                  num_per_class=_NUM_MONTAGE_COLUMNS):
+    """Get the tiles of a montage of select images per class ranked by a method.
+
+  Args:
+    rank_method: String, the ranking method, as in _rank_examples.
+    certainties: Numpy array of floats, the certainties.
+    predictions: 1D numpy array of the predicted class indices.
+    num_classes: Integer, the number of classes, one row each.
+    num_per_class: Integer, the maximum number of images per class.
+
+  Returns:
+    List of (row, column, sample index, label intensity) tuples.
+  """
+    tiles = []
+    for i in range(num_classes):
+        class_indices = numpy.arange(predictions.shape[0])[predictions == i]
+        num_plots_in_row = min(class_indices.shape[0], num_per_class)
+        if num_plots_in_row == 0:
+            continue
+        class_indices = _rank_examples(class_indices, rank_method, certainties,
+                                       predictions, num_plots_in_row, i)
+        for j in range(num_plots_in_row):
+            tiles.append((i, j, class_indices[j], certainties[class_indices[j]]))
+    return tiles
+
+
+def _get_class_bin_montage_tiles(certainties, predictions, num_classes,
+                                 bins_per_class=_NUM_MONTAGE_COLUMNS):
+    """Get the tiles of a montage of one image per certainty bin for each class.
+
+  Args:
+    certainties: Numpy array of floats in [0.0, 1.0], the certainties.
+    predictions: 1D numpy array of the predicted class indices.
+    num_classes: Integer, the number of classes, one row each.
+    bins_per_class: Integer, the number of certainty bins, one column each.
+
+  Returns:
+    List of (row, column, sample index, label intensity) tuples.
+  """
+    certainties = numpy.asarray(certainties)
+    boundaries = numpy.linspace(0.0, 1.0, bins_per_class + 1)
+    tiles = []
+    for i in range(num_classes):
+        for j in range(bins_per_class):
+            mask = (predictions == i) & (certainties >= boundaries[j]) & (
+                certainties < boundaries[j + 1])
+            bin_indices = numpy.arange(predictions.shape[0])[mask]
+            if bin_indices.shape[0] == 0:
+                continue
+            # Use the approximate median value in the bin.
+            bin_indices = bin_indices[numpy.argsort(certainties[mask])]
+            index = bin_indices[len(bin_indices) // 2]
+            tiles.append((i, j, index, certainties[index]))
+    return tiles
+
+
+def _get_first_several_montage_tiles(num_subplots, sorted_indices):
+    """Get the tiles of a montage of the first num_subplots^2 images.
+
+  Args:
+    num_subplots: Integer, the number of rows and columns.
+    sorted_indices: 1D numpy array of the sample indices to montage, in order.
+
+  Returns:
+    List of (row, column, sample index, label intensity) tuples.
+  """
+    num_tiles = min(num_subplots ** 2, len(sorted_indices))
+    return [(i // num_subplots, i % num_subplots, sorted_indices[i], 1.0)
+            for i in range(num_tiles)]
+
+
+def _get_summary_montages(certainties, predictions, num_classes, output_path,
+                          output_path_all_plots, include_all_plots=True):
+    """Get the tiles of all summary montages.
+
+  Args:
+    certainties: Dict of numpy arrays of floats, the certainties.
+    predictions: 1D numpy array of the predicted class indices.
+    num_classes: Integer, the number of classes.
+    output_path: String, path to folder to save summary results.
+    output_path_all_plots: String, path to folder to save less useful results.
+    include_all_plots: Boolean, if False, only the montages saved in
+      output_path are included.
+
+  Returns:
+    List of (tiles, number of rows, number of columns, path) tuples, one per
+    montage, with tiles as returned by _get_class_rank_montage_tiles.
+  """
+    def class_rank(rank_method, certainties):
+        return (_get_class_rank_montage_tiles(rank_method, certainties, predictions, num_classes),
+                num_classes, _NUM_MONTAGE_COLUMNS,
+                os.path.join(output_path_all_plots, 'rank_%s.jpg' % rank_method))
+
+    def first_several(sorted_indices, name):
+        width = min(len(sorted_indices), 8)
+        return (_get_first_several_montage_tiles(width, sorted_indices), width, width,
+                os.path.join(output_path_all_plots, '%s.jpg' % name))
+
+    montages = [class_rank('random', certainties['mean'])] if include_all_plots else []
+    for kind in microscopeimagequality.evaluation.CERTAINTY_TYPES.values():
+        kind_certainties = numpy.asarray(certainties[kind])
+        rank_method = '%s_certainty_least_to_most' % kind
+        if rank_method == 'aggregate_certainty_least_to_most':
+            path = output_path
+        elif include_all_plots:
+            path = output_path_all_plots
+        else:
+            continue
+        montages.append((_get_class_bin_montage_tiles(kind_certainties, predictions, num_classes),
+                         num_classes, _NUM_MONTAGE_COLUMNS,
+                         os.path.join(path, 'bin_%s.jpg' % rank_method)))
+        if not include_all_plots:
+            continue
+        for rank in ['least', 'most', 'least_to_most']:
+            montages.append(class_rank('%s_certainty_%s' % (kind, rank), kind_certainties))
+        indices = numpy.argsort(kind_certainties)
+        montages.append(first_several(indices, 'least_%s_certainty' % kind))
+        montages.append(first_several(indices[::-1], 'most_%s_certainty' % kind))
+    return montages
+
+
+def _save_montage(tiles, num_rows, num_columns, path, orig_names, thumbnail_cache,
+                  valid_sizes=None):
+    """Compose a montage from the thumbnails of annotated images, and save it.
+
+  Args:
+    tiles: List of (row, column, sample index, label intensity) tuples.
+    num_rows: Integer, the number of rows in the montage.
+    num_columns: Integer, the number of columns in the montage.
+    path: String, path to save the montage.
+    orig_names: List of strings, the original names of all samples.
+    thumbnail_cache: ThumbnailCache of the annotated images.
+    valid_sizes: Integer array of shape [num_samples x 2], or None, as in
+      save_summary_montages.
+
+  Returns:
+    List of strings, the lines mapping each tile to its original image path.
+  """
+    images = []
+    lines = []
+    for row, column, index, label_intensity in tiles:
+        orig_name = os.path.splitext(os.path.basename(orig_names[index]))[0]
+        valid_size = None if valid_sizes is None else valid_sizes[index]
+        image = numpy.array(thumbnail_cache.get(orig_name, valid_size))
+        images.append((row, column, _adjust_image_annotation(image, label_intensity)))
+        lines.append('%d, %d %s\n' % (row, column, orig_names[index]))
+    skimage.io.imsave(path, _make_montage_image(images, num_rows, num_columns))
+    return lines
+
+
+def _init_montage_worker(experiment_path, index, thumbnail_size, thumbnail_cache_bytes,
+                         orig_names, valid_sizes):
+    """Sets the thumbnails and names of save_summary_montages(), in each worker."""
+    global _worker_thumbnail_cache, _worker_orig_names, _worker_valid_sizes
+    _worker_thumbnail_cache = ThumbnailCache(experiment_path, index, thumbnail_size,
+                                             thumbnail_cache_bytes)
+    _worker_orig_names = orig_names
+    _worker_valid_sizes = valid_sizes
+
+
+def _save_worker_montage(tiles, num_rows, num_columns, path):
+    """Saves a montage with the thumbnails of the worker, see _save_montage."""
+    logging.info('Saving montage %s.', path)
+    return _save_montage(tiles, num_rows, num_columns, path, _worker_orig_names,
+                         _worker_thumbnail_cache, _worker_valid_sizes)
+
+
 def save_summary_montages(probabilities,
                           certainties,
                           orig_names,
                           predictions,
                           experiment_path,
                           output_path,
-                          output_path_all_plots=None):
+                          output_path_all_plots=None,
+                          valid_sizes=None,
+                          thumbnail_size=_THUMBNAIL_SIZE,
+                          thumbnail_cache_bytes=_THUMBNAIL_CACHE_MAX_BYTES,
+                          num_workers=None,
+                          fast=False):
     """Visualize and save summary montage images.
 
+  Each annotated image is decoded and downsampled once into a bounded cache,
+  and the montages are composed from these thumbnails.
+
   Args:
     probabilities: Numpy float array of shape [num_samples x num_classes].
     certainties: Dict of lists of floats, the certainties, each length
@@ -378,12 +843,38 @@ def save_summary_montages(probabilities,
     experiment_path: String, path to folder containing results.
     output_path: String, path to folder to save summary results.
     output_path_all_plots: String, path to folder to save less useful results.
+    valid_sizes: Integer array of shape [num_samples x 2], the (height, width)
+      of the valid region of each image. Where unknown (None or negative), the
+      region is read from the valid mask of the image.
+    thumbnail_size: Integer, the maximum height and width of each image in the
+      montages.
+    thumbnail_cache_bytes: Integer, the memory budget of the thumbnails kept
+      for reuse across montages, in bytes, shared by all workers.
+    num_workers: Integer, if not None, the number of processes saving the
+      montages concurrently, each with its own thumbnails.
+    fast: Boolean, whether to use smaller thumbnails and only save the
+      montages in output_path.
   """
     if output_path_all_plots is None:
         output_path_all_plots = output_path
+    if fast:
+        thumbnail_size = min(thumbnail_size, _FAST_THUMBNAIL_SIZE)
+    if num_workers is not None:
+        thumbnail_cache_bytes //= num_workers
 
     predictions = numpy.array(predictions)
-    num_samples, num_classes = probabilities.shape
+    num_classes = probabilities.shape[1]
+
+    # Look up annotated images by name, rather than listing the folder each time.
+    annotated_image_index = get_annotated_image_index(experiment_path)
+
+    montages = _get_summary_montages(certainties, predictions, num_classes, output_path,
+                                     output_path_all_plots, include_all_plots=not fast)
+    lines = _render_plots(
+        [(_save_worker_montage, montage) for montage in montages], num_workers,
+        initializer=_init_montage_worker,
+        initargs=(experiment_path, annotated_image_index, thumbnail_size,
+                  thumbnail_cache_bytes, orig_names, valid_sizes))
 
     with open(
             os.path.join(output_path_all_plots, 'montage_image_paths.txt'), 'w') as f:
@@ -392,105 +883,8 @@ def save_summary_montages(probabilities,
                  '# original image path. Subplots are denoted by 0-indexed row \n'
                  '# and column from upper left.\n\n'))
 
-        def plot_image(index, label_intensity=1.0):
-            """Read and plot inference image."""
-
-            orig_name = os.path.splitext(os.path.basename(orig_names[index]))[0]
-            f.write('%s\n' % orig_names[index])
-            image = _read_valid_part_of_annotated_image(experiment_path, orig_name)
-
-            image = _adjust_image_annotation(image, label_intensity)
-
-            matplotlib.pyplot.imshow(image)
-            matplotlib.pyplot.tick_params(labelbottom=False, labelleft=False)
-            matplotlib.pyplot.grid('off')
-            matplotlib.pyplot.axis('off')
-
-        def subplot(nrows, ncols, num):
-            """Makes a subplot and logs the (row, column) with 0-indexing."""
-            matplotlib.pyplot.subplot(nrows, ncols, num)
-            f.write('%d, %d ' % ((num - 1) / ncols, (num - 1) % ncols))
-
-        def savefig(path):
-            """Saves figure and logs the path."""
-            matplotlib.pyplot.subplots_adjust(hspace=0.01, wspace=0.01)
-            matplotlib.pyplot.savefig(path, bbox_inches='tight')
-            matplotlib.pyplot.close()
+        for montage_lines, (_, _, _, path) in zip(lines, montages):
+            f.writelines(montage_lines)
             f.write('%s\n\n' % path)
 
-        def setup_new_montage_figure(nrows, ncols):
-            """New figure with blank subplot at corners to fix figure shape."""
-            matplotlib.pyplot.figure(figsize=(_FIG_WIDTH, _FIG_WIDTH))
-            matplotlib.pyplot.subplot(nrows, ncols, 1)
-            matplotlib.pyplot.axis('off')
-            matplotlib.pyplot.subplot(nrows, ncols, nrows * ncols)
-            matplotlib.pyplot.axis('off')
-
-        def montage_by_class_rank(rank_method, certainties, num_per_class=10):
-            """Montage select images per class ranked by a particular method."""
-            setup_new_montage_figure(num_classes, num_per_class)
-            for i in range(num_classes):
-                class_indices = numpy.array(range(num_samples))[predictions == i]
-                num_plots_in_row = min(class_indices.shape[0], num_per_class)
-                if num_plots_in_row == 0:
-                    continue
-                class_indices = _rank_examples(class_indices, rank_method, certainties,
-                                               predictions, num_plots_in_row, i)
-                for j in range(num_plots_in_row):
-                    subplot(num_classes, num_per_class, 1 + i * num_per_class + j)
-                    plot_image(class_indices[j], certainties[class_indices[j]])
-            savefig(os.path.join(output_path_all_plots, 'rank_%s.jpg' % rank_method))
-
-        def montage_by_class_bin(rank_method, certainties, bins_per_class=10):
-            """Montage one image per certainty bin for each class."""
-            boundaries = numpy.linspace(0.0, 1.0, bins_per_class + 1)
-            setup_new_montage_figure(num_classes, bins_per_class)
-            for i in range(num_classes):
-                for j in range(bins_per_class):
-                    mask = (predictions == i) & (certainties >= boundaries[j]) & (
-                        certainties < boundaries[j + 1])
-                    bin_indices = numpy.array(range(num_samples))[mask]
-                    bin_certainties = numpy.array(certainties)[mask]
-                    if bin_indices.shape[0] == 0:
-                        continue
-                    # Use the approximate median value in the bin.
-                    bin_indices = bin_indices[numpy.argsort(bin_certainties)]
-                    index = bin_indices[len(bin_indices) // 2]
-                    subplot(num_classes, bins_per_class, 1 + i * bins_per_class + j)
-                    plot_image(index, certainties[index])
-            if rank_method == 'aggregate_certainty_least_to_most':
-                path = output_path
-            else:
-                path = output_path_all_plots
-            savefig(os.path.join(path, 'bin_%s.jpg' % rank_method))
-
-        def montage_by_certainty(certainties, kind):
-            montage_by_class_bin('%s_certainty_least_to_most' % kind, certainties)
-            montage_by_class_rank('%s_certainty_least' % kind, certainties)
-            montage_by_class_rank('%s_certainty_most' % kind, certainties)
-            montage_by_class_rank('%s_certainty_least_to_most' % kind, certainties)
-
-        def montage_first_several(num_subplots, sorted_indices, name):
-            """Montages the first num_subplots^2 images."""
-            setup_new_montage_figure(num_subplots, num_subplots)
-            for i in range(num_subplots):
-                for j in range(num_subplots):
-                    if i * num_subplots + j < len(sorted_indices):
-                        subplot(num_subplots, num_subplots, 1 + i * num_subplots + j)
-                        plot_image(sorted_indices[i * num_subplots + j])
-            savefig(os.path.join(output_path_all_plots, '%s.jpg' % name))
-
-        def plot_most_least_certain(certainties, kind):
-            indices = numpy.argsort(certainties)
-            width = min(len(certainties), 8)
-            montage_first_several(width, indices, 'least_%s_certainty' % kind)
-            montage_first_several(width, indices[::-1], 'most_%s_certainty' % kind)
-
-        # Now actually generate the montages.
-        montage_by_class_rank('random', certainties['mean'])
-        for certainty in microscopeimagequality.evaluation.CERTAINTY_TYPES.values():
-            logging.info('Generating montages for certainty type: %s.', certainty)
-            montage_by_certainty(certainties[certainty], certainty)
-            plot_most_least_certain(certainties[certainty], certainty)
-
     logging.info('Done saving summary montages.')
@@ -1,6 +1,7 @@
 from __future__ import print_function
 
 import logging
+import multiprocessing.pool
 import os
 import sys
 
@@ -31,31 +32,44 @@ def check_duplicate_image_name(image_paths):
     logging.info('Found no duplicates in %d images.', num_images)
 
 
-def check_image_dimensions(image_paths, image_height, image_width):
+def check_image_dimensions(image_paths, image_height, image_width, num_workers=None):
     """
     Check that the image dimensions are valid.
 
-    A valid image has height and width no smaller than the specified height, width.
+    A valid image has height and width no smaller than the specified height, width. Only the image headers are read,
+    and all images are checked before any bad images are reported, including images that can't be read.
 
     Args:
     image_paths: List of strings, paths to images.
     image_height: Integer, height of image.
     image_width: Integer, width of image.
+    num_workers: Integer, if not None, the number of threads reading image headers concurrently.
 
     Raises:
     ValueError: If there is an invalid image dimension
     """
     logging.info('Using image height, width %s', str((image_height, image_width)))
 
-    bad_images = []
+    if num_workers is None:
+        pool = None
+        image_shapes = (_read_image_shape(path) for path in image_paths)
+    else:
+        pool = multiprocessing.pool.ThreadPool(num_workers)
+        image_shapes = pool.imap(_read_image_shape, image_paths, chunksize=64)
 
-    for path in image_paths:
-        logging.info('Trying to read image %s', path)
-        image = microscopeimagequality.dataset_creation.read_16_bit_greyscale(path)
+    bad_images = []
 
-        if image.shape[0] < image_height or image.shape[1] < image_width:
-            bad_images.append(path)
-            logging.info('Image %s dimension %s is too small.', path, str(image.shape))
+    try:
+        for path, image_shape in zip(image_paths, image_shapes):
+            if image_shape is None:
+                bad_images.append(path)
+            elif image_shape[0] < image_height or image_shape[1] < image_width:
+                bad_images.append(path)
+                logging.info('Image %s dimension %s is too small.', path, str(image_shape))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     logging.info('Done checking images')
 
@@ -63,3 +77,22 @@ def check_image_dimensions(image_paths, image_height, image_width):
 
     if bad_images:
         raise ValueError('Found %d bad images! \n %s' % (len(bad_images), '\n'.join(bad_images)))
+
+
+def _read_image_shape(path):
+    """
+    Read the height and width of an image from its header.
+
+    Args:
+    path: String, path to image.
+
+    Returns:
+    A tuple of height, width, or None if the image can't be read.
+    """
+    logging.debug('Trying to read image %s', path)
+
+    try:
+        return microscopeimagequality.dataset_creation.read_image_shape(path)
+    except Exception as e:
+        logging.info('Image %s could not be read: %s', path, e)
+        return None
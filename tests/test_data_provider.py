@@ -8,6 +8,8 @@ import tensorflow
 import tensorflow.contrib.slim
 
 import microscopeimagequality.data_provider
+import microscopeimagequality.dataset_creation
+import microscopeimagequality.degrade
 
 TFRECORD_NUM_ENTRIES = 33
 
@@ -266,3 +268,110 @@ def test_provide_data_with_deterministic_ordering():
             save16_bit_png("first_tile_per_batch_%g.png" % i, im)
 
         numpy.testing.assert_array_equal(image_classes, TFRECORD_LABEL_ORDERING[0:num_batches_tested])
+
+
+def test_get_split_decodes_all_encodings():
+    image_path = os.path.join(input_directory, "BBBC006_z_aligned__a01__s1__w1_10.png")
+    labels = numpy.array([[0.0, 1.0]], dtype=numpy.float32)
+    encodings = [microscopeimagequality.data_provider.ENCODING_FLOAT_LIST,
+                 microscopeimagequality.data_provider.ENCODING_RAW_FLOAT32,
+                 microscopeimagequality.data_provider.ENCODING_RAW_UINT16,
+                 microscopeimagequality.data_provider.ENCODING_PNG]
+    images = []
+    for encoding in encodings:
+        file_pattern = os.path.join(test_dir, "data_" + encoding + "_%s.tfrecord")
+        microscopeimagequality.dataset_creation.convert_to_examples(
+            microscopeimagequality.dataset_creation.Dataset(labels, [image_path], image_width, image_height),
+            output_directory=test_dir,
+            output_tfrecord_filename=os.path.basename(file_pattern % "test"),
+            randomize=False,
+            normalize=False,
+            encoding=encoding
+        )
+        g = tensorflow.Graph()
+        with g.as_default():
+            dataset = microscopeimagequality.data_provider.get_split("test", file_pattern, num_classes=2, image_width=image_width, image_height=image_height)
+            provider = tensorflow.contrib.slim.dataset_data_provider.DatasetDataProvider(dataset, shuffle=False)
+            [image] = provider.get([microscopeimagequality.data_provider.FEATURE_IMAGE])
+            sess = get_tf_session(g)
+            images.append(sess.run(image))
+
+    assert (image_height, image_width, 1) == images[0].shape
+    for image in images[1:]:
+        numpy.testing.assert_allclose(images[0], image, atol=0.5 / 65535)
+
+
+def test_get_shard_filename():
+    path = microscopeimagequality.data_provider.get_shard_filename("/folder/filename.tfrecord", 1, 4)
+    assert "/folder/filename-00001-of-00004.tfrecord" == path
+
+
+def test_get_num_records_from_manifest():
+    tf_record_path = os.path.join(test_dir, "sharded.tfrecord")
+    with open(microscopeimagequality.data_provider.get_filename_manifest(tf_record_path), "w") as f:
+        f.write('{"num_records": 5, "shards": [{"path": "sharded-00000-of-00002.tfrecord", "num_records": 3}, '
+                '{"path": "sharded-00001-of-00002.tfrecord", "num_records": 2}]}')
+
+    assert 5 == microscopeimagequality.data_provider.get_num_records(tf_record_path)
+    assert [os.path.join(test_dir, "sharded-00000-of-00002.tfrecord"),
+            os.path.join(test_dir, "sharded-00001-of-00002.tfrecord")] == microscopeimagequality.data_provider.get_data_sources(tf_record_path)
+
+
+def test_provide_data_deterministic_with_parallel_calls():
+    g = tensorflow.Graph()
+    with g.as_default():
+        _, _, image_paths, num_samples = microscopeimagequality.data_provider.provide_data(tfrecord_file_pattern, split_name="train", batch_size=patches_per_image, num_classes=3, image_width=image_width, image_height=image_height, patch_width=28, randomize=False, num_threads=4, deterministic=True)
+
+        assert TFRECORD_NUM_ENTRIES == num_samples
+
+        with tensorflow.Session() as sess:
+            [np_image_paths] = sess.run([image_paths])
+
+        assert "image_000" == os.path.basename(np_image_paths[0][0])
+
+
+def test_apply_blur_kernels_matches_degrade():
+    images = numpy.random.RandomState(0).rand(2, 30, 40, 1).astype(numpy.float32)
+    kernels = numpy.random.RandomState(1).rand(2, 5, 7).astype(numpy.float32)
+
+    g = tensorflow.Graph()
+    with g.as_default():
+        blurred_images = microscopeimagequality.data_provider.apply_blur_kernels(tensorflow.constant(images), tensorflow.constant(kernels))
+
+        with tensorflow.Session() as sess:
+            np_blurred_images = sess.run(blurred_images)
+
+    assert images.shape == np_blurred_images.shape
+    for image, kernel, blurred_image in zip(images, kernels, np_blurred_images):
+        expected_image = microscopeimagequality.degrade.ImageDegrader.apply_blur_kernel(image[:, :, 0], kernel)
+        numpy.testing.assert_allclose(expected_image, blurred_image[:, :, 0], atol=1e-5)
+
+
+def test_apply_exposure_matches_degrade():
+    image = numpy.random.RandomState(0).rand(10, 10).astype(numpy.float32)
+    degrader = microscopeimagequality.degrade.ImageDegrader(photoelectron_factor=65535.0, sensor_offset_in_photoelectrons=100.0)
+
+    g = tensorflow.Graph()
+    with g.as_default():
+        adjusted_image = microscopeimagequality.data_provider.apply_exposure(tensorflow.constant(image), 2.0, 65535.0, 100.0)
+
+        with tensorflow.Session() as sess:
+            np_adjusted_image = sess.run(adjusted_image)
+
+    numpy.testing.assert_allclose(degrader.set_exposure(image, 2.0), np_adjusted_image, atol=1e-6)
+
+
+def test_provide_data_with_defocus_psfs():
+    defocus_psfs = microscopeimagequality.degrade.get_airy_psf_stack([0.0, 2e-6, 4e-6, 6e-6], psf_width_pixels=11)
+
+    g = tensorflow.Graph()
+    with g.as_default():
+        images, one_hot_labels, _, _ = microscopeimagequality.data_provider.provide_data(tfrecord_file_pattern, split_name="train", batch_size=batch_size, num_classes=4, image_width=image_width, image_height=image_height, patch_width=28, randomize=True, defocus_psfs=defocus_psfs)
+
+        assert [batch_size, 28, 28, 1] == images.get_shape().as_list()
+        assert [batch_size, 4] == one_hot_labels.get_shape().as_list()
+
+        with tensorflow.Session() as sess:
+            np_labels = sess.run(one_hot_labels)
+
+    numpy.testing.assert_array_equal(numpy.ones(batch_size), numpy.sum(np_labels, 1))
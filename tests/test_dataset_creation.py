@@ -4,6 +4,7 @@ import tempfile
 import numpy
 import pytest
 
+import microscopeimagequality.data_provider
 import microscopeimagequality.dataset_creation
 
 input_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
@@ -190,3 +191,109 @@ def test_read_unlabeled_dataset():
     assert dataset.labels.shape, (num_images_expected == num_classes)
 
     assert num_images_expected == len(dataset.image_paths)
+
+
+def test_read_dataset_sharded():
+    dataset = microscopeimagequality.dataset_creation.read_dataset([glob_images], num_classes, image_width, image_height, max_images=6, shard_num=1, num_shards=2, use_unlabeled_data=True)
+
+    assert 3 == dataset.num_examples
+
+    assert 0 == numpy.sum(dataset.labels)
+
+
+def test_read_dataset_labeled_requires_glob_per_class():
+    with pytest.raises(ValueError):
+        microscopeimagequality.dataset_creation.read_dataset([glob_images], num_classes, image_width, image_height)
+
+
+def test_convert_to_examples_with_pool_matches_serial():
+    labels = numpy.array([[0.0, 1.0], [1.0, 0.0], [0.5, 0.5]], dtype=numpy.float32)
+    image_paths = [input_image_path] * 3
+    records = []
+    for num_workers, pool_type in [(None, microscopeimagequality.dataset_creation.POOL_THREAD),
+                                   (2, microscopeimagequality.dataset_creation.POOL_THREAD),
+                                   (2, microscopeimagequality.dataset_creation.POOL_PROCESS)]:
+        num_examples = microscopeimagequality.dataset_creation.convert_to_examples(
+            microscopeimagequality.dataset_creation.Dataset(labels, image_paths, image_width, image_height),
+            output_directory=test_dir,
+            output_tfrecord_filename="data_pool.tfrecord",
+            randomize=False,
+            num_workers=num_workers,
+            pool_type=pool_type
+        )
+        assert num_examples == 3
+        with open(os.path.join(test_dir, "data_pool.tfrecord"), "rb") as f:
+            records.append(f.read())
+
+    # A single writer keeps the output ordering deterministic.
+    assert records[0] == records[1] == records[2]
+
+
+def test_encode_image_raw_uint16():
+    image = numpy.array([[0.0, 1.0], [0.5, 1.0 / 65535]], dtype=numpy.float32)
+    encoded = microscopeimagequality.dataset_creation.encode_image(image, microscopeimagequality.data_provider.ENCODING_RAW_UINT16)
+    decoded = numpy.frombuffer(encoded, dtype="<u2").reshape(image.shape)
+    numpy.testing.assert_array_equal([[0, 65535], [32768, 1]], decoded)
+
+
+def test_encode_image_invalid_encoding():
+    with pytest.raises(ValueError):
+        microscopeimagequality.dataset_creation.encode_image(numpy.zeros((2, 2)), "jpeg")
+
+
+def test_convert_to_examples_serial_leaves_worker_dataset_unset():
+    labels = numpy.array([[0.0, 1.0], [1.0, 0.0], [0.5, 0.5]], dtype=numpy.float32)
+    image_paths = [input_image_path] * 3
+    microscopeimagequality.dataset_creation._init_example_worker(None, None, None)
+    microscopeimagequality.dataset_creation.convert_to_examples(
+        microscopeimagequality.dataset_creation.Dataset(labels, image_paths, image_width, image_height),
+        output_directory=test_dir,
+        output_tfrecord_filename="data_serial.tfrecord"
+    )
+
+    assert microscopeimagequality.dataset_creation._worker_dataset is None
+
+
+def test_convert_to_examples_sharded():
+    labels = numpy.array([[0.0, 1.0], [1.0, 0.0], [0.5, 0.5]], dtype=numpy.float32)
+    image_paths = [input_image_path] * 3
+    num_examples = microscopeimagequality.dataset_creation.convert_to_examples(
+        microscopeimagequality.dataset_creation.Dataset(labels, image_paths, image_width, image_height),
+        output_directory=test_dir,
+        output_tfrecord_filename="data_sharded.tfrecord",
+        num_output_shards=2
+    )
+
+    tf_record_path = os.path.join(test_dir, "data_sharded.tfrecord")
+    data_sources = microscopeimagequality.data_provider.get_data_sources(tf_record_path)
+    assert 3 == num_examples
+    assert 3 == microscopeimagequality.data_provider.get_num_records(tf_record_path)
+    assert 2 == len(data_sources)
+    for path in data_sources:
+        assert os.path.isfile(path)
+
+
+def test_convert_to_examples_rerun_with_and_without_shards():
+    labels = numpy.array([[0.0, 1.0], [1.0, 0.0], [0.5, 0.5]], dtype=numpy.float32)
+    tf_record_path = os.path.join(test_dir, "data_rerun.tfrecord")
+
+    for num_output_shards, num_examples in [(3, 3), (None, 2), (2, 3)]:
+        microscopeimagequality.dataset_creation.convert_to_examples(
+            microscopeimagequality.dataset_creation.Dataset(labels[:num_examples], [input_image_path] * num_examples, image_width, image_height),
+            output_directory=test_dir,
+            output_tfrecord_filename="data_rerun.tfrecord",
+            num_output_shards=num_output_shards
+        )
+
+        data_sources = microscopeimagequality.data_provider.get_data_sources(tf_record_path)
+        assert num_examples == microscopeimagequality.data_provider.get_num_records(tf_record_path)
+        assert (num_output_shards or 1) == len(data_sources)
+
+    # Only the shards of the last conversion are left.
+    assert not os.path.isfile(microscopeimagequality.data_provider.get_shard_filename(tf_record_path, 2, 3))
+    assert not os.path.isfile(microscopeimagequality.data_provider.get_filename_num_records(tf_record_path))
+
+
+def test_read_image_shape():
+    for path in [input_image_path, input_image_path_tif]:
+        assert (520, 696) == microscopeimagequality.dataset_creation.read_image_shape(path)
@@ -2,6 +2,7 @@ import os
 import tempfile
 
 import numpy
+import pytest
 import skimage.io
 import tensorflow
 
@@ -168,3 +169,111 @@ def test_degrade_images_no_change():
     expected_image = get_test_image("cell_image.tiff")
 
     numpy.testing.assert_almost_equal(expected_image, degraded_image, 4)
+
+
+def test_evaluate_airy_function_at_radii_matches_quadrature():
+    radii = numpy.array([0.0, 0.3e-6, 1.0e-6, 4.2e-6])
+
+    psf_values = microscopeimagequality.degrade._evaluate_airy_function_at_radii(radii, 2e-6, 500e-9, 0.5, 1.0)
+
+    expected_psf_values = [
+        microscopeimagequality.degrade._evaluate_airy_function_at_point(radius, 0.0, 2e-6, 500e-9, 0.5, 1.0)
+        for radius in radii]
+    numpy.testing.assert_allclose(expected_psf_values, psf_values, rtol=1e-8, atol=1e-12)
+
+
+def test_get_cached_airy_psf():
+    cache_directory = os.path.join(test_dir, "psf_cache")
+    expected_psf = microscopeimagequality.degrade.get_airy_psf(21, 5e-6, 4.0e-6, 500e-9, 0.5, 1.0)
+
+    psf = microscopeimagequality.degrade.get_cached_airy_psf(21, 5e-6, 4.0e-6, 500e-9, 0.5, 1.0, cache_directory)
+
+    numpy.testing.assert_array_equal(expected_psf, psf)
+    assert not psf.flags.writeable
+    assert 1 == len(os.listdir(cache_directory))
+
+    # The psf is read from the cache directory when it is not in memory.
+    microscopeimagequality.degrade._psf_cache.clear()
+    cached_psf = microscopeimagequality.degrade.get_cached_airy_psf(21, 5e-6, 4.0e-6, 500e-9, 0.5, 1.0, cache_directory)
+
+    numpy.testing.assert_array_equal(expected_psf, cached_psf)
+    assert cached_psf is microscopeimagequality.degrade.get_cached_airy_psf(21, 5e-6, 4.0e-6, 500e-9, 0.5, 1.0)
+
+
+def test_blur_kernel_fft_matches_direct():
+    image = numpy.random.RandomState(0).rand(40, 30)
+
+    # Kernels with negative weights, e.g. sharpening ones, can blur outside the input range.
+    psfs = [numpy.random.RandomState(1).rand(5, 5), numpy.random.RandomState(1).rand(7, 4), numpy.random.RandomState(2).rand(5, 5) - 0.3]
+
+    for psf in psfs:
+
+        expected_image = microscopeimagequality.degrade.BlurKernel(psf, use_fft=False).apply(image)
+
+        blur_kernel = microscopeimagequality.degrade.BlurKernel(psf, use_fft=True)
+
+        numpy.testing.assert_allclose(expected_image, blur_kernel.apply(image), atol=1e-12)
+        numpy.testing.assert_allclose(expected_image, blur_kernel.apply(image), atol=1e-12)
+
+
+def test_degrade_stack():
+    glob = os.path.join(test_data_directory, "cell_image.tiff*")
+
+    output_path = os.path.join(test_dir, "stack")
+
+    class_globs = microscopeimagequality.degrade.degrade_stack(glob, output_path, [20e-6, 0e-6], [1.0], 0, 65535, 0, psf_width_pixels=21, pixel_size_meters=5e-6 / 21)
+
+    assert [os.path.join(output_path, "0", "*.png"), os.path.join(output_path, "1", "*.png")] == class_globs
+
+    degraded_image = microscopeimagequality.dataset_creation.read_16_bit_greyscale(os.path.join(output_path, "0", "cell_image.png"))
+
+    expected_image = get_test_image("cell_image_degraded.png")
+
+    numpy.testing.assert_almost_equal(expected_image, degraded_image, 4)
+
+    assert os.path.isfile(os.path.join(output_path, "1", "cell_image.png"))
+
+
+def test_degrade_stack_mismatched_exposure_factors():
+    glob = os.path.join(test_data_directory, "cell_image.tiff*")
+
+    with pytest.raises(ValueError):
+        microscopeimagequality.degrade.degrade_stack(glob, test_dir, [0e-6, 1e-6, 2e-6], [1.0, 2.0], 0, 65535, 0)
+
+
+def test_degrade_images_with_workers_is_reproducible():
+    glob = os.path.join(test_data_directory, "BBBC006_z_aligned__a0[1-3]__s1__w1_10.png")
+
+    degraded_images = []
+
+    for num_workers in [1, 3]:
+        output_path = os.path.join(test_dir, "workers_%d" % num_workers)
+
+        microscopeimagequality.degrade.degrade_images(glob, output_path, 2e-6, 1.0, 0, 65535, 0, psf_width_pixels=21, num_workers=num_workers)
+
+        degraded_images.append([skimage.io.imread(os.path.join(output_path, filename)) for filename in sorted(os.listdir(output_path))])
+
+    assert len(degraded_images[0]) == len(degraded_images[1]) > 1
+
+    for expected_image, degraded_image in zip(*degraded_images):
+        numpy.testing.assert_array_equal(expected_image, degraded_image)
+
+
+def test_get_image_seed():
+    seed = microscopeimagequality.degrade._get_image_seed(0, "/a/image.png")
+
+    assert seed == microscopeimagequality.degrade._get_image_seed(0, "/b/image.png")
+
+    assert seed != microscopeimagequality.degrade._get_image_seed(1, "/a/image.png")
+
+    assert 0 <= seed < 2 ** 32
+
+
+def test_get_output_seed():
+    assert 5 == microscopeimagequality.degrade._get_output_seed(5, 0)
+
+    seeds = [microscopeimagequality.degrade._get_output_seed(5, output_index) for output_index in range(3)]
+
+    assert len(set(seeds)) == 3
+
+    assert all(0 <= seed < 2 ** 32 for seed in seeds)
@@ -3,6 +3,7 @@ import tempfile
 
 import PIL.Image
 import numpy
+import scipy.stats
 import tensorflow
 import tensorflow.contrib.slim
 
@@ -188,12 +189,38 @@ class Evaluation(tensorflow.test.TestCase):
         # This is the first HSV color.
         self.assertEquals((1.0, 0, 0), class_rgb)
 
+    def testGetClassRgbTableMatchesGetClassRgb(self):
+        num_classes = 11
+        class_rgb_table = microscopeimagequality.evaluation._get_class_rgb_table(num_classes)
+        self.assertEquals((num_classes, 3), class_rgb_table.shape)
+        for predicted_class in range(num_classes):
+            numpy.testing.assert_array_equal(
+                microscopeimagequality.evaluation._get_class_rgb(num_classes, predicted_class),
+                class_rgb_table[predicted_class])
+
     def testGetCertainty(self):
         certainty = microscopeimagequality.evaluation.get_certainty(numpy.array([0.5, 0.5]))
         self.assertEquals(0.0, certainty)
         certainty = microscopeimagequality.evaluation.get_certainty(numpy.array([1.0, 0.0]))
         self.assertEquals(1.0, certainty)
 
+    def testCertaintiesFromProbabilitiesMatchesEntropy(self):
+        probabilities = numpy.random.RandomState(0).dirichlet(numpy.ones(11), size=12).astype(numpy.float32)
+        probabilities[0, :] = 0.0
+        probabilities[1, :] = 2.0
+
+        certainties = microscopeimagequality.evaluation.certainties_from_probabilities(probabilities)
+
+        # Zero probabilities have zero certainty.
+        expected_certainties = [0.0] + [
+            1.0 - scipy.stats.entropy(p / numpy.sum(p)) / numpy.log(11) for p in probabilities[1:]]
+        numpy.testing.assert_array_equal(numpy.clip(expected_certainties, 0.0, 1.0), certainties)
+
+        # The batched form gives the same result for each image.
+        batched_certainties = microscopeimagequality.evaluation.certainties_from_probabilities(
+            probabilities.reshape((3, 4, 11)))
+        numpy.testing.assert_array_equal(certainties.reshape((3, 4)), batched_certainties)
+
     def testGetRgbImageRuns(self):
         num_rows = 4
         patch_width = 28
@@ -313,6 +340,19 @@ class Evaluation(tensorflow.test.TestCase):
             image_shape_invalid = (20, 20)
             microscopeimagequality.evaluation._patches_to_image(patches, image_shape_invalid)
 
+    def testPatchesToImageStack(self):
+        num_images = 2
+        patch_width = 28
+        image_shape = patch_width * 2, patch_width * 3
+        patches = numpy.random.rand(num_images, 6, patch_width, patch_width, 1)
+        images = microscopeimagequality.evaluation._patches_to_image(patches, image_shape)
+        self.assertEquals((num_images, image_shape[0], image_shape[1], 1), images.shape)
+        for i in range(num_images):
+            numpy.testing.assert_array_equal(
+                microscopeimagequality.evaluation._patches_to_image(patches[i], image_shape), images[i])
+        # The patches are in row-major order.
+        numpy.testing.assert_array_equal(patches[1, 4], images[1, patch_width:, patch_width:2 * patch_width])
+
     def testSetBorderPixels(self):
         image = numpy.zeros((5, 5, 1))
         image_expected = numpy.ones((5, 5, 1))
@@ -406,13 +446,95 @@ class Evaluation(tensorflow.test.TestCase):
          aggregate_predictions_2) = microscopeimagequality.evaluation.load_inference_results(test_directory)
         numpy.testing.assert_array_equal(aggregate_probabilities,
                                          aggregate_probabilities_2)
-        self.assertEquals(aggregate_labels, aggregate_labels_2)
-        self.assertEquals(certainties['mean'], certainties_2['mean'])
-        self.assertEquals(certainties['max'], certainties_2['max'])
-        self.assertEquals(certainties['aggregate'], certainties_2['aggregate'])
-        self.assertEquals(certainties['weighted'], certainties_2['weighted'])
-        self.assertEquals(orig_names, orig_names_2)
-        self.assertEquals(aggregate_predictions, aggregate_predictions_2)
+        numpy.testing.assert_array_equal(aggregate_labels, aggregate_labels_2)
+        numpy.testing.assert_array_equal(certainties['mean'], certainties_2['mean'])
+        numpy.testing.assert_array_equal(certainties['max'], certainties_2['max'])
+        numpy.testing.assert_array_equal(certainties['aggregate'], certainties_2['aggregate'])
+        numpy.testing.assert_array_equal(certainties['weighted'], certainties_2['weighted'])
+        numpy.testing.assert_array_equal(orig_names, orig_names_2)
+        numpy.testing.assert_array_equal(aggregate_predictions, aggregate_predictions_2)
+
+    def testLoadInferenceColumnsFromShards(self):
+        test_directory = os.path.join(self.test_dir, 'load_columns_test')
+        os.makedirs(test_directory)
+        for shard in range(2):
+            microscopeimagequality.evaluation.save_inference_results(
+                numpy.full((3, 2), shard, dtype=numpy.float32), [shard] * 3,
+                {k: [0.5] * 3 for k in microscopeimagequality.evaluation.CERTAINTY_NAMES},
+                ['name,%d' % shard] * 3, [1] * 3,
+                os.path.join(test_directory, 'results-%d.csv' % shard))
+
+        columns = microscopeimagequality.evaluation.load_inference_columns(
+            test_directory, columns=['labels', 'orig_names'], num_workers=2)
+
+        self.assertEquals(['labels', 'orig_names'], sorted(columns.keys()))
+        numpy.testing.assert_array_equal([0, 0, 0, 1, 1, 1], columns['labels'])
+        numpy.testing.assert_array_equal(['name,0'] * 3 + ['name,1'] * 3, columns['orig_names'])
+
+    def testLoadInferenceResultsFromStore(self):
+        test_directory = os.path.join(self.test_dir, 'store_test')
+        os.makedirs(test_directory)
+        certainties = {k: [0.25, 0.5] for k in microscopeimagequality.evaluation.CERTAINTY_NAMES}
+        microscopeimagequality.evaluation.save_inference_results(
+            numpy.array([[0.1, 0.9], [0.6, 0.4]]), [1, -1], certainties,
+            ['a.png', 'b.png'], [1, 0], os.path.join(test_directory, 'results.csv'))
+        expected_results = microscopeimagequality.evaluation.load_inference_results(test_directory)
+
+        microscopeimagequality.evaluation.convert_inference_results_to_stores(test_directory)
+        os.remove(os.path.join(test_directory, 'results.csv'))
+        results = microscopeimagequality.evaluation.load_inference_results(test_directory)
+
+        self.assertIsInstance(results[0], numpy.memmap)
+        for expected_result, result in zip(expected_results, results):
+            if isinstance(expected_result, dict):
+                for k in microscopeimagequality.evaluation.CERTAINTY_NAMES:
+                    numpy.testing.assert_array_equal(expected_result[k], result[k])
+            else:
+                numpy.testing.assert_array_equal(expected_result, result)
+
+    def testConvertInferenceResultsToStoresAfterCsvRewrite(self):
+        test_directory = os.path.join(self.test_dir, 'store_rewrite_test')
+        os.makedirs(test_directory)
+        results_path = os.path.join(test_directory, 'results.csv')
+        certainties = {k: [0.25, 0.5] for k in microscopeimagequality.evaluation.CERTAINTY_NAMES}
+        microscopeimagequality.evaluation.save_inference_results(
+            numpy.array([[0.1, 0.9], [0.6, 0.4]]), [1, -1], certainties,
+            ['a.png', 'b.png'], [1, 0], results_path)
+        microscopeimagequality.evaluation.convert_inference_results_to_stores(test_directory)
+
+        # The .csv file is rewritten after its store.
+        store_path = microscopeimagequality.evaluation.get_results_store_path(results_path)
+        store_mtime = os.path.getmtime(store_path)
+        os.utime(store_path, (store_mtime - 100, store_mtime - 100))
+        os.utime(results_path, (store_mtime - 50, store_mtime - 50))
+        self.assertIsNone(microscopeimagequality.evaluation._get_results_store_if_current(results_path))
+
+        microscopeimagequality.evaluation.convert_inference_results_to_stores(test_directory)
+
+        self.assertIsNotNone(microscopeimagequality.evaluation._get_results_store_if_current(results_path))
+
+    def testLoadValidSizes(self):
+        test_directory = os.path.join(self.test_dir, 'valid_sizes_test')
+        os.makedirs(test_directory)
+        certainties = {k: [0.25, 0.5] for k in microscopeimagequality.evaluation.CERTAINTY_NAMES}
+        microscopeimagequality.evaluation.save_inference_results(
+            numpy.array([[0.1, 0.9], [0.6, 0.4]]), [1, -1], certainties,
+            ['a.png', 'b.png'], [1, 0], os.path.join(test_directory, 'results-0.csv'),
+            [[84, 168], [168, 84]])
+        # Results saved without valid sizes have unknown sizes.
+        microscopeimagequality.evaluation.save_inference_results(
+            numpy.array([[0.2, 0.8]]), [1], {k: [0.75] for k in microscopeimagequality.evaluation.CERTAINTY_NAMES},
+            ['c.png'], [1], os.path.join(test_directory, 'results-1.csv'))
+        columns = [microscopeimagequality.evaluation.RESULT_PROBABILITIES,
+                   microscopeimagequality.evaluation.RESULT_VALID_SIZES]
+
+        results = microscopeimagequality.evaluation.load_inference_columns(test_directory, columns)
+        microscopeimagequality.evaluation.convert_inference_results_to_stores(test_directory)
+        results_from_stores = microscopeimagequality.evaluation.load_inference_columns(test_directory, columns)
+
+        for r in [results, results_from_stores]:
+            numpy.testing.assert_allclose([[0.1, 0.9], [0.6, 0.4], [0.2, 0.8]], r['probabilities'])
+            numpy.testing.assert_array_equal([[84, 168], [168, 84], [-1, -1]], r['valid_sizes'])
 
     def testSaveResultPlotsRuns(self):
         num_classes = 4
@@ -32,6 +32,14 @@ class Inference(tensorflow.test.TestCase):
         self.assertEquals((168, 252), mask.shape)
         self.assertEquals(numpy.iinfo(numpy.uint16).max, numpy.max(mask))
 
+    def testPatchValuesToMaskStack(self):
+        values = numpy.arange(12, dtype=numpy.uint16).reshape((2, 2, 3))
+        masks = microscopeimagequality.prediction.patch_values_to_mask(values, self.patch_width)
+        self.assertEquals((2, 168, 252), masks.shape)
+        self.assertEquals(10, masks[1, self.patch_width, self.patch_width])
+        numpy.testing.assert_array_equal(
+            microscopeimagequality.prediction.patch_values_to_mask(values[0], self.patch_width), masks[0])
+
     def testSaveMasksAndAnnotatedVisualization(self):
         test_filename = 'BBBC006_z_aligned__a01__s1__w1_10.png'
         orig_name = os.path.join(self.test_data_directory, test_filename)
@@ -112,6 +120,93 @@ class Inference(tensorflow.test.TestCase):
                                          mask_format % orig_name_png)
             self.assertTrue(os.path.isfile(expected_file))
 
+    def testSaveInferenceOutputs(self):
+        test_filename = 'BBBC006_z_aligned__a01__s1__w1_10.png'
+        orig_name = os.path.join(self.test_data_directory, test_filename)
+        num_patches = 4
+        np_images = numpy.ones((num_patches, self.patch_width, self.patch_width, 1))
+        np_probabilities = numpy.ones(
+            (num_patches, self.num_classes)) / self.num_classes
+        np_labels = -1 * numpy.ones(num_patches)
+        np_image_paths = [[str.encode(orig_name)]]
+        image_height = int(numpy.sqrt(num_patches)) * self.patch_width
+        image_width = image_height
+        samples = [(np_probabilities, np_labels, np_images, np_image_paths)] * 2
+
+        microscopeimagequality.prediction.save_inference_outputs(
+            samples, self.test_dir, image_height, image_width, show_plots=False,
+            shard_num=0, num_shards=1, patch_width=self.patch_width,
+            aggregation_method=microscopeimagequality.evaluation.METHOD_AVERAGE)
+
+        self.assertTrue(os.path.isfile(os.path.join(self.test_dir, 'results-00000-of-00001.csv')))
+        self.assertTrue(os.path.isfile(os.path.join(self.test_dir, 'miq_histogram.png')))
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.test_dir, microscopeimagequality.constants.VALID_MASK_FORMAT % test_filename)))
+
+    def testSaveInferenceOutputsWithPatchStride(self):
+        test_filename = 'BBBC006_z_aligned__a01__s1__w1_10.png'
+        orig_name = os.path.join(self.test_data_directory, test_filename)
+        stride = self.patch_width // 2
+        image_size = 2 * self.patch_width
+        # 3 x 3 patches, of which those in the corners don't overlap.
+        num_patches = 9
+        np_images = numpy.ones((num_patches, self.patch_width, self.patch_width, 1))
+        np_probabilities = numpy.zeros((num_patches, self.num_classes))
+        np_probabilities[:, 1] = 1.0
+        np_probabilities[[0, 2, 6, 8], 1] = 0.0
+        np_probabilities[[0, 2, 6, 8], 2] = 1.0
+        np_labels = -1 * numpy.ones(num_patches)
+        samples = [(np_probabilities, np_labels, np_images, [[str.encode(orig_name)]])]
+
+        microscopeimagequality.prediction.save_inference_outputs(
+            samples, self.test_dir, image_size, image_size, show_plots=False,
+            shard_num=0, num_shards=1, patch_width=self.patch_width,
+            aggregation_method=microscopeimagequality.evaluation.METHOD_AVERAGE,
+            patch_stride=stride)
+
+        predictions_mask = numpy.asarray(PIL.Image.open(os.path.join(
+            self.test_dir, microscopeimagequality.constants.PREDICTIONS_MASK_FORMAT % test_filename)))
+        self.assertTrue(numpy.all(predictions_mask[:image_size, :image_size] == 2))
+        dense_predictions_mask = numpy.asarray(PIL.Image.open(os.path.join(
+            self.test_dir, microscopeimagequality.constants.DENSE_PREDICTIONS_MASK_FORMAT % test_filename)))
+        self.assertEquals((image_size, image_size), dense_predictions_mask.shape)
+        self.assertEquals(2, dense_predictions_mask[0, 0])
+        self.assertEquals(1, dense_predictions_mask[image_size // 2, image_size // 2])
+
+    def testSaveInferenceOutputsWithPatchStrideNotDividingPatchWidth(self):
+        with self.assertRaises(ValueError):
+            microscopeimagequality.prediction.save_inference_outputs(
+                [], self.test_dir, self.patch_width, self.patch_width, show_plots=False,
+                shard_num=0, num_shards=1, patch_width=self.patch_width,
+                aggregation_method=microscopeimagequality.evaluation.METHOD_AVERAGE,
+                patch_stride=self.patch_width // 2 + 1)
+
+    def testSaveInferenceOutputsWithResultsStore(self):
+        orig_name = os.path.join(self.test_data_directory, 'BBBC006_z_aligned__a01__s1__w1_10.png')
+        num_patches = 4
+        np_images = numpy.ones((num_patches, self.patch_width, self.patch_width, 1))
+        np_probabilities = numpy.ones((num_patches, self.num_classes)) / self.num_classes
+        np_labels = -1 * numpy.ones(num_patches)
+        samples = [(np_probabilities, np_labels, np_images, [[str.encode(orig_name)]])]
+
+        microscopeimagequality.prediction.save_inference_outputs(
+            samples, self.test_dir, 2 * self.patch_width, 2 * self.patch_width, show_plots=False,
+            shard_num=0, num_shards=1, patch_width=self.patch_width,
+            aggregation_method=microscopeimagequality.evaluation.METHOD_AVERAGE, results_store=True)
+
+        results_path = os.path.join(self.test_dir, 'results-00000-of-00001.csv')
+        self.assertEquals(microscopeimagequality.evaluation.get_results_store_path(results_path),
+                          microscopeimagequality.evaluation._get_results_store_if_current(results_path))
+        columns = microscopeimagequality.evaluation.RESULT_COLUMNS + [microscopeimagequality.evaluation.RESULT_VALID_SIZES]
+        from_csv, _ = microscopeimagequality.evaluation._load_inference_csv((results_path, columns))
+        from_store = microscopeimagequality.evaluation.load_inference_columns(self.test_dir, columns)
+        for column in columns:
+            if column == microscopeimagequality.evaluation.RESULT_CERTAINTIES:
+                for k in microscopeimagequality.evaluation.CERTAINTY_NAMES:
+                    numpy.testing.assert_allclose(from_csv[column][k], from_store[column][k])
+            else:
+                numpy.testing.assert_array_equal(from_csv[column], from_store[column])
+
     def testRunModelInferenceFirstHalfRuns(self):
         batch_size = 1
         num_classes = 11
@@ -156,3 +251,111 @@ class Inference(tensorflow.test.TestCase):
                 is_training=False).labels
 
             self.assertEquals(batch_size, labels.get_shape())
+
+    def testGetBatchTilesTensor(self):
+        num_images = 3
+        images = numpy.zeros((num_images, 2 * self.patch_width, self.patch_width, 1))
+        for i in range(num_images):
+            images[i, self.patch_width:, :, :] = 1.0 + i
+        with self.test_session() as sess:
+            tiles = microscopeimagequality.prediction._get_batch_tiles_tensor(
+                tensorflow.constant(images, dtype=tensorflow.float32), self.patch_width)
+            np_tiles = sess.run(tiles)
+
+        # The tiles of each image are contiguous and in row-major order.
+        self.assertEquals((2 * num_images, self.patch_width, self.patch_width, 1), np_tiles.shape)
+        numpy.testing.assert_array_equal([0, 1, 0, 2, 0, 3], numpy.max(np_tiles, axis=(1, 2, 3)))
+
+    def testGetPatchLocations(self):
+        locations = microscopeimagequality.prediction._get_patch_locations(
+            (2 * self.patch_width, 3 * self.patch_width + 10), self.patch_width)
+
+        # The last full row and column of patches are included.
+        self.assertEquals((6, 4), locations.shape)
+        numpy.testing.assert_array_equal([0, 0, self.patch_width, self.patch_width], locations[0])
+        numpy.testing.assert_array_equal([0, 2 * self.patch_width, self.patch_width, self.patch_width], locations[2])
+        numpy.testing.assert_array_equal(
+            [self.patch_width, 2 * self.patch_width, self.patch_width, self.patch_width], locations[-1])
+
+    def testGetPatchLocationsWithStride(self):
+        stride = self.patch_width // 2
+        locations = microscopeimagequality.prediction._get_patch_locations(
+            (self.patch_width, 2 * self.patch_width), self.patch_width, stride)
+
+        self.assertEquals((3, 4), locations.shape)
+        numpy.testing.assert_array_equal([0, stride, 2 * stride], locations[:, 1])
+
+    def testPatchProbabilitiesToMap(self):
+        stride = self.patch_width // 2
+        locations = microscopeimagequality.prediction._get_patch_locations(
+            (self.patch_width, 2 * self.patch_width), self.patch_width, stride)
+        probabilities = numpy.zeros((3, self.num_classes))
+        probabilities[:, 0] = [1.0, 0.0, 1.0]
+        probabilities[:, 1] = [0.0, 1.0, 0.0]
+
+        probability_map = microscopeimagequality.prediction.patch_probabilities_to_map(
+            probabilities, locations, (self.patch_width + 1, 2 * self.patch_width))
+
+        self.assertEquals((self.patch_width + 1, 2 * self.patch_width, self.num_classes), probability_map.shape)
+        # Pixels covered by two patches have the average of their probabilities.
+        numpy.testing.assert_allclose([1.0, 0.5, 0.5, 1.0], probability_map[0, ::stride, 0])
+        numpy.testing.assert_allclose(1.0, numpy.sum(probability_map[:-1], 2))
+        # The last row is not covered by any patch.
+        numpy.testing.assert_allclose(0.0, probability_map[-1])
+
+    def testPatchProbabilitiesToMapMatchesPerPatchAverage(self):
+        stride = self.patch_width // 3
+        image_shape = (2 * self.patch_width + 1, 3 * self.patch_width)
+        locations = microscopeimagequality.prediction._get_patch_locations(
+            image_shape, self.patch_width, stride)
+        probabilities = numpy.random.RandomState(0).rand(len(locations), self.num_classes)
+
+        probability_map = microscopeimagequality.prediction.patch_probabilities_to_map(
+            probabilities, locations, image_shape)
+
+        for row, col in [(0, 0), (stride, stride + 1), (self.patch_width, 2 * self.patch_width - 1)]:
+            covering = [(r <= row < r + h) and (c <= col < c + w) for r, c, h, w in locations]
+            numpy.testing.assert_allclose(numpy.mean(probabilities[covering], 0), probability_map[row, col])
+
+    def testSaveMergedResultPlots(self):
+        test_filename = 'BBBC006_z_aligned__a01__s1__w1_10.png'
+        orig_name = os.path.join(self.test_data_directory, test_filename)
+        num_patches = 4
+        np_images = numpy.ones((num_patches, self.patch_width, self.patch_width, 1))
+        np_probabilities = numpy.ones(
+            (num_patches, self.num_classes)) / self.num_classes
+        np_labels = -1 * numpy.ones(num_patches, dtype=numpy.int64)
+        np_image_paths = [[str.encode(orig_name)]]
+        image_height = int(numpy.sqrt(num_patches)) * self.patch_width
+        image_width = image_height
+        samples = [(np_probabilities, np_labels, np_images, np_image_paths)]
+
+        num_shards = 2
+        for shard_num in range(num_shards):
+            microscopeimagequality.prediction.save_inference_outputs(
+                samples, self.test_dir, image_height, image_width, show_plots=False,
+                shard_num=shard_num, num_shards=num_shards, patch_width=self.patch_width,
+                aggregation_method=microscopeimagequality.evaluation.METHOD_AVERAGE)
+
+        # Plots are only saved from the results of all shards.
+        self.assertFalse(os.path.isfile(os.path.join(self.test_dir, 'miq_histogram.png')))
+        microscopeimagequality.prediction.save_merged_result_plots(self.test_dir)
+        self.assertTrue(os.path.isfile(os.path.join(self.test_dir, 'miq_histogram.png')))
+
+    def testGetNumInferenceShardsAtMostNumImages(self):
+        glob_images = os.path.join(self.test_data_directory, 'BBBC006_z_aligned__a01__s1__w1_10.png')
+
+        num_shards = microscopeimagequality.prediction._get_num_inference_shards(
+            [glob_images], 4, 84, 84, self.num_classes)
+
+        self.assertEquals(1, num_shards)
+
+    def testRemoveShardResults(self):
+        for filename in ['results-00000-of-00002.csv', 'results-00001-of-00002.csv', 'results_all.csv']:
+            with open(os.path.join(self.test_dir, filename), 'w') as f:
+                f.write('original filename\n')
+        os.makedirs(os.path.join(self.test_dir, 'results-00000-of-00002.columns'))
+
+        microscopeimagequality.prediction._remove_shard_results(self.test_dir)
+
+        self.assertEquals(['results_all.csv'], sorted(os.listdir(self.test_dir)))
@@ -0,0 +1,153 @@
+import os
+import tempfile
+
+import numpy
+import pytest
+import skimage.io
+
+import microscopeimagequality.evaluation
+import microscopeimagequality.summarize
+
+
+def _save_annotated_image(experiment_path, orig_name, valid_height, valid_width):
+    image = numpy.zeros((20, 30, 3), dtype=numpy.uint8)
+    mask = numpy.zeros((20, 30), dtype=numpy.uint16)
+    mask[:valid_height, :valid_width] = 65535
+    skimage.io.imsave(os.path.join(experiment_path, 'actual0_pred1_mean_certainty=0.500orig_name=%s.png' % orig_name), image)
+    skimage.io.imsave(os.path.join(experiment_path, 'valid_mask_%s.png' % orig_name), mask)
+
+
+def test_get_annotated_image_index():
+    experiment_path = tempfile.mkdtemp()
+    _save_annotated_image(experiment_path, 'image_a', 10, 20)
+    _save_annotated_image(experiment_path, 'image_ab', 10, 20)
+
+    index = microscopeimagequality.summarize.get_annotated_image_index(experiment_path)
+
+    assert sorted(index.keys()) == ['image_a', 'image_ab']
+    assert index['image_a'] == {'annotated': 'actual0_pred1_mean_certainty=0.500orig_name=image_a.png',
+                                'valid_mask': 'valid_mask_image_a.png'}
+    assert os.path.isfile(os.path.join(experiment_path, microscopeimagequality.summarize.ANNOTATED_IMAGE_INDEX_FILENAME))
+    assert microscopeimagequality.summarize.get_annotated_image_index(experiment_path) == index
+    # No temporary files are left behind.
+    assert sorted(f for f in os.listdir(experiment_path) if f.endswith('.json')) == [
+        microscopeimagequality.summarize.ANNOTATED_IMAGE_INDEX_FILENAME]
+
+
+def test_read_valid_part_of_annotated_image_rebuilds_stale_index():
+    experiment_path = tempfile.mkdtemp()
+    _save_annotated_image(experiment_path, 'image_a', 10, 20)
+    index = microscopeimagequality.summarize.get_annotated_image_index(experiment_path)
+
+    _save_annotated_image(experiment_path, 'image_b', 5, 15)
+    image = microscopeimagequality.summarize._read_valid_part_of_annotated_image(experiment_path, 'image_b', index)
+
+    assert image.shape == (5, 15, 3)
+    assert 'image_b' in index
+
+    with pytest.raises(ValueError):
+        microscopeimagequality.summarize._read_valid_part_of_annotated_image(experiment_path, 'image_c', index)
+
+
+def test_read_valid_part_of_annotated_image_with_valid_size():
+    experiment_path = tempfile.mkdtemp()
+    _save_annotated_image(experiment_path, 'image_a', 10, 20)
+    os.remove(os.path.join(experiment_path, 'valid_mask_image_a.png'))
+    index = microscopeimagequality.summarize.get_annotated_image_index(experiment_path)
+
+    image = microscopeimagequality.summarize._read_valid_part_of_annotated_image(experiment_path, 'image_a', index, (12, 24))
+
+    assert image.shape == (12, 24, 3)
+
+
+def test_thumbnail_cache_evicts_least_recently_used():
+    experiment_path = tempfile.mkdtemp()
+    for orig_name in ['image_a', 'image_b', 'image_c']:
+        _save_annotated_image(experiment_path, orig_name, 10, 20)
+    # Thumbnails are 5 x 10 x 3 bytes, so two fit.
+    cache = microscopeimagequality.summarize.ThumbnailCache(experiment_path, thumbnail_size=10, max_bytes=300)
+
+    assert cache.get('image_a').shape == (5, 10, 3)
+    cache.get('image_b')
+    cache.get('image_a')
+    cache.get('image_c')
+
+    assert len(cache) == 2
+    assert cache.num_bytes == 300
+    assert (cache.num_hits, cache.num_misses) == (1, 3)
+    cache.get('image_a')
+    assert cache.num_misses == 3
+    cache.get('image_b')
+    assert cache.num_misses == 4
+
+
+def test_save_summary_montages():
+    experiment_path = tempfile.mkdtemp()
+    orig_names = ['/images/image_%d.tif' % i for i in range(6)]
+    for i in range(6):
+        _save_annotated_image(experiment_path, 'image_%d' % i, 10, 20)
+    probabilities = numpy.tile([[0.2, 0.8], [0.9, 0.1]], (3, 1))
+    certainties = {k: numpy.linspace(0.1, 0.9, 6) for k in microscopeimagequality.evaluation.CERTAINTY_NAMES}
+
+    microscopeimagequality.summarize.save_summary_montages(
+        probabilities, certainties, orig_names, numpy.argmax(probabilities, 1), experiment_path, experiment_path,
+        valid_sizes=numpy.full((6, 2), -1))
+
+    montage = skimage.io.imread(os.path.join(experiment_path, 'rank_random.jpg'))
+    assert montage.shape == (2 * (10 + 4) - 4, 10 * (20 + 4) - 4, 3)
+    assert os.path.isfile(os.path.join(experiment_path, 'bin_aggregate_certainty_least_to_most.jpg'))
+    with open(os.path.join(experiment_path, 'montage_image_paths.txt')) as f:
+        assert '0, 0 /images/image_' in f.read()
+
+
+def test_save_summary_montages_with_workers_matches_serial():
+    experiment_path = tempfile.mkdtemp()
+    orig_names = ['/images/image_%d.tif' % i for i in range(6)]
+    for i in range(6):
+        _save_annotated_image(experiment_path, 'image_%d' % i, 10, 20)
+    probabilities = numpy.tile([[0.2, 0.8], [0.9, 0.1]], (3, 1))
+    certainties = {k: numpy.linspace(0.1, 0.9, 6) for k in microscopeimagequality.evaluation.CERTAINTY_NAMES}
+    montage_paths = {}
+    for num_workers in [None, 2]:
+        output_path = tempfile.mkdtemp()
+        numpy.random.seed(0)
+        microscopeimagequality.summarize.save_summary_montages(
+            probabilities, certainties, orig_names, numpy.argmax(probabilities, 1), experiment_path, output_path,
+            num_workers=num_workers)
+        with open(os.path.join(output_path, 'montage_image_paths.txt')) as f:
+            montage_paths[num_workers] = f.read().replace(output_path, '')
+
+    assert montage_paths[None] == montage_paths[2]
+
+
+def test_save_histograms_scatter_plots_and_csv_fast():
+    output_path = tempfile.mkdtemp()
+    output_path_all_plots = tempfile.mkdtemp()
+    probabilities = numpy.tile(numpy.identity(11)[[1, 0]], (3, 1))
+    certainties = {k: numpy.linspace(0.1, 0.9, 6) for k in microscopeimagequality.evaluation.CERTAINTY_NAMES}
+
+    microscopeimagequality.summarize.save_histograms_scatter_plots_and_csv(
+        probabilities, [-1] * 6, certainties, ['image_%d.png' % i for i in range(6)], [1, 0] * 3, output_path,
+        output_path_all_plots, num_workers=2, fast=True)
+
+    assert os.path.isfile(os.path.join(output_path, 'certainty_scatter_plot.png'))
+    assert os.path.isfile(os.path.join(output_path, 'histogram_aggregate_certainty.jpg'))
+    assert not os.path.isfile(os.path.join(output_path_all_plots, 'certainty_scatter_plot_all_certainties.png'))
+    assert not os.path.isfile(os.path.join(output_path_all_plots, 'histogram_mean_certainty.jpg'))
+
+
+def test_save_summary_montages_fast():
+    experiment_path = tempfile.mkdtemp()
+    orig_names = ['/images/image_%d.tif' % i for i in range(2)]
+    for i in range(2):
+        _save_annotated_image(experiment_path, 'image_%d' % i, 10, 20)
+    output_path = tempfile.mkdtemp()
+    probabilities = numpy.array([[0.2, 0.8], [0.9, 0.1]])
+    certainties = {k: numpy.array([0.3, 0.6]) for k in microscopeimagequality.evaluation.CERTAINTY_NAMES}
+
+    microscopeimagequality.summarize.save_summary_montages(
+        probabilities, certainties, orig_names, numpy.argmax(probabilities, 1), experiment_path, output_path,
+        fast=True)
+
+    assert sorted(f for f in os.listdir(output_path) if f.endswith('.jpg')) == [
+        'bin_aggregate_certainty_least_to_most.jpg']
@@ -30,3 +30,12 @@ def test_check_image_dimensions_runs():
 def test_check_image_dimensions_image_too_small():
     with pytest.raises(ValueError):
         microscopeimagequality.validation.check_image_dimensions([pathname], 1e4, 1e4)
+
+
+def test_check_image_dimensions_with_workers_reports_all_bad_images():
+    missing_pathname = os.path.join(directory, "missing.png")
+
+    with pytest.raises(ValueError) as error:
+        microscopeimagequality.validation.check_image_dimensions([pathname, missing_pathname, pathname], 1e4, 1e4, num_workers=2)
+
+    assert "Found 3 bad images" in str(error.value)